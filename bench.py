@@ -0,0 +1,522 @@
+"""MailBot 离线基准测试：本地假 SMTP 服务器 + 真实的 /upload-csv -> /send 流程
+
+用法示例：
+    python bench.py send --recipients 2000 --accounts 5 --latency 0.01
+    python bench.py send --backend asyncio --recipients 2000 --accounts 5 --latency 0.01
+    python bench.py template --recipients 100000
+    python bench.py mime --recipients 20000
+    python bench.py memory --recipients 1000000
+    python bench.py micro --scales 10000,100000,1000000
+"""
+import os
+import sys
+import ssl
+import time
+import random
+import asyncio
+import resource
+import argparse
+import tempfile
+import tracemalloc
+from collections import deque
+import threading
+import subprocess
+from io import BytesIO
+
+
+# ================== 假 SMTP 服务器 ==================
+class FakeSMTPServer:
+    # latency: 每条命令回复前的延迟（秒），模拟慢速往返
+    # fail_rate: DATA 阶段返回 550 的概率
+    # drop_after: 每个连接发送 N 封后对下一个 MAIL 返回 421 并断开
+    # reject / tempfail: 对这些收件人的 RCPT 返回 550 / 450；auth_fail: 所有登录返回 535
+    # batch_reject: 多个收件人的事务在 DATA 阶段返回 554
+    # drop_after_data: 含这些收件人的事务收下邮件后不回复 250，直接断开
+    def __init__(self, latency=0.0, fail_rate=0.0, drop_after=None, reject=(), tempfail=(), auth_fail=False,
+                 batch_reject=False, drop_after_data=()):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.batch_reject = batch_reject
+        self.drop_after = drop_after
+        self.reject = set(reject)
+        self.tempfail = set(tempfail)
+        self.drop_after_data = set(drop_after_data)
+        self.auth_fail = auth_fail
+        self.connections = 0
+        self.logins = 0
+        self.messages = []
+        self.port = None
+        self._tmp = tempfile.mkdtemp(prefix="fake_smtp_")
+        self._tls = self._make_tls_context()
+        self._loop = None
+        self._server = None
+        self._writers = set()
+
+    def _make_tls_context(self):
+        cert = os.path.join(self._tmp, "cert.pem")
+        key = os.path.join(self._tmp, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key,
+                        "-out", cert, "-days", "1", "-subj", "/CN=localhost"],
+                       check=True, capture_output=True)
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(cert, key)
+        return ctx
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, "127.0.0.1", 0, backlog=1024))
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    # 先关闭仍在进行的会话，各会话读到 EOF 后自行结束，避免事件循环停止后残留的连接在解释器退出时报错
+    async def _shutdown(self):
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=1)
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self._writers.add(writer)
+
+        async def reply(line):
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            writer.write((line + "\r\n").encode())
+            await writer.drain()
+
+        count = 0
+        rcpts = []
+        try:
+            await reply("220 fake ESMTP")
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    return
+                line = raw.decode().rstrip("\r\n")
+                cmd = line[:4].upper()
+                if cmd == "EHLO":
+                    writer.write(b"250-fake\r\n250-PIPELINING\r\n250-8BITMIME\r\n250-AUTH LOGIN PLAIN\r\n")
+                    await reply("250 STARTTLS")
+                elif cmd == "HELO":
+                    await reply("250 fake")
+                elif cmd == "STAR":
+                    await reply("220 ready")
+                    await writer.start_tls(self._tls)
+                elif cmd == "AUTH":
+                    parts = line.split()
+                    if parts[1].upper() == "LOGIN":
+                        # 用户名可以跟在 AUTH LOGIN 后面一起发（aiosmtplib 就是这样）
+                        if len(parts) < 3:
+                            await reply("334 VXNlcm5hbWU6")
+                            await reader.readline()
+                        await reply("334 UGFzc3dvcmQ6")
+                        await reader.readline()
+                    elif len(parts) < 3:
+                        await reply("334 ")
+                        await reader.readline()
+                    if self.auth_fail:
+                        await reply("535 authentication failed")
+                        continue
+                    self.logins += 1
+                    await reply("235 ok")
+                elif cmd == "MAIL":
+                    if self.drop_after is not None and count >= self.drop_after:
+                        await reply("421 too many messages, closing")
+                        return
+                    rcpts = []
+                    await reply("250 ok")
+                elif cmd == "RCPT":
+                    addr = line.split(":", 1)[1].strip().strip("<>")
+                    if addr in self.reject:
+                        await reply("550 no such user")
+                    elif addr in self.tempfail:
+                        await reply("450 mailbox busy")
+                    else:
+                        rcpts.append(addr)
+                        await reply("250 ok")
+                elif cmd == "DATA":
+                    await reply("354 go ahead")
+                    data = []
+                    while True:
+                        raw = await reader.readline()
+                        if not raw:
+                            return
+                        if raw.rstrip(b"\r\n") == b".":
+                            break
+                        data.append(raw)
+                    count += 1
+                    if self.batch_reject and len(rcpts) > 1:
+                        await reply("554 too many recipients")
+                        continue
+                    if random.random() < self.fail_rate:
+                        await reply("550 rejected")
+                        continue
+                    self.messages.append((rcpts, b"".join(data)))
+                    if self.drop_after_data.intersection(rcpts):
+                        return
+                    await reply("250 queued")
+                elif cmd in ("NOOP", "RSET"):
+                    await reply("250 ok")
+                elif cmd == "QUIT":
+                    await reply("221 bye")
+                    return
+                else:
+                    await reply("500 unknown command")
+        except (ConnectionError, ssl.SSLError, asyncio.IncompleteReadError):
+            return
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+# ================== 收件域名解析桩 ==================
+# 不访问 DNS：undeliverable 中的域名视为不存在，其余都可投递
+class StubResolver:
+    def __init__(self, undeliverable=()):
+        self.undeliverable = set(undeliverable)
+        self.queries = 0
+
+    def __call__(self, domain):
+        self.queries += 1
+        if domain in self.undeliverable:
+            return False, "域名不存在"
+        return True, "127.0.0.1"
+
+
+# ================== 端到端吞吐 ==================
+def load_app(accounts, port, workdir):
+    os.chdir(workdir)
+    for i in range(1, accounts + 1):
+        os.environ[f"EMAIL{i}"] = f"bench{i}@example.com"
+        os.environ[f"APP_PASSWORD{i}"] = "secret"
+        os.environ[f"SMTP_SERVER{i}"] = "127.0.0.1"
+        os.environ[f"SMTP_PORT{i}"] = str(port)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    main.DOMAIN_CACHE.resolver = StubResolver()
+    return main
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# 本进程累计写入块设备的字节数；没有 /proc/self/io 时返回 None
+def disk_write_bytes():
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None
+    return int(fields["write_bytes"])
+
+
+def dir_bytes(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def peak_rss_mib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# 单封延迟：从写入在途租约（claim_batch）到该收件人投递成功（finish_recipient）
+def track_latency(main):
+    started, latencies = {}, []
+    claim_batch, finish_recipient = main.claim_batch, main.finish_recipient
+
+    def timed_claim(job, acc, batch):
+        now = time.perf_counter()
+        batch = claim_batch(job, acc, batch)
+        for r in batch:
+            started.setdefault(r.id, now)
+        return batch
+
+    def timed_finish(job, acc, recipient, success, err):
+        finish_recipient(job, acc, recipient, success, err)
+        if success:
+            latencies.append(time.perf_counter() - started.pop(recipient.id))
+
+    main.claim_batch, main.finish_recipient = timed_claim, timed_finish
+    return latencies
+
+
+def bench_send(args):
+    server = FakeSMTPServer(latency=args.latency, fail_rate=args.fail_rate, drop_after=args.drop_after).start()
+    workdir = tempfile.mkdtemp(prefix="mailbot_bench_")
+    main = load_app(args.accounts, server.port, workdir)
+    main.SEND_BACKEND = args.backend
+    main.DAILY_LIMIT = args.daily_limit
+    latencies = track_latency(main)
+    client = main.app.test_client()
+    written = disk_write_bytes()
+
+    rows = "".join(f"user{i}@bench.test,name{i},real{i}\n" for i in range(args.recipients))
+    csv_bytes = ("email,name,real_name\n" + rows).encode("utf-8")
+    client.post("/upload-csv", data={"file": (BytesIO(csv_bytes), "bench.csv")},
+                content_type="multipart/form-data")
+
+    start = time.perf_counter()
+    client.post("/send", json={"subject": "Hi {name}", "body": "Hello {real_name}", "interval": 0})
+    while main.IS_SENDING and time.perf_counter() - start < args.timeout:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    main.close_smtp_pool()
+    server.stop()
+    main.db_checkpoint("TRUNCATE")
+    if written is not None:
+        written = disk_write_bytes() - written
+
+    delivered = len(server.messages)
+    print(f"backend={args.backend} accounts={args.accounts} recipients={args.recipients} latency={args.latency}s")
+    print(f"delivered={delivered} elapsed={elapsed:.2f}s rate={delivered / elapsed:.1f} msg/s "
+          f"connections={server.connections} logins={server.logins}")
+    print(f"per-message p50={percentile(latencies, 0.5) * 1000:.1f}ms p99={percentile(latencies, 0.99) * 1000:.1f}ms "
+          f"peak_rss={peak_rss_mib():.1f}MiB db_size={dir_bytes(workdir) / 2**20:.1f}MiB "
+          f"disk_written={'n/a' if written is None else f'{written / 2**20:.1f}MiB'}")
+    summary = client.get("/metrics-summary").get_json()
+    for phase, item in sorted(summary["phases"].items()):
+        print(f"  {phase:<9} n={item['count']:<6} p50={item['p50']}s p99={item['p99']}s")
+
+
+# ================== 模板渲染 ==================
+def bench_template(args):
+    main = load_app(0, 0, tempfile.mkdtemp(prefix="mailbot_bench_"))
+    source = "您好 {name}，\n我是 {real_name}，来自 {company}。\n" * 5 + "祝好"
+    recipients = [{"email": f"user{i}@bench.test", "name": f"name{i}", "real_name": f"real{i}",
+                   "company": f"company{i % 100}"} for i in range(args.recipients)]
+
+    # 原实现：每个收件人构造变量字典后调用 str.format
+    start = time.perf_counter()
+    expected = []
+    for r in recipients:
+        safe = {"name": r.get("name", ""), "real_name": r.get("real_name", ""), "company": r.get("company", "")}
+        expected.append(source.format(**safe))
+    format_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    template = main.CompiledTemplate(source)
+    rendered = template.render_many(recipients)
+    compiled_elapsed = time.perf_counter() - start
+
+    assert rendered == expected
+
+    # 表头大小写：固定列不区分大小写，其余列按原样对应模板变量
+    stats = {"rows": 0, "bad": 0}
+    rows = list(main.iter_csv_rows(BytesIO("EMAIL,Name,Real_Name,Company\na@bench.test,A,AA,ACME\n".encode()), stats))
+    assert rows == [{"email": "a@bench.test", "name": "A", "real_name": "AA", "Company": "ACME"}], rows
+    assert main.CompiledTemplate("{name} {Company}").render(rows[0]) == "A ACME"
+
+    print(f"recipients={args.recipients}")
+    print(f"str.format: {format_elapsed:.3f}s ({args.recipients / format_elapsed:.0f}/s)")
+    print(f"compiled:   {compiled_elapsed:.3f}s ({args.recipients / compiled_elapsed:.0f}/s) "
+          f"speedup={format_elapsed / compiled_elapsed:.2f}x")
+
+
+# ================== 邮件骨架 ==================
+MIME_CASES = [
+    ("Hi {name}", "Hello {real_name}"),
+    ("固定主题", "固定正文\n第二行"),
+    ("", ""),
+    ("{name} " + "很长的主题" * 40, "正文 {{不是变量}} {company}\n" * 200),
+    ("Subject with = and ? and _ {name}", "line\r\nwith crlf\n.leading dot\n"),
+    ("emoji 😀 {real_name}", "😀" * 100),
+]
+MIME_RECIPIENTS = [
+    {"email": "plain@bench.test", "name": "张三", "real_name": "Zhang", "company": "ACME"},
+    {"email": "ünï@bench.test", "name": "x", "real_name": "y"},
+    {"email": "odd name@bench.test", "name": "", "real_name": ""},
+]
+
+
+def bench_mime(args):
+    main = load_app(0, 0, tempfile.mkdtemp(prefix="mailbot_bench_"))
+    import smtplib
+
+    # 正确性：骨架输出必须与 MIMEText 路径经 smtplib 规范化后的字节完全一致
+    checked = 0
+    for subject, body in MIME_CASES:
+        factory = main.MessageFactory(main.CompiledTemplate(subject), main.CompiledTemplate(body))
+        for recipient in MIME_RECIPIENTS:
+            for sender in ("sender@bench.test", "发件人@bench.test"):
+                expected = main.build_message({"email": sender}, recipient["email"],
+                                              factory.subject_tpl.render(recipient), factory.body_tpl.render(recipient))
+                expected = smtplib._fix_eols(expected).encode("utf-8")
+                assert factory.build(sender, recipient) == expected, (subject, body, recipient, sender)
+                checked += 1
+    print(f"correctness: {checked} cases identical")
+
+    subject, body = "您好 {name}", "这是一封测试邮件。\n" * 50
+    recipients = [{"email": f"user{i}@bench.test", "name": f"name{i}"} for i in range(args.recipients)]
+    for label, body_source in (("personalized body", body + "{name}"), ("shared body", body)):
+        subject_tpl, body_tpl = main.CompiledTemplate(subject), main.CompiledTemplate(body_source)
+        start = time.perf_counter()
+        for r in recipients:
+            smtplib._fix_eols(main.build_message({"email": "sender@bench.test"}, r["email"],
+                                                 subject_tpl.render(r), body_tpl.render(r))).encode("ascii")
+        mimetext_elapsed = time.perf_counter() - start
+        factory = main.MessageFactory(subject_tpl, body_tpl)
+        start = time.perf_counter()
+        for r in recipients:
+            factory.build("sender@bench.test", r)
+        factory_elapsed = time.perf_counter() - start
+        print(f"{label}: MIMEText {args.recipients / mimetext_elapsed:.0f}/s, "
+              f"factory {args.recipients / factory_elapsed:.0f}/s, speedup={mimetext_elapsed / factory_elapsed:.1f}x")
+
+
+# ================== 收件人内存占用 ==================
+# 改动前的待发送队列布局：每个收件人一个 dict，队列槽位和邮箱索引各套一层 list
+def legacy_queue(recipients):
+    queue, index = deque(), {}
+    for r in recipients:
+        slot = [r]
+        queue.append(slot)
+        index.setdefault(r["email"], []).append(slot)
+    return queue, index
+
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    data = build()
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    return size, elapsed
+
+
+def bench_memory(args):
+    main = load_app(0, 0, tempfile.mkdtemp(prefix="mailbot_bench_"))
+    n = args.recipients
+
+    def rows():
+        for i in range(n):
+            yield f"user{i}@bench.test", f"name{i}", f"real{i}"
+
+    cases = [
+        ("list of dicts", lambda: [{"id": i, "email": e, "name": a, "real_name": b}
+                                   for i, (e, a, b) in enumerate(rows())]),
+        ("dicts in legacy queue", lambda: legacy_queue({"id": i, "email": e, "name": a, "real_name": b}
+                                                       for i, (e, a, b) in enumerate(rows()))),
+        ("list of Recipient", lambda: [main.Recipient(e, a, b, None, i) for i, (e, a, b) in enumerate(rows())]),
+        ("Recipient in PendingQueue", lambda: main.PendingQueue(main.Recipient(e, a, b, None, i)
+                                                                for i, (e, a, b) in enumerate(rows()))),
+        ("sent email index", lambda: {main.normalize_email(e) for e, _, _ in rows()}),
+    ]
+    print(f"recipients={n}")
+    baseline = None
+    for label, build in cases:
+        size, elapsed = measure(build)
+        baseline = baseline or size
+        print(f"{label:26s} {size / 2**20:8.1f} MiB  {size / n:6.0f} B/recipient  "
+              f"{size / baseline:5.2f}x  build {elapsed:.2f}s")
+
+
+# ================== 热点函数微基准 ==================
+# 规模逐级累加（同一个数据库）：N 条收件人记录下的状态写入、N 条 24 小时日志下的 append_log、N 个账号下的取号
+def bench_micro(args):
+    main = load_app(0, 0, tempfile.mkdtemp(prefix="mailbot_bench_"))
+    main.DAILY_LIMIT = 10**9
+    scales = sorted(int(s) for s in args.scales.split(","))
+    rng = random.Random(0)
+    recipients, logs = [], 0
+
+    def timed(op):
+        start = time.perf_counter()
+        for _ in range(args.ops):
+            op()
+        return (time.perf_counter() - start) / args.ops * 1e6
+
+    print(f"ops={args.ops} per measurement, us/op")
+    print(f"{'scale':>9} {'insert/s':>9} {'db_mark_sent':>13} {'append_log':>11} {'get_next_account':>17} {'rss':>8}")
+    for n in scales:
+        # 收件人：补足到 n 条，再随机标记 ops 个为已发送（对应原 save_recipients 的整表写入）
+        start = time.perf_counter()
+        added = [main.Recipient(f"user{i}@bench.test", f"name{i}", f"real{i}", None)
+                 for i in range(len(recipients), n)]
+        for i in range(0, len(added), main.IMPORT_BATCH):
+            main.db_insert_recipients(added[i:i + main.IMPORT_BATCH])
+        insert_rate = len(added) / (time.perf_counter() - start)
+        recipients += added
+        mark_sent = timed(lambda: main.db_mark_sent(rng.choice(recipients), "bench", "bench1@example.com"))
+
+        # 日志：24 小时窗口内补足到 n 条并重新加载，再追加 ops 条
+        now = time.time()
+        main.db_executemany("INSERT INTO logs(epoch,ts,msg,event,account) VALUES (?,?,?,?,?)",
+                            [(now - 3600 + i / n, "", f"已发送给 user{i}@bench.test", "sent", f"bench{i % 100}@example.com")
+                             for i in range(logs, n)])
+        logs = n
+        main.load_logs()
+        append = timed(lambda: main.append_log("已发送给 x@bench.test", event="sent", account="bench1@example.com"))
+
+        # 账号：补足到 n 个后重建就绪堆，测一次取号 + 归还
+        main.ACCOUNTS += [{"email": f"bench{i}@example.com", "app_password": "secret", "selected": True}
+                          for i in range(len(main.ACCOUNTS), n)]
+        main.accounts_changed()
+
+        def next_account():
+            acc = main.get_next_account()
+            main.release_account(acc)
+        next_account()
+        pick = timed(next_account)
+        print(f"{n:>9} {insert_rate:>9.0f} {mark_sent:>13.1f} {append:>11.1f} {pick:>17.1f} {peak_rss_mib():>6.0f}MiB")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="MailBot 离线基准测试")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    send = sub.add_parser("send", help="端到端发送吞吐")
+    send.add_argument("--backend", default="thread", choices=["thread", "asyncio"])
+    send.add_argument("--recipients", type=int, default=1000)
+    send.add_argument("--accounts", type=int, default=3)
+    send.add_argument("--latency", type=float, default=0.0)
+    send.add_argument("--fail-rate", type=float, default=0.0)
+    send.add_argument("--drop-after", type=int, default=None)
+    send.add_argument("--daily-limit", type=int, default=10**9, help="覆盖每账号 24 小时上限（默认不限）")
+    send.add_argument("--timeout", type=float, default=600)
+    send.set_defaults(func=bench_send)
+
+    template = sub.add_parser("template", help="模板渲染：CompiledTemplate 对比 str.format")
+    template.add_argument("--recipients", type=int, default=100000)
+    template.set_defaults(func=bench_template)
+
+    mime = sub.add_parser("mime", help="邮件骨架：与 MIMEText 输出逐字节比对并测速")
+    mime.add_argument("--recipients", type=int, default=20000)
+    mime.set_defaults(func=bench_mime)
+
+    memory = sub.add_parser("memory", help="收件人内存占用：Recipient + PendingQueue 对比 dict 列表")
+    memory.add_argument("--recipients", type=int, default=1000000)
+    memory.set_defaults(func=bench_memory)
+
+    micro = sub.add_parser("micro", help="append_log / db_mark_sent / get_next_account 随规模的单次耗时")
+    micro.add_argument("--scales", default="10000,100000,1000000")
+    micro.add_argument("--ops", type=int, default=2000)
+    micro.set_defaults(func=bench_micro)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,4 +1,5 @@
 import os
+import re
 import csv
 import smtplib
 import time
@@ -9,18 +10,728 @@ from flask import Flask, request, jsonify, render_template_string, send_file, Re
 from email.mime.text import MIMEText
 from email.header import Header
 from io import StringIO, BytesIO
-from threading import Thread, Lock
-from queue import Queue
+from threading import Thread, Lock, RLock, Condition, Event
+from collections import deque
 import atexit
+import signal
+import sys
+import asyncio
+import sqlite3
+import codecs
+import itertools
+import string
+import base64
+import heapq
+import random
+import hashlib
+import bisect
+import socket
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+try:
+    import dns.resolver
+    import dns.exception
+except ImportError:
+    dns = None
 
 
 app = Flask(__name__)
 
 # ================== 配置 ==================
 DAILY_LIMIT = 450
+DB_FILE = os.getenv("DB_FILE","mailbot.db")
+DB_SYNC = os.getenv("DB_SYNC","normal")                        # normal | full
+DB_CHECKPOINT_EVENTS = int(os.getenv("DB_CHECKPOINT_EVENTS",1000))
+DB_CHECKPOINT_MS = int(os.getenv("DB_CHECKPOINT_MS",5000))
+DB_COMPACT_INTERVAL = int(os.getenv("DB_COMPACT_INTERVAL",600))
+USAGE_FLUSH_MS = int(os.getenv("USAGE_FLUSH_MS",1000))   # 发送计数写回间隔：进程被强杀时最多丢失这么久的计数
+# 旧版 JSON 文件，仅在首次启动时导入数据库
 RECIPIENTS_FILE = "recipients.json"
 LOG_FILE_JSON = "send_log.json"
 USAGE_FILE_JSON = "account_usage.json"
+SEND_BACKEND = os.getenv("SEND_BACKEND","thread")      # thread | asyncio
+ASYNC_PER_ACCOUNT = int(os.getenv("ASYNC_PER_ACCOUNT",5))
+ASYNC_GLOBAL = int(os.getenv("ASYNC_GLOBAL",200))
+SMTP_BATCH_SIZE = int(os.getenv("SMTP_BATCH_SIZE",50))   # 模板不含变量时每个事务最多的收件人数
+ACCOUNT_RATE_PER_MIN = float(os.getenv("ACCOUNT_RATE_PER_MIN",0))   # 每个账号每分钟最多发送封数，0 为不限
+HOST_RATE_PER_MIN = float(os.getenv("HOST_RATE_PER_MIN",0))         # 每个 SMTP 主机每分钟最多发送封数
+GLOBAL_RATE_PER_MIN = float(os.getenv("GLOBAL_RATE_PER_MIN",0))     # 全局每分钟最多发送封数
+RATE_BURST = int(os.getenv("RATE_BURST",1))                         # 速率桶最多可累积的令牌数
+SCHEDULER_MAX_WAIT = 5    # 单次等待上限，账号启用、暂停等变化最迟这么久后生效
+MAX_RECIPIENT_ATTEMPTS = int(os.getenv("MAX_RECIPIENT_ATTEMPTS",5))   # 收件人临时失败达到该次数后移入失败列表
+RETRY_BASE = float(os.getenv("RETRY_BASE",60))                      # 临时失败后首次重试的等待秒数，之后每次翻倍（带随机抖动）
+RETRY_MAX = float(os.getenv("RETRY_MAX",3600))                      # 重试等待秒数上限
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS",300))                 # 在途租约时长
+INFLIGHT_RECOVERY = os.getenv("INFLIGHT_RECOVERY","requeue")        # 启动时结果未知的在途收件人：requeue 放回队首 | hold 移入失败列表待人工确认
+DOMAIN_PREFLIGHT = os.getenv("DOMAIN_PREFLIGHT","1") != "0"         # 发送前解析收件域名，过滤无法投递的域名
+DOMAIN_CACHE_TTL = int(os.getenv("DOMAIN_CACHE_TTL",3600))          # 域名可投递的结果缓存秒数
+DOMAIN_NEGATIVE_TTL = int(os.getenv("DOMAIN_NEGATIVE_TTL",600))     # 域名不存在 / 不收信的结果缓存秒数
+DOMAIN_RESOLVE_WORKERS = int(os.getenv("DOMAIN_RESOLVE_WORKERS",16))
+# 进程角色：all 单进程（页面、接口和发送都在本进程）| web 只提供页面和接口，可起多个 worker | sender 只负责发送，可起多个。
+# web / sender 之间不共享内存，活动、账号、暂停状态和事件流都放在同一个 SQLite 库里
+ROLE = os.getenv("MAILBOT_ROLE","all")
+if ROLE not in ("all","web","sender"): raise SystemExit(f"MAILBOT_ROLE 只能是 all、web 或 sender：{ROLE}")
+SHARED = ROLE != "all"
+SENDER_ID = f"{socket.gethostname()}:{os.getpid()}"
+SENDER_POLL = float(os.getenv("SENDER_POLL",1))          # 发送进程同步活动、账号、暂停状态的间隔秒数
+CLAIM_BATCH = int(os.getenv("CLAIM_BATCH",500))          # 发送进程每次从活动中认领的收件人数上限
+CLAIM_PER_ACCOUNT = int(os.getenv("CLAIM_PER_ACCOUNT",20)) # 发送进程每次认领时按每个可用账号认领的收件人数（合并发送时再乘批大小）
+EVENT_RETENTION = int(os.getenv("EVENT_RETENTION",3600))  # 共享事件流保留秒数
+
+# ================== 指标 ==================
+# 热路径只做计数和直方图分桶（一次二分 + 加锁自增），汇总、分位数估算和格式化都在 /metrics、/metrics-summary
+# 被请求时进行；队列深度等状态量在请求时现算，不在发送路径上维护。METRICS=0 时所有记录都是空操作
+METRICS_ENABLED = os.getenv("METRICS","1") != "0"
+METRIC_BUCKETS = (0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60)
+
+# buckets 为空时只记录次数和总和（Prometheus summary），用于标签数量大的序列
+class Histogram:
+    def __init__(self, name, doc, labels, buckets=METRIC_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}      # 标签值元组 -> [各桶计数..., +Inf 桶计数, 总和]
+        self._lock = Lock()
+
+    def observe(self, value, *labels):
+        if not METRICS_ENABLED: return
+        i = bisect.bisect_left(self.buckets,value)
+        with self._lock:
+            s = self.series.get(labels)
+            if s is None: s = self.series[labels] = [0]*(len(self.buckets)+1)+[0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {labels:list(s) for labels,s in self.series.items()}
+
+    def collect(self):
+        kind = "histogram" if self.buckets else "summary"
+        lines = [f"# HELP {self.name} {self.doc}",f"# TYPE {self.name} {kind}"]
+        for labels,s in sorted(self.snapshot().items()):
+            pairs = list(zip(self.labels,labels))
+            cumulative = 0
+            for bound,count in zip(self.buckets+("+Inf",),s) if self.buckets else ():
+                cumulative += count
+                lines.append(f"{self.name}_bucket{metric_labels(pairs+[('le',bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{metric_labels(pairs)} {s[-1]:.6f}")
+            lines.append(f"{self.name}_count{metric_labels(pairs)} {sum(s[:-1])}")
+        return lines
+
+    # 把若干序列按 key(标签值) 合并后给出次数、均值和分位数（桶内线性插值估算）
+    def summary(self, key=lambda labels: labels):
+        merged = {}
+        for labels,s in self.snapshot().items():
+            total = merged.setdefault(key(labels),[0]*len(s))
+            for i,v in enumerate(s): total[i] += v
+        result = {}
+        for k,s in merged.items():
+            count = sum(s[:-1])
+            item = {"count":count,"mean":round(s[-1]/count,6) if count else None}
+            if self.buckets:
+                for q in (0.5,0.9,0.99): item[f"p{round(q*100)}"] = bucket_quantile(self.buckets,s,q)
+            result[k] = item
+        return result
+
+def bucket_quantile(buckets, s, q):
+    count = sum(s[:-1])
+    if not count: return None
+    rank,cumulative,lower = q*count,0,0.0
+    for bound,n in zip(buckets,s):
+        if n and cumulative+n >= rank:
+            return round(lower+(bound-lower)*(rank-cumulative)/n,6)
+        cumulative += n
+        lower = bound
+    return buckets[-1]     # 落在 +Inf 桶，只能给出下限
+
+class Counter:
+    def __init__(self, name, doc, labels):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.series = {} if labels else {():0}
+        self._lock = Lock()
+
+    def inc(self, *labels, n=1):
+        if not METRICS_ENABLED: return
+        with self._lock:
+            self.series[labels] = self.series.get(labels,0)+n
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.series)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.doc}",f"# TYPE {self.name} counter"]
+        for labels,value in sorted(self.snapshot().items()):
+            lines.append(f"{self.name}{metric_labels(list(zip(self.labels,labels)))} {value}")
+        return lines
+
+def metric_labels(pairs):
+    if not pairs: return ""
+    escape = lambda v: str(v).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")
+    return "{"+",".join(f'{k}="{escape(v)}"' for k,v in pairs)+"}"
+
+SMTP_PHASE_SECONDS = Histogram("mailbot_smtp_phase_seconds","SMTP 各阶段耗时：connect/starttls/login/noop/envelope(MAIL+RCPT)/data",("phase","host"))
+ACCOUNT_PHASE_SECONDS = Histogram("mailbot_smtp_account_phase_seconds","按账号的 SMTP 各阶段耗时（只记次数和总和）",("phase","account"),buckets=())
+PERSIST_SECONDS = Histogram("mailbot_persist_seconds","持久化耗时：按 SQL 语句（动词 + 表）以及 append_log 整体",("op",))
+SENT_TOTAL = Counter("mailbot_sent_total","本进程启动以来成功投递的收件人数",("account",))
+SCHEDULER_WAIT_SECONDS = Counter("mailbot_scheduler_wait_seconds_total","发送线程等待账号就绪的累计秒数",())
+
+# 记录一个 SMTP 阶段的耗时
+def observe_phase(phase, account, host, seconds):
+    SMTP_PHASE_SECONDS.observe(seconds,phase,host)
+    ACCOUNT_PHASE_SECONDS.observe(seconds,phase,account)
+
+# ================== SQLite 存储 ==================
+# 收件人 / 日志 / 用量都存 SQLite（WAL 模式），每封邮件只更新对应的一行。
+# WAL 本身就是追加写日志：synchronous=NORMAL 时提交只追加 WAL 不 fsync，
+# 由后台线程按 DB_CHECKPOINT_EVENTS 条 / DB_CHECKPOINT_MS 毫秒做检查点（fsync 并写回主库），
+# 并每 DB_COMPACT_INTERVAL 秒清理过期日志、截断 WAL。发送线程不再承担检查点开销
+DB_LOCK = RLock()   # 可重入：启动迁移在一个写事务里调用其他 db_ 函数
+# 多进程时写锁可能被其他进程短暂占用，等待时间放宽
+DB = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None, timeout=30 if SHARED else 5)
+DB.execute("PRAGMA journal_mode=WAL")
+DB.execute("PRAGMA synchronous=FULL" if DB_SYNC=="full" else "PRAGMA synchronous=NORMAL")
+DB.execute("PRAGMA wal_autocheckpoint=0")
+DB.executescript("""
+CREATE TABLE IF NOT EXISTS recipients(
+    id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    real_name TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL,
+    pos INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_recipients_status_pos ON recipients(status,pos);
+CREATE TABLE IF NOT EXISTS logs(
+    id INTEGER PRIMARY KEY,
+    epoch REAL NOT NULL,
+    ts TEXT NOT NULL,
+    msg TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_logs_epoch ON logs(epoch);
+CREATE TABLE IF NOT EXISTS usage_minutes(
+    email TEXT NOT NULL,
+    minute INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY(email,minute)
+) WITHOUT ROWID;
+""")
+# 以下表只在多进程部署（MAILBOT_ROLE=web / sender）时使用：
+# campaigns 活动；accounts 账号；control 暂停状态、账号版本号和 id / pos 分配计数；
+# events 共享事件流（id 即 SSE 事件 id）；senders 发送进程心跳；account_leases 账号由哪个发送进程负责
+DB.executescript("""
+CREATE TABLE IF NOT EXISTS campaigns(
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    interval INTEGER NOT NULL,
+    priority INTEGER NOT NULL,
+    accounts TEXT,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    created REAL NOT NULL,
+    finished REAL,
+    sent INTEGER,
+    dead INTEGER
+);
+CREATE TABLE IF NOT EXISTS accounts(
+    id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    app_password TEXT NOT NULL,
+    smtp_server TEXT,
+    smtp_port INTEGER,
+    selected INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS control(
+    key TEXT PRIMARY KEY,
+    value
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS events(
+    id INTEGER PRIMARY KEY,
+    epoch REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS senders(
+    id TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL,
+    state TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS account_leases(
+    email TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    lease_until REAL NOT NULL
+) WITHOUT ROWID;
+""")
+
+# 去重、送达记录用的邮箱键：去掉首尾空白后整体转小写（实际邮件系统的本地部分基本都不区分大小写）。
+# 已是归一形式时直接返回原字符串，索引与记录共用同一个对象
+def normalize_email(email):
+    key = email.strip().lower()
+    return email if key == email else key
+
+DB.create_function("normalize_email",1,normalize_email,deterministic=True)
+
+# 旧库补列。gunicorn 多个 worker 同时启动时会并发执行到这里：查列和补列放在同一个写事务中，
+# 先拿到写锁的进程补完列，其余进程拿到锁时已能看到新列，不会重复 ALTER
+DB.execute("BEGIN IMMEDIATE")
+# 日志增加结构化的 event / account 字段
+_log_columns = {r[1] for r in DB.execute("PRAGMA table_info(logs)").fetchall()}
+if "event" not in _log_columns: DB.execute("ALTER TABLE logs ADD COLUMN event TEXT")
+if "account" not in _log_columns: DB.execute("ALTER TABLE logs ADD COLUMN account TEXT")
+# 收件人除 email/name/real_name 外的 CSV 列以 JSON 存在 extra 中，供模板使用
+_recipient_columns = {r[1] for r in DB.execute("PRAGMA table_info(recipients)").fetchall()}
+if "extra" not in _recipient_columns:
+    DB.execute("ALTER TABLE recipients ADD COLUMN extra TEXT")
+# 失败重试次数与最近一次错误；status='dead' 为失败列表（永久拒收或重试次数用尽）
+if "attempts" not in _recipient_columns:
+    DB.execute("ALTER TABLE recipients ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+if "last_error" not in _recipient_columns:
+    DB.execute("ALTER TABLE recipients ADD COLUMN last_error TEXT")
+# 在途租约：SMTP 事务开始前把收件人标为 status='inflight' 并记下活动、租约到期时间与账号，
+# 进程被强杀后启动时据此找回发送中的收件人
+# job 为收件人所属的发送活动，NULL 表示尚未分配
+# retry_at 为临时失败后退避到期的时间，之前不会被认领发送
+for _column,_type in (("campaign","TEXT"),("lease_until","REAL"),("lease_owner","TEXT"),("job","INTEGER"),("retry_at","REAL")):
+    if _column not in _recipient_columns: DB.execute(f"ALTER TABLE recipients ADD COLUMN {_column} {_type}")
+# email_key 为归一邮箱（normalize_email），插入时写入并建索引，按邮箱删除、导入去重都走索引，不再逐行计算
+if "email_key" not in _recipient_columns:
+    DB.execute("ALTER TABLE recipients ADD COLUMN email_key TEXT")
+    DB.execute("UPDATE recipients SET email_key=normalize_email(email)")
+DB.execute("CREATE INDEX IF NOT EXISTS idx_recipients_email_key ON recipients(email_key)")
+# /recipients 的邮箱搜索按 email_key 匹配，不区分大小写
+DB.execute("DROP INDEX IF EXISTS idx_recipients_status_email")
+DB.execute("CREATE INDEX IF NOT EXISTS idx_recipients_status_email_key ON recipients(status,email_key)")
+# 多进程时发送进程按活动认领收件人、按持有者续租
+if SHARED:
+    DB.execute("CREATE INDEX IF NOT EXISTS idx_recipients_job_status_pos ON recipients(job,status,pos)")
+    DB.execute("CREATE INDEX IF NOT EXISTS idx_recipients_lease_owner ON recipients(lease_owner) WHERE lease_owner IS NOT NULL")
+# 退订/屏蔽名单：邮箱按 normalize_email 归一后存储，导入时跳过，加入时删除对应的待发送收件人
+DB.execute("""CREATE TABLE IF NOT EXISTS suppressions(
+    email TEXT PRIMARY KEY,
+    reason TEXT,
+    epoch REAL NOT NULL
+) WITHOUT ROWID""")
+# 幂等键：(活动, 收件人) 送达记录，与收件人状态在同一事务中写入
+DB.execute("""CREATE TABLE IF NOT EXISTS deliveries(
+    campaign TEXT NOT NULL,
+    email TEXT NOT NULL,
+    account TEXT,
+    epoch REAL NOT NULL,
+    PRIMARY KEY(campaign,email)
+) WITHOUT ROWID""")
+DB.execute("COMMIT")
+RECIPIENT_BASE_KEYS = ("id","email","name","real_name")
+
+# 指标标签：SQL 的动词和表名，如 "UPDATE recipients"，按语句文本缓存
+DB_STATEMENT_LABELS = {}
+
+def db_statement_label(sql):
+    label = DB_STATEMENT_LABELS.get(sql)
+    if label is None:
+        words = sql.replace("("," ").split()
+        table = next((words[i+1] for i,w in enumerate(words[:-1]) if w.upper() in ("INTO","UPDATE","FROM")),"")
+        label = f"{words[0].upper()} {table}".strip()
+        if len(DB_STATEMENT_LABELS) < 1000: DB_STATEMENT_LABELS[sql] = label
+    return label
+
+def db_execute(sql, params=()):
+    with DB_LOCK:
+        start = time.perf_counter()
+        rows = DB.execute(sql, params).fetchall()
+        elapsed = time.perf_counter()-start
+    PERSIST_SECONDS.observe(elapsed,db_statement_label(sql))
+    return rows
+
+# 已在事务中（启动迁移期间）时并入外层事务，由外层提交或回滚；返回是否由调用方负责提交
+def db_begin(mode="BEGIN"):
+    if DB.in_transaction: return False
+    DB.execute(mode)
+    return True
+
+def db_executemany(sql, rows):
+    with DB_LOCK:
+        start = time.perf_counter()
+        own = db_begin()
+        try:
+            DB.executemany(sql, rows)
+            if own: DB.execute("COMMIT")
+        except:
+            if own: DB.execute("ROLLBACK")
+            raise
+        elapsed = time.perf_counter()-start
+    PERSIST_SECONDS.observe(elapsed,db_statement_label(sql))
+
+# 多条语句放在同一事务中执行
+def db_execute_atomic(statements):
+    with DB_LOCK:
+        start = time.perf_counter()
+        own = db_begin()
+        try:
+            for sql,params in statements:
+                DB.execute(sql, params)
+            if own: DB.execute("COMMIT")
+        except:
+            if own: DB.execute("ROLLBACK")
+            raise
+        elapsed = time.perf_counter()-start
+    PERSIST_SECONDS.observe(elapsed,db_statement_label(statements[0][0]))
+
+# 在一个写事务中执行 fn(DB) 并返回其结果；BEGIN IMMEDIATE 先拿写锁，多进程并发时事务内读到的不会过时
+def db_transaction(fn):
+    with DB_LOCK:
+        start = time.perf_counter()
+        own = db_begin("BEGIN IMMEDIATE")
+        try:
+            result = fn(DB)
+            if own: DB.execute("COMMIT")
+        except:
+            if own: DB.execute("ROLLBACK")
+            raise
+        elapsed = time.perf_counter()-start
+    PERSIST_SECONDS.observe(elapsed,"transaction")
+    return result
+
+# 队列位置：队尾递增、队首递减，已发送的按发送顺序递增
+POS_HEAD, POS_TAIL = db_execute("SELECT COALESCE(MIN(pos),0), COALESCE(MAX(pos),0) FROM recipients")[0]
+NEXT_RECIPIENT_ID = db_execute("SELECT COALESCE(MAX(id),0)+1 FROM recipients")[0][0]
+POS_LOCK = Lock()
+# 多进程时各进程从 control 表按块领取位置和 id，互不重叠
+POS_BLOCK = 1000
+POS_BLOCKS = {}    # 'pos_head' / 'pos_tail' -> [块内下一个位置, 块内剩余个数]
+if SHARED:
+    DB.execute("INSERT OR IGNORE INTO control(key,value) VALUES ('pos_head',0),('pos_tail',0),('recipient_id',0)")
+    DB.execute("UPDATE control SET value=MIN(value,?) WHERE key='pos_head'", (POS_HEAD,))
+    DB.execute("UPDATE control SET value=MAX(value,?) WHERE key='pos_tail'", (POS_TAIL,))
+    DB.execute("UPDATE control SET value=MAX(value,?) WHERE key='recipient_id'", (NEXT_RECIPIENT_ID-1,))
+
+# 计数 key 加上 n（可为负），返回加之前的值；调用方独占这之后的 |n| 个值
+def db_reserve(key, n):
+    return db_execute("UPDATE control SET value=value+? WHERE key=? RETURNING value-?", (n,key,n))[0][0]
+
+def next_pos(front=False):
+    global POS_HEAD, POS_TAIL
+    with POS_LOCK:
+        if SHARED:
+            key,step = ("pos_head",-1) if front else ("pos_tail",1)
+            block = POS_BLOCKS.get(key)
+            if not block or not block[1]:
+                block = POS_BLOCKS[key] = [db_reserve(key,step*POS_BLOCK)+step,POS_BLOCK]
+            pos = block[0]
+            block[0] += step
+            block[1] -= 1
+            return pos
+        if front:
+            POS_HEAD -= 1
+            return POS_HEAD
+        POS_TAIL += 1
+        return POS_TAIL
+
+def db_insert_recipients(rows, status="pending"):
+    global NEXT_RECIPIENT_ID, POS_TAIL
+    params = []
+    with POS_LOCK:
+        if SHARED:
+            # 整批的 id 和位置一次领取
+            NEXT_RECIPIENT_ID = db_reserve("recipient_id",len(rows))+1
+            POS_TAIL = db_reserve("pos_tail",len(rows))
+        for r in rows:
+            POS_TAIL += 1
+            r.id = NEXT_RECIPIENT_ID
+            NEXT_RECIPIENT_ID += 1
+            params.append((r.id, r.email, normalize_email(r.email), r.name, r.real_name, status, POS_TAIL,
+                           json.dumps(r.extra,ensure_ascii=False) if r.extra else None))
+    db_executemany("INSERT INTO recipients(id,email,email_key,name,real_name,status,pos,extra) VALUES (?,?,?,?,?,?,?,?)", params)
+
+def db_mark_sent(recipient, campaign=None, account=None):
+    update = ("UPDATE recipients SET status='sent', pos=?, lease_until=NULL, lease_owner=NULL WHERE id=?", (next_pos(), recipient["id"]))
+    if campaign is None:
+        db_execute(*update)
+    else:
+        db_execute_atomic([update, ("INSERT OR IGNORE INTO deliveries(campaign,email,account,epoch) VALUES (?,?,?,?)",
+                                    (campaign, normalize_email(recipient["email"]), account, time.time()))])
+
+# 写入在途租约，返回租到的收件人。租约持有者单进程时为账号；多进程时为发送进程，
+# 且只租仍由本进程认领的（已被删除、屏蔽或随活动取消释放的不再发送）
+def db_lease(recipients, campaign, account):
+    lease_until = time.time()+LEASE_SECONDS
+    if SHARED:
+        rows = db_execute(f"""UPDATE recipients SET status='inflight', campaign=?, lease_until=?
+                              WHERE lease_owner=? AND status='pending' AND id IN ({','.join('?'*len(recipients))}) RETURNING id""",
+                          (campaign, lease_until, SENDER_ID, *(r.id for r in recipients)))
+        leased = {r[0] for r in rows}
+        return [r for r in recipients if r.id in leased]
+    db_executemany("UPDATE recipients SET status='inflight', campaign=?, lease_until=?, lease_owner=? WHERE id=?",
+                   [(campaign, lease_until, account, r["id"]) for r in recipients])
+    return recipients
+
+def db_requeue(recipient, front=False, attempts=None, error=None, job=None, retry_at=None):
+    # 多进程时回到本进程活动队列的收件人继续由本进程认领；等待退避的放回库中，到期后由任一发送进程认领
+    shared = SHARED and job is not None and retry_at is None
+    owner,lease_until = (SENDER_ID,time.time()+LEASE_SECONDS) if shared else (None,None)
+    if attempts is None:
+        db_execute("UPDATE recipients SET status='pending', pos=?, job=?, lease_until=?, lease_owner=?, retry_at=? WHERE id=?",
+                   (next_pos(front), job, lease_until, owner, retry_at, recipient["id"]))
+    else:
+        db_execute("UPDATE recipients SET status='pending', pos=?, job=?, attempts=?, last_error=?, lease_until=?, lease_owner=?, retry_at=? WHERE id=?",
+                   (next_pos(front), job, attempts, error, lease_until, owner, retry_at, recipient["id"]))
+
+# 按实际发送顺序（域名交错后）依次把待发送收件人移到队尾，/recipients 按位置分页看到的就是发送顺序。
+# 分批提交，大活动重排期间发送线程的写入不会被长时间阻塞
+def db_reorder(recipients):
+    for i in range(0,len(recipients),IMPORT_BATCH):
+        db_executemany("UPDATE recipients SET pos=? WHERE id=? AND status='pending'",
+                       [(next_pos(),r.id) for r in recipients[i:i+IMPORT_BATCH]])
+
+# 把活动 job 接管的收件人按 id 划给它。导入时先写库、再加入未分配队列，不能按 job IS NULL 划分：
+# 已写库还没入队的那一批会在库中划给新活动，内存里却留在未分配队列
+def db_assign_job(job, recipients):
+    db_execute("UPDATE recipients SET job=? WHERE id IN (SELECT value FROM json_each(?)) AND status='pending'",
+               (job, json.dumps([r.id for r in recipients])))
+
+# 导入的收件人带的其他列名，CSV 导入时并入 control 表，/send 校验模板变量时只读这一行，不扫描收件人表。
+# 只增不减：失败重试、活动取消等放回未分配的收件人可能来自更早的导入；清空待发送收件人时重置
+def db_import_columns():
+    return set(json.loads(db_get_control("import_columns","[]")))
+
+def db_add_import_columns(columns):
+    def add(db):
+        row = db.execute("SELECT value FROM control WHERE key='import_columns'").fetchone()
+        known = set(json.loads(row[0])) if row else set()
+        if columns <= known: return
+        db.execute("INSERT INTO control(key,value) VALUES ('import_columns',?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                   (json.dumps(sorted(known|columns),ensure_ascii=False),))
+    db_transaction(add)
+
+# 升级前导入的收件人没有记录列名，启动时扫描一次待发送收件人补上
+def migrate_import_columns():
+    if db_get_control("import_columns") is not None: return
+    columns = {r[0] for r in db_execute("""SELECT DISTINCT j.key FROM recipients r, json_each(r.extra) j
+                                           WHERE r.status='pending' AND r.extra IS NOT NULL""")}
+    db_set_control("import_columns",json.dumps(sorted(columns),ensure_ascii=False))
+
+def db_release_job(job):
+    db_execute("UPDATE recipients SET job=NULL WHERE status='pending' AND job=?", (job,))
+
+def db_mark_dead(recipient, attempts, error):
+    db_execute("UPDATE recipients SET status='dead', pos=?, attempts=?, last_error=?, lease_until=NULL, lease_owner=NULL, retry_at=NULL WHERE id=?",
+               (next_pos(), attempts, error, recipient["id"]))
+
+# rows 为 (收件人, 错误) 列表
+def db_mark_dead_many(rows):
+    db_executemany("UPDATE recipients SET status='dead', pos=?, last_error=?, lease_until=NULL, lease_owner=NULL WHERE id=?",
+                   [(next_pos(), error, r.id) for r,error in rows])
+
+# 旧版本写入的送达记录是原样邮箱，读出时统一归一
+def db_campaign_deliveries(campaign):
+    return {normalize_email(r[0]) for r in db_execute("SELECT email FROM deliveries WHERE campaign=?", (campaign,))}
+
+# 启动时处理上次退出时仍在途的收件人：幂等表中已有送达记录的记为已发送；
+# 其余无法确定 SMTP 事务是否完成，按 INFLIGHT_RECOVERY 放回队首（至少投递一次）或移入失败列表。
+# 多进程时其他发送进程可能仍在运行，只处理租约在 expired_before 之前到期的（持有进程已退出）
+def recover_inflight(expired_before=None):
+    cond,params = ("",()) if expired_before is None else (" AND lease_until<?",(expired_before,))
+    rows = db_execute(f"SELECT id,email,campaign FROM recipients WHERE status='inflight'{cond} ORDER BY pos DESC", params)
+    # 送达记录的邮箱已归一，按活动取出后在 Python 里比对（SQLite 的 lower() 只处理 ASCII）
+    deliveries = {campaign:db_campaign_deliveries(campaign) for campaign in {r[2] for r in rows if r[2]}}
+    rows = [(rid,campaign in deliveries and normalize_email(email) in deliveries[campaign]) for rid,email,campaign in rows]
+    delivered = [(next_pos(), rid, *params) for rid,done in rows if done]
+    unknown = [rid for rid,done in rows if not done]
+    db_executemany(f"UPDATE recipients SET status='sent', pos=?, lease_until=NULL, lease_owner=NULL WHERE id=? AND status='inflight'{cond}", delivered)
+    if INFLIGHT_RECOVERY == "hold":
+        db_executemany(f"UPDATE recipients SET status='dead', pos=?, last_error=?, lease_until=NULL, lease_owner=NULL WHERE id=? AND status='inflight'{cond}",
+                       [(next_pos(), "上次运行中断时正在发送，结果未知", rid, *params) for rid in reversed(unknown)])
+    else:
+        # 倒序逐个插到队首，保持原有先后顺序
+        db_executemany(f"UPDATE recipients SET status='pending', pos=?, lease_until=NULL, lease_owner=NULL WHERE id=? AND status='inflight'{cond}",
+                       [(next_pos(True), rid, *params) for rid in unknown])
+    # 单进程时活动只存在于进程内，上次运行的活动随进程结束，其未发送的收件人回到未分配状态
+    # 多进程时放回的收件人所属活动如已结束，同样回到未分配状态
+    if not SHARED:
+        db_execute("UPDATE recipients SET job=NULL WHERE status='pending' AND job IS NOT NULL")
+    elif unknown and INFLIGHT_RECOVERY != "hold":
+        db_execute("""UPDATE recipients SET job=NULL WHERE id IN (SELECT value FROM json_each(?))
+                       AND job NOT IN (SELECT id FROM campaigns WHERE status='running')""", (json.dumps(unknown),))
+    return len(delivered),len(unknown)
+
+# 失败列表整体放回待发送队尾（未分配），重试次数清零
+def db_revive_dead():
+    recipients = db_load_recipients("dead")
+    db_executemany("UPDATE recipients SET status='pending', job=NULL, pos=?, attempts=0, last_error=NULL, retry_at=NULL WHERE id=?",
+                   [(next_pos(), r["id"]) for r in recipients])
+    return recipients
+
+def db_delete_pending(email=None):
+    if email is None:
+        db_execute_atomic([("DELETE FROM recipients WHERE status='pending'",()),
+                           ("DELETE FROM control WHERE key='import_columns'",())])
+    else:
+        db_execute("DELETE FROM recipients WHERE status='pending' AND email=?", (email,))
+
+def recipient_from_row(row):
+    return Recipient(row[1],row[2],row[3],json.loads(row[4]) if row[4] else None,row[0])
+
+# 只取邮箱列，用于建立已发送 / 失败列表的去重索引，不把整条记录读进内存
+def db_load_emails(status):
+    return [r[0] for r in db_execute("SELECT email FROM recipients WHERE status=?", (status,))]
+
+def db_load_suppressions():
+    return {r[0] for r in db_execute("SELECT email FROM suppressions")}
+
+def db_add_suppressions(emails, reason=None):
+    now = time.time()
+    db_executemany("INSERT OR IGNORE INTO suppressions(email,reason,epoch) VALUES (?,?,?)",
+                   [(email, reason, now) for email in emails])
+
+def db_delete_suppression(email):
+    db_execute("DELETE FROM suppressions WHERE email=?", (email,))
+
+def db_delete_recipients(recipients):
+    db_executemany("DELETE FROM recipients WHERE id=? AND status='pending'", [(r.id,) for r in recipients])
+
+# ---- 多进程：发送进程认领活动的收件人 ----
+# 认领一批未被其他进程持有（或租约已过期）、且不在重试退避中的收件人，按队列顺序返回；
+# 同时返回其中失败过的收件人 id -> 已失败次数（可能是在其他进程失败的）
+def db_claim_recipients(job, n):
+    now = time.time()
+    rows = db_execute("""UPDATE recipients SET lease_owner=?, lease_until=? WHERE id IN (
+                             SELECT id FROM recipients WHERE job=? AND status='pending' AND (lease_until IS NULL OR lease_until<?)
+                             AND (retry_at IS NULL OR retry_at<=?)
+                             ORDER BY pos LIMIT ?)
+                         RETURNING id,email,name,real_name,extra,pos,attempts""", (SENDER_ID, now+LEASE_SECONDS, job, now, now, n))
+    rows.sort(key=lambda r: r[5])
+    return [recipient_from_row(r) for r in rows],{r[0]:r[6] for r in rows if r[6]}
+
+def db_renew_leases():
+    db_execute("UPDATE recipients SET lease_until=? WHERE lease_owner=? AND status IN ('pending','inflight')",
+               (time.time()+LEASE_SECONDS, SENDER_ID))
+
+# 放弃认领（recipients 为 None 时放弃本进程认领的全部待发送收件人），其他进程可立即认领
+def db_release_claims(recipients=None):
+    if recipients is None:
+        db_execute("UPDATE recipients SET lease_owner=NULL, lease_until=NULL WHERE lease_owner=? AND status='pending'", (SENDER_ID,))
+    else:
+        db_executemany("UPDATE recipients SET lease_owner=NULL, lease_until=NULL WHERE id=? AND lease_owner=? AND status='pending'",
+                       [(r.id, SENDER_ID) for r in recipients])
+
+def db_get_control(key, default=None):
+    rows = db_execute("SELECT value FROM control WHERE key=?", (key,))
+    return rows[0][0] if rows else default
+
+def db_set_control(key, value):
+    db_execute("INSERT INTO control(key,value) VALUES (?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key,value))
+
+def db_load_recipients(status):
+    rows = db_execute("SELECT id,email,name,real_name,extra FROM recipients WHERE status=? ORDER BY pos", (status,))
+    return [recipient_from_row(r) for r in rows]
+
+# 分页查询：按 status 走 (status,pos) 索引；q 为邮箱前缀（走 (status,email_key) 索引）或子串，
+# 都按归一邮箱匹配，不区分大小写；传 cursor（上一页最后一条的 pos）时用键集分页，不受页码深度影响
+def db_page_recipients(status, offset=0, limit=50, q="", match="prefix", cursor=None):
+    where = "status=?"
+    params = [status]
+    q = normalize_email(q)
+    if q:
+        if match == "substring":
+            where += " AND email_key LIKE ? ESCAPE '\\'"
+            params.append("%"+q.replace("\\","\\\\").replace("%","\\%").replace("_","\\_")+"%")
+        else:
+            where += " AND email_key>=? AND email_key<?"
+            params += [q, q+"\U0010ffff"]
+    total = None
+    if q:
+        total = db_execute(f"SELECT COUNT(*) FROM recipients WHERE {where}", params)[0][0]
+    if cursor is not None:
+        where += " AND pos>?"
+        params.append(cursor)
+        offset = 0
+    rows = db_execute(f"SELECT id,email,name,real_name,extra,pos,attempts,last_error FROM recipients WHERE {where} ORDER BY pos LIMIT ? OFFSET ?",
+                      params+[limit,offset])
+    items = []
+    for r in rows:
+        item = recipient_from_row(r).to_dict()
+        if r[7]: item.update({"attempts":r[6],"error":r[7]})
+        items.append(item)
+    next_cursor = rows[-1][5] if len(rows)==limit else None
+    return items,total,next_cursor
+
+# rows: [(邮箱, 分钟序号, 新增封数)]，累加到已有的分钟桶上
+def db_add_usage(rows):
+    db_executemany("INSERT INTO usage_minutes(email,minute,count) VALUES (?,?,?) ON CONFLICT(email,minute) DO UPDATE SET count=count+excluded.count", rows)
+
+def db_checkpoint(mode="PASSIVE"):
+    with DB_LOCK:
+        DB.execute(f"PRAGMA wal_checkpoint({mode})")
+
+def db_compact():
+    db_execute("DELETE FROM logs WHERE epoch<=?",(time.time()-24*3600,))
+    db_execute("DELETE FROM usage_minutes WHERE minute<?",(usage_cutoff(time.time()),))
+    if SHARED: db_execute("DELETE FROM events WHERE epoch<=?",(time.time()-EVENT_RETENTION,))
+    db_checkpoint("TRUNCATE")
+
+def db_maintenance_loop():
+    last_changes = DB.total_changes
+    last_checkpoint = last_compact = time.time()
+    while True:
+        time.sleep(min(DB_CHECKPOINT_MS/1000,1))
+        try:
+            now = time.time()
+            if now-last_compact >= DB_COMPACT_INTERVAL:
+                db_compact()
+                last_compact = last_checkpoint = now
+                last_changes = DB.total_changes
+                continue
+            changes = DB.total_changes-last_changes
+            if changes and (changes >= DB_CHECKPOINT_EVENTS or (now-last_checkpoint)*1000 >= DB_CHECKPOINT_MS):
+                db_checkpoint()
+                last_checkpoint = now
+                last_changes = DB.total_changes
+        except Exception as e:
+            print("数据库检查点失败:", e)
+
+# 一次性迁移：数据库为空且存在旧 JSON 文件时导入，提交后改名为 .migrated。
+# 检查和导入在同一个写事务中，多个进程同时启动时只有先拿到写锁的进程导入，其余进程随后看到库已非空而跳过
+def migrate_json_files():
+    def read_json(path):
+        with open(path,'r',encoding='utf-8') as f:
+            return json.load(f)
+    def migrate(db):
+        migrated = []
+        if os.path.exists(RECIPIENTS_FILE) and not db.execute("SELECT 1 FROM recipients LIMIT 1").fetchone():
+            data = read_json(RECIPIENTS_FILE)
+            def records(rows):
+                return [Recipient(r['email'],r.get('name',''),r.get('real_name',''),
+                                  {k:v for k,v in r.items() if k not in RECIPIENT_FIELDS}) for r in rows]
+            db_insert_recipients(records(data.get('sent',[])), "sent")
+            db_insert_recipients(records(data.get('pending',[])), "pending")
+            migrated.append(RECIPIENTS_FILE)
+        if os.path.exists(LOG_FILE_JSON) and not db.execute("SELECT 1 FROM logs LIMIT 1").fetchone():
+            rows = []
+            for entry in read_json(LOG_FILE_JSON):
+                try: epoch = datetime.datetime.fromisoformat(entry['ts']).timestamp()
+                except Exception: continue
+                rows.append((epoch, entry['ts'], entry['msg']))
+            db_executemany("INSERT INTO logs(epoch,ts,msg) VALUES (?,?,?)", rows)
+            migrated.append(LOG_FILE_JSON)
+        if os.path.exists(USAGE_FILE_JSON) and not db.execute("SELECT 1 FROM usage_minutes LIMIT 1").fetchone():
+            # 旧文件只有当天累计数，按刚发送计入
+            for email,count in read_json(USAGE_FILE_JSON).items(): add_usage(email,count)
+            flush_usage()
+            migrated.append(USAGE_FILE_JSON)
+        return migrated
+    for path in db_transaction(migrate): os.replace(path, path+".migrated")
+
+# 多进程时由发送进程按租约到期逐步回收，不在启动时一次性处理
+RECOVERED_INFLIGHT = recover_inflight() if not SHARED else (0,0)
+
+Thread(target=db_maintenance_loop, daemon=True).start()
 
 # ================== 账号加载 ==================
 def load_accounts_from_env():
@@ -42,183 +753,1232 @@ def load_accounts_from_env():
     return accounts
 
 ACCOUNTS = load_accounts_from_env()
-current_index = 0
+HELD_ACCOUNTS = set()    # 发送进程当前负责的账号（MAILBOT_ROLE=sender）
+ACCOUNTS_VERSION = None
+
+# 多进程时账号存在数据库中：环境变量里的账号启动时写入（保留已有的启用状态），
+# 上传、启用/禁用、删除直接改库并递增 accounts_version，各进程据此重新加载
+def db_load_accounts():
+    accounts = []
+    for email,app_password,smtp_server,smtp_port,selected in db_execute(
+            "SELECT email,app_password,smtp_server,smtp_port,selected FROM accounts ORDER BY id"):
+        rec = {"email": email, "app_password": app_password, "selected": bool(selected)}
+        if smtp_server: rec["smtp_server"] = smtp_server
+        if smtp_port: rec["smtp_port"] = smtp_port
+        accounts.append(rec)
+    return accounts
+
+def db_save_accounts(accounts, keep_selected=False):
+    selected = "" if keep_selected else ", selected=excluded.selected"
+    db_executemany(f"""INSERT INTO accounts(email,app_password,smtp_server,smtp_port,selected) VALUES (?,?,?,?,?)
+                       ON CONFLICT(email) DO UPDATE SET app_password=excluded.app_password, smtp_server=excluded.smtp_server,
+                       smtp_port=excluded.smtp_port{selected}""",
+                   [(a["email"], a["app_password"], a.get("smtp_server"), a.get("smtp_port"), int(a.get("selected",True))) for a in accounts])
+    db_bump_accounts()
+
+def db_bump_accounts():
+    db_execute("UPDATE control SET value=value+1 WHERE key='accounts_version'")
+
+# 账号有变化时重新加载，返回是否有变化
+def refresh_accounts():
+    global ACCOUNTS, ACCOUNTS_VERSION
+    version = db_get_control("accounts_version")
+    if version == ACCOUNTS_VERSION: return False
+    ACCOUNTS_VERSION,ACCOUNTS = version,db_load_accounts()
+    return True
+
+if SHARED:
+    DB.execute("INSERT OR IGNORE INTO control(key,value) VALUES ('accounts_version',0),('paused',0)")
+    if ACCOUNTS: db_save_accounts(ACCOUNTS, keep_selected=True)
+    refresh_accounts()
+
+# 本进程用来发送的账号：选中的；发送进程还须是它负责的
+def sending_account(acc):
+    return acc.get("selected",True) and (ROLE != "sender" or acc['email'] in HELD_ACCOUNTS)
 
 # ================== 用量持久化 ==================
-account_usage = {}
-last_reset_date = datetime.date.today()
+# 服务商按滚动 24 小时限额：每个账号的发送数按分钟分桶，只保留最近 USAGE_WINDOW 秒，桶过期即释放对应配额。
+# 桶在其所在分钟结束 USAGE_WINDOW 秒后过期，比逐封记时间最多晚一分钟释放（偏保守）
+USAGE_WINDOW = 24*3600
+USAGE_BUCKET = 60
 
-if os.path.exists(USAGE_FILE_JSON):
+# 仍在窗口内的最早分钟序号
+def usage_cutoff(now):
+    return int((now-USAGE_WINDOW)//USAGE_BUCKET)
+
+class RollingUsage:
+    def __init__(self):
+        self.buckets = deque()    # [分钟序号, 封数]，按时间先后
+        self.total = 0
+
+    def add(self, minute, n):
+        # 时钟回拨时计入最后一个桶
+        if self.buckets and self.buckets[-1][0] >= minute: self.buckets[-1][1] += n
+        else: self.buckets.append([minute,n])
+        self.total += n
+
+    def count(self, now):
+        cutoff = usage_cutoff(now)
+        while self.buckets and self.buckets[0][0] < cutoff:
+            self.total -= self.buckets.popleft()[1]
+        return self.total
+
+    # 窗口内发送数降到 limit 以下（还能再发 1 封）的最早时间
+    def free_at(self, limit, now):
+        excess = self.count(now)-limit+1
+        if excess <= 0: return now
+        for minute,n in self.buckets:
+            excess -= n
+            if excess <= 0: return (minute+1)*USAGE_BUCKET+USAGE_WINDOW
+        return now
+
+# 发送计数先在内存中累加，新增部分记在 USAGE_DIRTY，由后台线程每 USAGE_FLUSH_MS 合并写回一次，退出时（含 SIGTERM）全部写回
+USAGE_LOCK = Lock()
+ACCOUNT_USAGE = {}    # 邮箱 -> RollingUsage
+USAGE_DIRTY = {}      # (邮箱, 分钟序号) -> 尚未写回的封数
+
+def usage_count(email, now=None):
+    with USAGE_LOCK:
+        usage = ACCOUNT_USAGE.get(email)
+        return usage.count(now or time.time()) if usage else 0
+
+def usage_free_at(email, limit, now):
+    with USAGE_LOCK:
+        usage = ACCOUNT_USAGE.get(email)
+        return usage.free_at(limit,now) if usage else now
+
+def add_usage(email, n, now=None):
+    minute = int((now or time.time())//USAGE_BUCKET)
+    with USAGE_LOCK:
+        usage = ACCOUNT_USAGE.get(email)
+        if usage is None: usage = ACCOUNT_USAGE[email] = RollingUsage()
+        usage.add(minute,n)
+        USAGE_DIRTY[email,minute] = USAGE_DIRTY.get((email,minute),0)+n
+
+# 从库中读窗口内的分钟桶，替换这些账号（None 为全部）的内存计数
+def load_usage(emails=None):
+    cutoff = usage_cutoff(time.time())
+    if emails is None:
+        rows = db_execute("SELECT email,minute,count FROM usage_minutes WHERE minute>=? ORDER BY minute", (cutoff,))
+    else:
+        rows = db_execute("SELECT email,minute,count FROM usage_minutes WHERE minute>=? AND email IN (SELECT value FROM json_each(?)) ORDER BY minute",
+                          (cutoff,json.dumps(sorted(emails))))
+    loaded = {email:RollingUsage() for email in emails or ()}
+    for email,minute,count in rows:
+        usage = loaded.get(email)
+        if usage is None: usage = loaded[email] = RollingUsage()
+        usage.add(minute,count)
+    with USAGE_LOCK:
+        if emails is None: ACCOUNT_USAGE.clear()
+        ACCOUNT_USAGE.update(loaded)
+
+def flush_usage():
+    global USAGE_DIRTY
+    with USAGE_LOCK:
+        if not USAGE_DIRTY: return
+        dirty,USAGE_DIRTY = USAGE_DIRTY,{}
     try:
-        with open(USAGE_FILE_JSON,'r',encoding='utf-8') as f:
-            account_usage = json.load(f)
-    except:
-        account_usage = {}
+        db_add_usage([(email,minute,n) for (email,minute),n in dirty.items()])
+    except Exception:
+        with USAGE_LOCK:
+            for key,n in dirty.items(): USAGE_DIRTY[key] = USAGE_DIRTY.get(key,0)+n
+        raise
+
+# 旧版 usage 表只有当天累计数、没有时间：升级时按当前分钟计入，24 小时后过期
+def migrate_daily_usage(db):
+    if db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='usage'").fetchone():
+        db.execute("INSERT OR IGNORE INTO usage_minutes(email,minute,count) SELECT email,?,count FROM usage WHERE count>0",
+                   (int(time.time()//USAGE_BUCKET),))
+        db.execute("DROP TABLE usage")
 
-for acc in ACCOUNTS:
-    account_usage.setdefault(acc['email'], 0)
+db_transaction(migrate_daily_usage)
+load_usage()
+
+def usage_flush_loop():
+    while True:
+        time.sleep(USAGE_FLUSH_MS/1000)
+        try:
+            flush_usage()
+        except Exception as e:
+            print("发送计数写回失败:", e)
 
-def save_usage():
-    with open(USAGE_FILE_JSON,'w',encoding='utf-8') as f:
-        json.dump(account_usage,f,ensure_ascii=False,indent=2)
+Thread(target=usage_flush_loop, daemon=True).start()
 
 # ================== 收件人 ==================
-RECIPIENTS = []
-SENT_RECIPIENTS = []
+# 百万级收件人常驻内存，用 __slots__ 记录代替 dict：固定字段各占一个槽，CSV 其他列才放进 extra 字典。
+# 提供 r['email'] / r.get(列名) 的取值方式，模板渲染、CSV 导出与原来的 dict 写法通用
+RECIPIENT_FIELDS = frozenset(RECIPIENT_BASE_KEYS)
+
+class Recipient:
+    __slots__ = ("id","email","name","real_name","extra")
+
+    def __init__(self, email, name="", real_name="", extra=None, id=None):
+        self.id = id
+        self.email = email
+        self.name = name
+        self.real_name = real_name
+        self.extra = extra or None
+
+    def get(self, key, default=None):
+        if key in RECIPIENT_FIELDS: return getattr(self,key)
+        if self.extra is None: return default
+        return self.extra.get(key,default)
+
+    def __getitem__(self, key):
+        if key in RECIPIENT_FIELDS: return getattr(self,key)
+        if self.extra is None or key not in self.extra: raise KeyError(key)
+        return self.extra[key]
+
+    def to_dict(self):
+        data = {"id":self.id,"email":self.email,"name":self.name,"real_name":self.real_name}
+        if self.extra: data.update(self.extra)
+        return data
+
+    def __repr__(self):
+        return f"Recipient({self.to_dict()!r})"
+
+# 待发送队列：deque + 归一邮箱索引。出队/队首插回/队尾插回/按邮箱删除/成员判断均为 O(1)。
+# 索引直接指向收件人记录（同一邮箱有多条时为列表），按邮箱删除只删索引，队列中不在索引里的记录即为墓碑，
+# 出队时跳过，墓碑过多时整体压缩一次
+class PendingQueue:
+    def __init__(self, items=()):
+        self._queue = deque()
+        self._index = {}
+        self._size = 0
+        self._dead = 0
+        for r in items: self.append(r)
+
+    def _add(self, recipient, left=False):
+        if left: self._queue.appendleft(recipient)
+        else: self._queue.append(recipient)
+        self._index_add(recipient)
+
+    def _index_add(self, recipient):
+        key = normalize_email(recipient.email)
+        current = self._index.get(key)
+        if current is None: self._index[key] = recipient
+        elif type(current) is list: current.append(recipient)
+        else: self._index[key] = [current,recipient]
+        self._size += 1
+
+    def _unlink(self, recipient):
+        key = normalize_email(recipient.email)
+        current = self._index.get(key)
+        if current is recipient:
+            del self._index[key]
+            return True
+        if type(current) is list:
+            for i,r in enumerate(current):
+                if r is recipient:
+                    del current[i]
+                    if len(current) == 1: self._index[key] = current[0]
+                    return True
+        return False
+
+    def append(self, recipient): self._add(recipient)
+
+    def appendleft(self, recipient): self._add(recipient, left=True)
+
+    def popleft(self):
+        while self._queue:
+            recipient = self._queue.popleft()
+            if not self._unlink(recipient):
+                self._dead -= 1
+                continue
+            self._size -= 1
+            return recipient
+        return None
+
+    # 返回被删除的收件人记录
+    def remove_email(self, email):
+        current = self._index.pop(normalize_email(email),None)
+        if current is None: return []
+        removed = current if type(current) is list else [current]
+        self._size -= len(removed)
+        self._dead += len(removed)
+        if self._dead > 1024 and self._dead > self._size: self._compact()
+        return removed
+
+    def _compact(self):
+        self._queue = deque(self)
+        self._dead = 0
+
+    def clear(self):
+        self._queue.clear()
+        self._index.clear()
+        self._size = 0
+        self._dead = 0
+
+    def _live(self, recipient):
+        current = self._index.get(normalize_email(recipient.email))
+        if current is recipient: return True
+        return type(current) is list and any(r is recipient for r in current)
+
+    def __contains__(self, email): return normalize_email(email) in self._index
+
+    def __len__(self): return self._size
+
+    def __iter__(self):
+        if not self._dead:
+            yield from self._queue
+            return
+        for recipient in self._queue:
+            if self._live(recipient): yield recipient
+
+# 临时失败、等待退避到期的收件人：按到期时间排成堆，按邮箱删除与成员判断沿用 PendingQueue 的索引
+class RetryQueue(PendingQueue):
+    def __init__(self):
+        super().__init__()
+        self._queue = []    # (到期时间, 序号, 收件人)
+        self._seq = 0
+
+    def push(self, recipient, due):
+        self._seq += 1
+        heapq.heappush(self._queue,(due,self._seq,recipient))
+        self._index_add(recipient)
+
+    # 取出所有已到期的收件人
+    def pop_due(self, now):
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            recipient = heapq.heappop(self._queue)[2]
+            if not self._unlink(recipient):
+                self._dead -= 1
+                continue
+            self._size -= 1
+            due.append(recipient)
+        return due
+
+    # 最早的到期时间，没有时返回 None
+    def next_due(self):
+        while self._queue and not self._live(self._queue[0][2]):
+            heapq.heappop(self._queue)
+            self._dead -= 1
+        return self._queue[0][0] if self._queue else None
+
+    def _compact(self):
+        self._queue = [entry for entry in self._queue if self._live(entry[2])]
+        heapq.heapify(self._queue)
+        self._dead = 0
+
+    def __iter__(self):
+        for _,_,recipient in sorted(self._queue):
+            if not self._dead or self._live(recipient): yield recipient
+
+RECIPIENTS = PendingQueue()   # 尚未分配给活动的待发送收件人；已分配的在各活动自己的队列中
+# 已发送 / 失败 / 屏蔽的收件人只保留归一邮箱索引用于导入去重，完整记录按需从数据库读取
+SENT_COUNT = 0
+SENT_EMAILS = set()
+DEAD_EMAILS = set()         # 失败列表中的邮箱，导入时跳过
+SUPPRESSED = set()          # 屏蔽名单，导入时跳过
+RECIPIENT_ATTEMPTS = {}     # 收件人 id -> 已失败次数（仅记录大于 0 的）
 
 # ================== 发送控制 ==================
-SEND_QUEUE = []
+JOBS = {}           # 活动 id -> CampaignJob，按创建顺序
+NEXT_JOB_ID = db_execute("SELECT COALESCE(MAX(job),0)+1 FROM recipients")[0][0]
 IS_SENDING = False
 PAUSED = False
 SEND_LOCK = Lock()
-EVENT_SUBSCRIBERS = []
+ACTIVE_WORKERS = 0
+
+# 账号占用：每个账号同时在途的 SMTP 事务数有上限，节奏由下方的令牌桶调度器控制
+ACCOUNT_LOCK = Lock()
+ACCOUNTS_INFLIGHT = {}     # 在途 SMTP 事务数
+ACCOUNTS_RESERVED = {}     # 在途事务占用的配额（合并发送时一次事务可占多封）
+SCHEDULER = Condition(ACCOUNT_LOCK)   # 账号释放、启用、删除时唤醒等待中的发送线程
 
 # ================== 日志 ==================
-SEND_LOGS = []
+# 24 小时日志窗口：按时间顺序追加，只从左侧淘汰过期条目；
+# RECENT_USAGE 为窗口内各账号发送成功次数，随追加/淘汰增量维护
+LOG_WINDOW = 24*3600
+SEND_LOGS = deque()     # (epoch, {"ts","msg"}, account)
+RECENT_USAGE = {}
+LOG_LOCK = Lock()
 
-def load_logs():
+def load_logs(rows=None):
     global SEND_LOGS
-    if os.path.exists(LOG_FILE_JSON):
-        try:
-            with open(LOG_FILE_JSON,'r',encoding='utf-8') as f:
-                SEND_LOGS = json.load(f)
-        except:
-            SEND_LOGS = []
-    else:
-        SEND_LOGS = []
+    SEND_LOGS = deque()
+    RECENT_USAGE.clear()
+    if rows is None:
+        rows = db_execute("SELECT epoch,ts,msg,event,account FROM logs WHERE epoch>? ORDER BY id",(time.time()-LOG_WINDOW,))
+    for epoch,ts,msg,event,account in rows:
+        # 迁移来的旧日志没有结构化字段，从文本里解析一次
+        if event is None and msg.startswith('已发送给') and '使用账号' in msg:
+            event,account = "sent",msg.split('使用账号')[1].strip(' )')
+        if event != "sent": account = None
+        SEND_LOGS.append((epoch,{"ts":ts,"msg":msg},account))
+        if account: RECENT_USAGE[account] = RECENT_USAGE.get(account,0)+1
+
+def save_log(entry,epoch,event=None,account=None):
+    db_execute("INSERT INTO logs(epoch,ts,msg,event,account) VALUES (?,?,?,?,?)",(epoch,entry['ts'],entry['msg'],event,account))
 
-def save_logs():
-    with open(LOG_FILE_JSON,'w',encoding='utf-8') as f:
-        json.dump(SEND_LOGS,f,ensure_ascii=False,indent=2)
-        
+# 先写回计数、释放认领：关闭会话时每个 QUIT 最多可能阻塞 SMTP_TIMEOUT 秒，可能超过平台 SIGTERM 后的宽限期
 def cleanup():
-    save_recipients()
-    save_logs()
-    save_usage()
+    flush_usage()
+    if ROLE == "sender": leave_shared()
+    close_smtp_pool()
+    db_checkpoint("TRUNCATE")
 
 atexit.register(cleanup)
 
-# ================== 辅助 ==================
-def reset_daily_usage_if_needed():
-    global account_usage,last_reset_date
-    today = datetime.date.today()
-    if today != last_reset_date:
-        for k in account_usage.keys():
-            account_usage[k] = 0
-        last_reset_date = today
-        save_usage()
-        append_log("已进入新的一天，账号发送计数已重置。")
+# Render 等平台停止服务时先发 SIGTERM，默认处理会直接结束进程而不执行 atexit；转成正常退出
+def handle_sigterm(signum, frame):
+    sys.exit(0)
 
+# ================== 辅助 ==================
 def infer_smtp(email):
     domain = email.split('@')[-1].lower().strip()
     if domain in {"outlook.com","hotmail.com","live.com","msn.com","outlook.cn"}: return ("smtp.office365.com",587)
     if domain=="gmail.com": return ("smtp.gmail.com",587)
     return ("smtp."+domain,587)
 
-def get_next_account():
-    global current_index
-    selected_accounts = [acc for acc in ACCOUNTS if acc.get("selected",True)]
-    if not selected_accounts: return None
-    for _ in range(len(selected_accounts)):
-        acc = selected_accounts[current_index % len(selected_accounts)]
-        current_index = (current_index+1) % len(selected_accounts)
-        count = account_usage.get(acc['email'],0)
-        if count < DAILY_LIMIT: return acc
-    return None
+# ================== 发送调度（令牌桶） ==================
+# 每个账号一个间隔桶（两次事务至少相隔 interval 秒）和一个每分钟封数桶，每个 SMTP 主机、全局各一个封数桶；
+# 再加上滚动 24 小时内的 DAILY_LIMIT 配额。账号可发的最早时间取各项限制中最晚的那个，发送线程只等到最早可发的账号就绪
+class TokenBucket:
+    def __init__(self, rate=0.0, capacity=1):
+        self.rate = rate              # 每秒补充的令牌数，0 表示不限速
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
 
-def send_email(account,to_email,subject,body):
+    def configure(self, rate, capacity=1):
+        if rate == self.rate and capacity == self.capacity: return
+        self._refill(time.time())
+        self.rate,self.capacity = rate,capacity
+        self.tokens = min(self.tokens,capacity)
+
+    def _refill(self, now):
+        if self.rate and now > self.updated:
+            self.tokens = min(self.capacity,self.tokens+(now-self.updated)*self.rate)
+        self.updated = max(self.updated,now)
+
+    def available(self, now):
+        if not self.rate: return float("inf")
+        self._refill(now)
+        return self.tokens
+
+    def ready_at(self, now, n=1):
+        if not self.rate: return now
+        self._refill(now)
+        if self.tokens >= n: return now
+        return now+(n-self.tokens)/self.rate
+
+    def take(self, now, n=1):
+        if not self.rate: return
+        self._refill(now)
+        self.tokens -= n
+
+    # 归还取了但没用上的令牌，不超过容量
+    def give(self, now, n=1):
+        if not self.rate: return
+        self._refill(now)
+        self.tokens = min(self.capacity,self.tokens+n)
+
+    def snapshot(self, now):
+        if not self.rate: return None
+        return {"rate_per_min":round(self.rate*60,3),"capacity":self.capacity,
+                "tokens":round(self.available(now),3),"ready_in":round(self.ready_at(now)-now,3)}
+
+# 账号熔断：认证失败立即熔断，网络/临时错误连续 BREAKER_THRESHOLD 次后熔断；
+# 熔断期间账号不参与调度，到期后半开放行一个事务试探，成功则恢复，失败则退避时间翻倍
+BREAKER_THRESHOLD = 3
+BREAKER_BASE = 30         # 首次熔断秒数
+BREAKER_MAX = 3600        # 退避上限
+BREAKER_KINDS = ("auth","network","transient","unknown")
+
+class CircuitBreaker:
+    def __init__(self):
+        self.state = "closed"     # closed | open | half_open
+        self.failures = 0         # 连续失败次数
+        self.trips = 0            # 连续熔断次数，决定退避时长
+        self.open_until = 0
+        self.last_error = ""
+
+    def ready_at(self, now):
+        if self.state == "open":
+            if now < self.open_until: return self.open_until
+            self.state = "half_open"
+        return now
+
+    # 记录一次事务结果（failure 为空表示成功），返回 "open"（刚熔断）、"closed"（试探成功恢复）或 None
+    def record(self, failure, now):
+        if not failure or failure.kind not in BREAKER_KINDS or failure.recipient:
+            # 成功或收件人本身的问题都说明账号可用
+            recovered = self.state != "closed"
+            self.state,self.failures,self.trips = "closed",0,0
+            return "closed" if recovered else None
+        self.last_error = str(failure)
+        if self.state == "open": return None     # 熔断前已发出的事务，不重复计数
+        self.failures += 1
+        if failure.kind == "auth" or self.state == "half_open" or self.failures >= BREAKER_THRESHOLD:
+            self.trips += 1
+            self.state,self.failures = "open",0
+            self.open_until = now+min(BREAKER_BASE*2**(self.trips-1),BREAKER_MAX)
+            return "open"
+        return None
+
+    def snapshot(self, now):
+        open_in = self.ready_at(now)-now
+        return {"state":self.state,"failures":self.failures,"trips":self.trips,
+                "open_in":round(open_in,3),"last_error":self.last_error}
+
+ACCOUNT_BREAKERS = {}   # 账号 -> CircuitBreaker，首次失败时创建
+ACCOUNT_PACE = {}       # 账号 -> 间隔桶（按事务计）
+ACCOUNT_BUCKETS = {}    # 账号 -> 每分钟封数桶
+HOST_BUCKETS = {}       # SMTP 主机 -> 每分钟封数桶
+GLOBAL_BUCKET = TokenBucket(GLOBAL_RATE_PER_MIN/60,RATE_BURST)
+NO_ACCOUNT_NOTICE = None
+
+# 以下函数均需在持有 ACCOUNT_LOCK 时调用
+def pace_bucket(acc,interval=None):
+    bucket = ACCOUNT_PACE.get(acc['email'])
+    if bucket is None: bucket = ACCOUNT_PACE[acc['email']] = TokenBucket()
+    if interval is not None: bucket.configure(1/interval if interval > 0 else 0)
+    return bucket
+
+def rate_buckets(acc):
+    bucket = ACCOUNT_BUCKETS.get(acc['email'])
+    if bucket is None: bucket = ACCOUNT_BUCKETS[acc['email']] = TokenBucket(ACCOUNT_RATE_PER_MIN/60,RATE_BURST)
+    host = smtp_endpoint(acc)[0]
+    host_bucket = HOST_BUCKETS.get(host)
+    if host_bucket is None: host_bucket = HOST_BUCKETS[host] = TokenBucket(HOST_RATE_PER_MIN/60,RATE_BURST)
+    return bucket,host_bucket,GLOBAL_BUCKET
+
+# 返回 (账号最早可发送的时间, 受限原因)；时间为 None 表示要等在途事务结束才能确定
+def account_ready_at(acc,now,max_inflight=1):
+    email = acc['email']
+    reserved = ACCOUNTS_RESERVED.get(email,0)
+    if usage_count(email,now)+reserved >= DAILY_LIMIT:
+        return (None,"reserved") if reserved else (usage_free_at(email,DAILY_LIMIT,now),"daily")
+    breaker = ACCOUNT_BREAKERS.get(email)
+    if breaker is not None:
+        open_until = breaker.ready_at(now)
+        if open_until > now: return open_until,"breaker"
+        if breaker.state == "half_open" and ACCOUNTS_INFLIGHT.get(email,0): return None,"inflight"
+    if ACCOUNTS_INFLIGHT.get(email,0) >= max_inflight: return None,"inflight"
+    ready,reason = now,None
+    account_bucket,host_bucket,global_bucket = rate_buckets(acc)
+    for name,bucket in (("pace",pace_bucket(acc)),("account",account_bucket),("host",host_bucket),("global",global_bucket)):
+        t = bucket.ready_at(now)
+        if t > ready: ready,reason = t,name
+    return ready,reason
+
+# 账号就绪堆：选中账号按 (最早可发时间, -剩余配额) 排成最小堆，取账号为 O(log n)。
+# 24 小时配额已满的账号记入 exhausted，仍按配额释放的时间入堆；在途已满或配额被占满的账号暂不入堆，释放时再放回。
+# 共享的主机/全局桶被别的账号消耗后，堆里的时间可能偏早，出堆时重新计算并按新时间放回（只会推迟，不会提前）
+class AccountRegistry:
+    def __init__(self):
+        self.heap = []          # (可发时间, -剩余配额, 序号, 邮箱)
+        self.queued = {}        # 邮箱 -> 堆中有效条目的序号，其余条目视为作废
+        self.accounts = {}      # 选中账号：邮箱 -> 账号
+        self.exhausted = set()
+        self.seq = itertools.count()
+        self.max_inflight = None   # 首次 configure 时建堆
+
+    def rebuild(self, now=None):
+        if self.max_inflight is None: return
+        now = now or time.time()
+        self.heap,self.queued,self.exhausted = [],{},set()
+        self.accounts = {acc['email']:acc for acc in ACCOUNTS if sending_account(acc)}
+        for acc in self.accounts.values():
+            self.push(acc,now,heapify=False)
+        heapq.heapify(self.heap)
+
+    def configure(self, max_inflight, now):
+        if max_inflight != self.max_inflight:
+            self.max_inflight = max_inflight
+            self.rebuild(now)
+
+    def push(self, acc, now, heapify=True):
+        email = acc['email']
+        acc = self.accounts.get(email)
+        if acc is None: return
+        self.queued.pop(email,None)
+        ready,reason = account_ready_at(acc,now,self.max_inflight)
+        if reason == "daily": self.exhausted.add(email)
+        else: self.exhausted.discard(email)
+        if ready is None: return
+        entry = (ready,-(DAILY_LIMIT-usage_count(email,now)-ACCOUNTS_RESERVED.get(email,0)),next(self.seq),email)
+        self.queued[email] = entry[2]
+        if heapify: heapq.heappush(self.heap,entry)
+        else: self.heap.append(entry)
+
+    # 清理堆顶的作废条目并校正其时间，返回堆顶账号的准确可发时间；堆空时返回 None
+    def peek(self, now):
+        while self.heap:
+            ready,_,seq,email = self.heap[0]
+            acc = self.accounts.get(email)
+            if acc is None or self.queued.get(email) != seq:
+                heapq.heappop(self.heap)
+                continue
+            actual,reason = account_ready_at(acc,now,self.max_inflight)
+            if actual is None:
+                heapq.heappop(self.heap)
+                del self.queued[email]
+                continue
+            if reason == "daily": self.exhausted.add(email)
+            else: self.exhausted.discard(email)
+            if actual > ready and actual > now:
+                remaining = DAILY_LIMIT-usage_count(email,now)-ACCOUNTS_RESERVED.get(email,0)
+                heapq.heapreplace(self.heap,(actual,-remaining,seq,email))
+                continue
+            return ready
+        return None
+
+    # usable 为可选的邮箱过滤函数（活动限定了账号时使用），不满足的条目暂时取出、最后放回
+    def pop_ready(self, now, usable=None):
+        skipped,acc = [],None
+        while True:
+            ready = self.peek(now)
+            if ready is None or ready > now: break
+            entry = heapq.heappop(self.heap)
+            if usable is None or usable(entry[3]):
+                del self.queued[entry[3]]
+                acc = self.accounts[entry[3]]
+                break
+            skipped.append(entry)
+        for entry in skipped: heapq.heappush(self.heap,entry)
+        return acc
+
+    def next_ready(self, now, usable=None):
+        skipped = []
+        while True:
+            ready = self.peek(now)
+            if ready is None or usable is None or usable(self.heap[0][3]): break
+            skipped.append(heapq.heappop(self.heap))
+        for entry in skipped: heapq.heappush(self.heap,entry)
+        return ready
+
+    # 没有账号可发时的原因："none" 没有选中账号，"daily" 全部达到 24 小时上限，其余为 None
+    def idle_reason(self):
+        if not self.accounts: return "none"
+        if len(self.exhausted) == len(self.accounts): return "daily"
+        return None
+
+ACCOUNT_REGISTRY = AccountRegistry()
+
+def get_next_account(max_inflight=1,usable=None):
+    now = time.time()
+    with ACCOUNT_LOCK:
+        ACCOUNT_REGISTRY.configure(max_inflight,now)
+        acc = ACCOUNT_REGISTRY.pop_ready(now,usable)
+        if acc is None: return None
+        inflight = ACCOUNTS_INFLIGHT[acc['email']] = ACCOUNTS_INFLIGHT.get(acc['email'],0)+1
+        ACCOUNTS_RESERVED[acc['email']] = ACCOUNTS_RESERVED.get(acc['email'],0)+1
+        pace_bucket(acc).take(now)
+        for bucket in rate_buckets(acc): bucket.take(now)
+        if inflight < max_inflight: ACCOUNT_REGISTRY.push(acc,now)
+        return acc
+
+# 账号的发送间隔取自它刚刚服务的活动：取账号时已按原速度扣过间隔桶的令牌，这里改为该活动的 interval；
+# 原来不限速时那次扣减没有生效，补扣一次
+def set_account_pace(acc,interval):
+    now = time.time()
+    with ACCOUNT_LOCK:
+        bucket = pace_bucket(acc)
+        rate = bucket.rate
+        pace_bucket(acc,interval)
+        if bucket.rate == rate: return
+        if not rate: bucket.take(now)
+        if acc['email'] in ACCOUNT_REGISTRY.queued: ACCOUNT_REGISTRY.push(acc,now)
+
+# 在已占用的 1 封之外再为合并发送多占 n 封配额（同时受各速率桶剩余令牌限制），返回实际占到的数量
+def reserve_quota(acc,n):
+    now = time.time()
+    with ACCOUNT_LOCK:
+        reserved = ACCOUNTS_RESERVED.get(acc['email'],0)
+        buckets = rate_buckets(acc)
+        n = max(0,int(min(n,DAILY_LIMIT-usage_count(acc['email'],now)-reserved,*(b.available(now) for b in buckets))))
+        ACCOUNTS_RESERVED[acc['email']] = reserved+n
+        for bucket in buckets: bucket.take(now,n)
+        return n
+
+# 归还占用了但没有发出的 n 封的速率令牌；pace 为真时整个事务没有发生，取账号时扣的间隔令牌也归还。需持有 ACCOUNT_LOCK
+def refund_tokens(acc,n,now,pace=False):
+    for bucket in rate_buckets(acc): bucket.give(now,n)
+    if pace: pace_bucket(acc).give(now)
+
+# 合并发送取到的收件人少于占用的配额时（队列快空），立即归还多占的 n 封配额和令牌
+def refund_quota(acc,n):
+    now = time.time()
+    with ACCOUNT_LOCK:
+        left = ACCOUNTS_RESERVED.get(acc['email'],0)-n
+        if left > 0: ACCOUNTS_RESERVED[acc['email']] = left
+        else: ACCOUNTS_RESERVED.pop(acc['email'],None)
+        refund_tokens(acc,n,now)
+        if acc['email'] in ACCOUNT_REGISTRY.queued: ACCOUNT_REGISTRY.push(acc,now)
+        SCHEDULER.notify_all()
+
+# outcome 为本次 SMTP 事务的结果（'' 成功 / SendFailure 失败），None 表示没有发生事务；
+# unused 为占用了配额但没有发出的封数（没取到收件人、认领时被删除或已送达），归还其令牌
+def release_account(acc,reserved=1,outcome=None,unused=0):
+    now = time.time()
+    change = None
+    with ACCOUNT_LOCK:
+        if unused: refund_tokens(acc,unused,now,pace=unused == reserved)
+        if outcome is not None:
+            breaker = ACCOUNT_BREAKERS.get(acc['email'])
+            if breaker is None and outcome:
+                breaker = ACCOUNT_BREAKERS[acc['email']] = CircuitBreaker()
+            if breaker is not None:
+                change = breaker.record(outcome,now)
+                open_for = breaker.open_until-now
+        inflight = ACCOUNTS_INFLIGHT.get(acc['email'],0)-1
+        if inflight > 0: ACCOUNTS_INFLIGHT[acc['email']] = inflight
+        else: ACCOUNTS_INFLIGHT.pop(acc['email'],None)
+        left = ACCOUNTS_RESERVED.get(acc['email'],0)-reserved
+        if left > 0: ACCOUNTS_RESERVED[acc['email']] = left
+        else: ACCOUNTS_RESERVED.pop(acc['email'],None)
+        ACCOUNT_REGISTRY.push(acc,now)
+        SCHEDULER.notify_all()
+    if change == "open":
+        with SEND_LOCK: FAILURE_COUNTS["breaker_trips"] += 1
+        append_log(f"账号 {acc['email']} 暂停发送 {open_for:.0f} 秒（{outcome.kind}）：{outcome}", event="breaker", account=acc['email'])
+    elif change == "closed":
+        append_log(f"账号 {acc['email']} 已恢复发送", event="breaker", account=acc['email'])
+
+# 账号启用/禁用、导入、删除或换了负责的发送进程后重建就绪堆，并唤醒等待中的发送线程
+def accounts_changed():
+    with SCHEDULER:
+        ACCOUNT_REGISTRY.rebuild()
+        SCHEDULER.notify_all()
+
+# 没有账号可发时等到调度器算出的最早可发时间（最多 SCHEDULER_MAX_WAIT 秒），返回等待秒数；
+# block=False 时只计算不等待，供 asyncio 后端自行 await
+def wait_for_account(max_inflight=1,usable=None,block=True):
+    global NO_ACCOUNT_NOTICE
+    with SCHEDULER:
+        now = time.time()
+        ACCOUNT_REGISTRY.configure(max_inflight,now)
+        earliest = ACCOUNT_REGISTRY.next_ready(now,usable)
+        reason = ACCOUNT_REGISTRY.idle_reason()
+        wait = SCHEDULER_MAX_WAIT if earliest is None else min(max(earliest-now,0.001),SCHEDULER_MAX_WAIT)
+        # 多个线程同时等待时同一原因只记录一次
+        notice = None
+        if reason == "none": notice = "没有选中的账号，启用账号后继续发送。"
+        elif reason == "daily":
+            notice = "所有账号已达 24 小时发送上限" + \
+                     (f"，最早将于 {datetime.datetime.fromtimestamp(earliest):%Y-%m-%d %H:%M} 恢复发送。" if earliest is not None else "。")
+        log = notice if notice and notice != NO_ACCOUNT_NOTICE else None
+        NO_ACCOUNT_NOTICE = notice
+        if block and log is None:
+            start = time.perf_counter()
+            SCHEDULER.wait(wait)
+            SCHEDULER_WAIT_SECONDS.inc(n=time.perf_counter()-start)
+    # 写日志要落库并推送，不能占着调度锁；这一轮不等待，调用方重新取账号时再等，不会漏掉期间的唤醒
+    if log:
+        append_log(log)
+        return 0
+    return wait
+
+# ================== SMTP 连接池 ==================
+# 每个账号保留已登录的会话，避免每封邮件都重新 TCP + STARTTLS + LOGIN
+SMTP_TIMEOUT = 30
+SMTP_NOOP_AFTER = 10              # 会话空闲超过该秒数，复用前先 NOOP 探活
+SMTP_IDLE_TIMEOUT = 120           # 会话空闲超过该秒数直接丢弃（服务端多半已断开）
+SMTP_MAX_MSGS_PER_SESSION = 100   # 单个会话发送达到该数量后关闭重建
+SMTP_POOLS = {}                   # 账号邮箱 -> 空闲会话列表
+SMTP_POOL_LOCK = Lock()
+
+class SMTPSession:
+    def __init__(self, account, server, endpoint):
+        self.email = account['email']
+        self.app_password = account['app_password']
+        self.endpoint = endpoint
+        self.server = server
+        self.sent = 0
+        self.last_used = time.time()
+
+def smtp_endpoint(account):
+    smtp_server,smtp_port = infer_smtp(account['email'])
+    if 'smtp_server' in account: smtp_server = account['smtp_server']
+    if 'smtp_port' in account: smtp_port = int(account['smtp_port'])
+    return smtp_server,smtp_port
+
+# 记下最近一次 DATA 的耗时，事务总耗时减去它即为 MAIL/RCPT 阶段
+class TimedSMTP(smtplib.SMTP):
+    data_seconds = 0.0
+    data_started = False
+
+    def data(self, msg):
+        self.data_started = True
+        start = time.perf_counter()
+        try:
+            return super().data(msg)
+        finally:
+            self.data_seconds = time.perf_counter()-start
+
+def open_smtp_session(account):
+    endpoint = smtp_endpoint(account)
+    email,host = account['email'],endpoint[0]
+    t0 = time.perf_counter()
+    server = TimedSMTP(endpoint[0],endpoint[1],timeout=SMTP_TIMEOUT)
+    t1 = time.perf_counter()
     try:
-        smtp_server,smtp_port = infer_smtp(account['email'])
-        if 'smtp_server' in account: smtp_server = account['smtp_server']
-        if 'smtp_port' in account: smtp_port = int(account['smtp_port'])
-        msg = MIMEText(body,'plain','utf-8')
-        msg['From'] = account['email']
-        msg['To'] = to_email
-        msg['Subject'] = Header(subject,'utf-8')
-        server = smtplib.SMTP(smtp_server,smtp_port)
         server.starttls()
+        t2 = time.perf_counter()
         server.login(account['email'],account['app_password'])
-        server.sendmail(account['email'],[to_email],msg.as_string())
-        server.quit()
-        account_usage[account['email']] = account_usage.get(account['email'],0)+1
-        save_usage()
-        return True,''
+        t3 = time.perf_counter()
+    except:
+        server.close()
+        raise
+    observe_phase("connect",email,host,t1-t0)
+    observe_phase("starttls",email,host,t2-t1)
+    observe_phase("login",email,host,t3-t2)
+    return SMTPSession(account,server,endpoint)
+
+def close_smtp_session(sess):
+    try: sess.server.quit()
+    except:
+        try: sess.server.close()
+        except: pass
+
+# 取出一个可用的已登录会话，没有则新建
+def acquire_smtp(account):
+    while True:
+        with SMTP_POOL_LOCK:
+            idle = SMTP_POOLS.get(account['email'])
+            sess = idle.pop() if idle else None
+        if sess is None:
+            return open_smtp_session(account)
+        # 账号密码或服务器被修改过，旧会话作废
+        if sess.app_password != account['app_password'] or sess.endpoint != smtp_endpoint(account):
+            close_smtp_session(sess)
+            continue
+        idle_for = time.time()-sess.last_used
+        if idle_for > SMTP_IDLE_TIMEOUT:
+            close_smtp_session(sess)
+            continue
+        if idle_for > SMTP_NOOP_AFTER:
+            start = time.perf_counter()
+            try: code = sess.server.noop()[0]
+            except: code = None
+            observe_phase("noop",sess.email,sess.endpoint[0],time.perf_counter()-start)
+            if code != 250:
+                close_smtp_session(sess)
+                continue
+        return sess
+
+def release_smtp(sess):
+    sess.last_used = time.time()
+    if sess.sent >= SMTP_MAX_MSGS_PER_SESSION:
+        close_smtp_session(sess)
+        return
+    with SMTP_POOL_LOCK:
+        SMTP_POOLS.setdefault(sess.email,[]).append(sess)
+
+def close_smtp_pool(email=None):
+    with SMTP_POOL_LOCK:
+        if email is None:
+            sessions = [s for idle in SMTP_POOLS.values() for s in idle]
+            SMTP_POOLS.clear()
+        else:
+            sessions = SMTP_POOLS.pop(email,[])
+    for sess in sessions:
+        close_smtp_session(sess)
+
+# 成功事务的耗时拆成 envelope（MAIL/RCPT）和 data 两段
+def observe_transaction(sess, seconds):
+    data = sess.server.data_seconds
+    observe_phase("envelope",sess.email,sess.endpoint[0],seconds-data)
+    observe_phase("data",sess.email,sess.endpoint[0],data)
+
+def is_smtp_disconnect(e):
+    if isinstance(e,(smtplib.SMTPServerDisconnected,ConnectionError)): return True
+    return isinstance(e,smtplib.SMTPResponseException) and e.smtp_code==421
+
+# DATA 发出后连接断开或超时、没有收到服务器答复：邮件可能已被接收，不能重连重发，
+# 与启动时找回的在途收件人一样按结果未知处理（INFLIGHT_RECOVERY）
+def data_unanswered(server,e):
+    replied = (smtplib.SMTPResponseException,)+((aiosmtplib.SMTPResponseException,) if aiosmtplib else ())
+    return server.data_started and not isinstance(e,replied)
+
+def unknown_failure(e):
+    return SendFailure(f"DATA 之后连接中断，发送结果未知：{smtp_error_message(e)}","unknown")
+
+# ================== 失败分类 ==================
+# auth：认证失败或发件人被永久拒绝，账号本身不可用；network：连接断开、超时、421；
+# transient：其余 4xx，稍后重试；permanent：5xx 拒收，换账号重试也无用；
+# unknown：DATA 之后连接中断，可能已送达；other：无法归类的异常
+FAILURE_KINDS = ("auth","transient","permanent","network","unknown","other")
+FAILURE_COUNTS = dict.fromkeys(FAILURE_KINDS+("retried","dead","breaker_trips"),0)   # 由 SEND_LOCK 保护
+ACCOUNT_FAILURES = {}   # 账号 -> {类别: 次数}
+
+class SendFailure(str):
+    """带分类的错误信息，仍可当作字符串写日志、判断真假；recipient 表示只是 RCPT 被拒，与账号无关"""
+    def __new__(cls, message, kind="other", code=None, recipient=False):
+        self = super().__new__(cls, message)
+        self.kind,self.code,self.recipient = kind,code,recipient
+        return self
+
+def failure_from_code(code, message, recipient=False):
+    if code == 421: kind = "network"
+    elif 400 <= code < 500: kind = "transient"
+    elif 500 <= code < 600: kind = "permanent"
+    else: kind = "other"
+    return SendFailure(message,kind,code,recipient)
+
+def smtp_error_code(e):
+    if isinstance(e,smtplib.SMTPResponseException): return e.smtp_code
+    if isinstance(e,smtplib.SMTPRecipientsRefused) and e.recipients:
+        return next(iter(e.recipients.values()))[0]
+    if aiosmtplib is not None:
+        if isinstance(e,aiosmtplib.SMTPResponseException): return e.code
+        if isinstance(e,aiosmtplib.SMTPRecipientsRefused) and e.recipients: return e.recipients[0].code
+    return None
+
+# 错误信息写成“450 mailbox busy”：smtplib 的 str(e) 是 (代码, 响应) 元组或 {地址: (代码, 响应)} 字典的 repr
+def smtp_error_message(e):
+    if isinstance(e,smtplib.SMTPRecipientsRefused) and e.recipients:
+        code,resp = next(iter(e.recipients.values()))
+    elif isinstance(e,smtplib.SMTPResponseException):
+        code,resp = e.smtp_code,e.smtp_error
+    elif aiosmtplib is not None and isinstance(e,aiosmtplib.SMTPRecipientsRefused) and e.recipients:
+        code,resp = e.recipients[0].code,e.recipients[0].message
+    elif aiosmtplib is not None and isinstance(e,aiosmtplib.SMTPResponseException):
+        code,resp = e.code,e.message
+    else:
+        return str(e)
+    if isinstance(resp,bytes): resp = resp.decode('utf-8','replace')
+    return f"{code} {resp}"
+
+# smtplib 与 aiosmtplib 的异常统一归类为 SendFailure
+def classify_failure(e):
+    message = smtp_error_message(e)
+    code = smtp_error_code(e)
+    auth_errors = (smtplib.SMTPAuthenticationError,)+((aiosmtplib.SMTPAuthenticationError,) if aiosmtplib else ())
+    sender_errors = (smtplib.SMTPSenderRefused,)+((aiosmtplib.SMTPSenderRefused,) if aiosmtplib else ())
+    if isinstance(e,auth_errors) or (isinstance(e,sender_errors) and code and code >= 500):
+        return SendFailure(message,"auth",code)
+    if isinstance(e,UnicodeError):
+        # 地址含非 ASCII 字符：未请求 SMTPUTF8 时命令按 ASCII 编码，每次都会同样失败
+        return SendFailure(message,"permanent",code)
+    if code is not None:
+        refused = (smtplib.SMTPRecipientsRefused,)+((aiosmtplib.SMTPRecipientsRefused,) if aiosmtplib else ())
+        return failure_from_code(code,message,isinstance(e,refused))
+    if isinstance(e,OSError):
+        return SendFailure(message,"network")
+    return SendFailure(message,"other")
+
+def build_message(account,to_email,subject,body):
+    msg = MIMEText(body,'plain','utf-8')
+    msg['From'] = account['email']
+    msg['To'] = to_email
+    msg['Subject'] = Header(subject,'utf-8')
+    return msg.as_string()
+
+def record_usage(account,count=1):
+    SENT_TOTAL.inc(account['email'],n=count)
+    add_usage(account['email'],count)
+
+def send_email(account,to_email,subject,body):
+    try:
+        payload = build_message(account,to_email,subject,body)
     except Exception as e:
         return False,str(e)
+    return send_payload(account,to_email,payload)
 
-# ================== 收件人持久化 ==================
-def save_recipients():
-    with open(RECIPIENTS_FILE,'w',encoding='utf-8') as f:
-        json.dump({"pending":RECIPIENTS,"sent":SENT_RECIPIENTS},f,ensure_ascii=False,indent=2)
+# 在池化会话上执行一次 SMTP 事务；会话被服务端断开（421 / 连接断开）时重连一次。返回 (结果, 错误)
+def smtp_transaction(account,transaction):
+    for attempt in range(2):
+        sess = None
+        try:
+            sess = acquire_smtp(account)
+            sess.server.data_seconds,sess.server.data_started = 0.0,False
+            start = time.perf_counter()
+            result = transaction(sess.server)
+            observe_transaction(sess,time.perf_counter()-start)
+            sess.sent += 1
+            release_smtp(sess)
+            return result,''
+        except Exception as e:
+            if sess is not None:
+                if is_smtp_disconnect(e) or not isinstance(e,smtplib.SMTPException):
+                    close_smtp_session(sess)
+                else:
+                    # 收件人被拒等错误 smtplib 已 RSET，会话仍可复用
+                    release_smtp(sess)
+                if data_unanswered(sess.server,e): return None,unknown_failure(e)
+            if attempt==0 and is_smtp_disconnect(e):
+                continue
+            return None,classify_failure(e)
+
+def send_payload(account,to_email,payload):
+    _,err = smtp_transaction(account,lambda server: server.sendmail(account['email'],[to_email],payload))
+    if err: return False,err
+    record_usage(account)
+    return True,''
+
+# ---- 合并发送：同一事务多个 RCPT，服务器支持 PIPELINING 时 MAIL/RCPT 一次写出 ----
+def check_421(code,resp):
+    if code == 421: raise smtplib.SMTPResponseException(code,resp)
+
+# 返回被拒收件人 {邮箱: (code, resp)}；全部被拒时也不抛异常，每个收件人按自己的响应码归类
+def sendmail_pipelined(server,from_addr,to_addrs,payload):
+    if not server.has_extn('pipelining'):
+        try:
+            return server.sendmail(from_addr,to_addrs,payload)
+        except smtplib.SMTPRecipientsRefused as e:
+            # 遇到 421 时 smtplib 已断开连接，其余收件人没有结果，按断线重试整批
+            if len(e.recipients) < len(to_addrs) or any(code == 421 for code,_ in e.recipients.values()): raise
+            return e.recipients
+    server.send(f"MAIL FROM:{smtplib.quoteaddr(from_addr)}\r\n"+
+                "".join(f"RCPT TO:{smtplib.quoteaddr(addr)}\r\n" for addr in to_addrs))
+    mail_reply = server.getreply()
+    rcpt_replies = [server.getreply() for _ in to_addrs]
+    check_421(*mail_reply)
+    for reply in rcpt_replies: check_421(*reply)
+    if mail_reply[0] != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(mail_reply[0],mail_reply[1],from_addr)
+    refused = {addr:reply for addr,reply in zip(to_addrs,rcpt_replies) if reply[0] not in (250,251)}
+    if len(refused) == len(to_addrs):
+        server.rset()
+        return refused
+    code,resp = server.data(payload)
+    check_421(code,resp)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPDataError(code,resp)
+    return refused
 
+# 地址不能按 ASCII 编码的收件人（未请求 SMTPUTF8）不放进事务，单独判为永久失败，不拖累同批其他人
+def split_unencodable(to_emails):
+    refused = {addr:SendFailure("收件人地址含非 ASCII 字符，服务器不接受","permanent",recipient=True)
+               for addr in to_emails if not addr.isascii()}
+    return [addr for addr in to_emails if addr not in refused],refused
+
+def refused_failures(refused):
+    failures = {}
+    for addr,(code,resp) in refused.items():
+        if isinstance(resp,bytes): resp = resp.decode('utf-8','replace')
+        failures[addr] = failure_from_code(code,f"{code} {resp}",True)
+    return failures
+
+# 整批事务因账号或连接问题失败（auth / network）时错误对所有人都不计次，结果未知（unknown）的整批都可能已送达，不能重发；
+# 其他整批失败无法确定是哪个收件人的问题，逐个单独重发，每人的结果只算在自己头上
+def batch_failed_for_all(err):
+    return err.kind in ("auth","network","unknown")
+
+# 逐个重发时第 i 个收件人整批性失败：其余的还没发出，结果未知的只有这一个，其余按连接问题放回
+def fail_remaining(failures,to_emails,i,err):
+    failures[to_emails[i]] = err
+    rest = SendFailure(str(err),"network") if err.kind == "unknown" else err
+    failures.update(dict.fromkeys(to_emails[i+1:],rest))
+
+# 返回 (被拒收件人 {邮箱: SendFailure}, 错误)；被拒为 None 表示整批因账号或连接问题失败，错误对每个收件人都适用
+def send_batch(account,to_emails,payload):
+    to_emails,failures = split_unencodable(to_emails)
+    if not to_emails: return failures,''
+    refused,err = smtp_transaction(account,lambda server: sendmail_pipelined(server,account['email'],to_emails,payload))
+    if err and batch_failed_for_all(err): return None,err
+    if err:
+        for i,addr in enumerate(to_emails):
+            ok,err = send_payload(account,addr,payload)
+            if ok: continue
+            if batch_failed_for_all(err):
+                fail_remaining(failures,to_emails,i,err)
+                return failures,err
+            failures[addr] = err
+        return failures,''
+    record_usage(account,len(to_emails)-len(refused))
+    failures.update(refused_failures(refused))
+    return failures,''
+
+# ================== 收件人持久化 ==================
 def load_recipients():
-    global RECIPIENTS,SENT_RECIPIENTS
-    if os.path.exists(RECIPIENTS_FILE):
-        with open(RECIPIENTS_FILE,'r',encoding='utf-8') as f:
-            data=json.load(f)
-            RECIPIENTS=data.get('pending',[])
-            SENT_RECIPIENTS=data.get('sent',[])
-    else:
-        RECIPIENTS=[]
-        SENT_RECIPIENTS=[]
-        
+    global RECIPIENTS,SENT_COUNT,SENT_EMAILS,DEAD_EMAILS,SUPPRESSED,RECIPIENT_ATTEMPTS
+    RECIPIENTS=PendingQueue(db_load_recipients("pending"))
+    sent = db_load_emails("sent")
+    SENT_COUNT=len(sent)
+    SENT_EMAILS={normalize_email(e) for e in sent}
+    DEAD_EMAILS={normalize_email(e) for e in db_load_emails("dead")}
+    SUPPRESSED=db_load_suppressions()
+    RECIPIENT_ATTEMPTS=dict(db_execute("SELECT id,attempts FROM recipients WHERE status='pending' AND attempts>0"))
+
+# 第 attempts 次临时失败后的退避秒数：RETRY_BASE × 2^(attempts-1)，不超过 RETRY_MAX，乘以 0.5~1.5 的随机抖动
+def retry_delay(attempts):
+    return min(RETRY_MAX,RETRY_BASE*2**max(0,attempts-1))*random.uniform(0.5,1.5)
+
+# 失败的收件人回到所属活动的队列；活动已取消或结束时回到未分配队列。
+# 带 retry_at 的等退避到期后才重新发送：单进程时放进活动的重试堆，多进程时只写回库中，到期后由任一发送进程认领
+def requeue_recipient(recipient,front=False,attempts=None,error=None,job=None,retry_at=None):
+    with SEND_LOCK:
+        running = job is not None and job.status == "running"
+        queue = job.queue if running else RECIPIENTS
+        # 多进程时未分配的收件人只在数据库中
+        if running and retry_at is not None:
+            if not SHARED: job.retry.push(recipient,retry_at)
+            # 多进程时可能由其他进程认领重试，失败次数以认领时库中的为准
+            else: RECIPIENT_ATTEMPTS.pop(recipient['id'],None)
+        elif running or not SHARED:
+            if front: queue.appendleft(recipient)
+            else: queue.append(recipient)
+        job_id = job.id if running else None
+    db_requeue(recipient,front,attempts,error,job_id,retry_at)
+
+# 以下三个函数需在持有 SEND_LOCK 时调用：待发送收件人分布在未分配队列和各进行中活动的队列里
+def pending_queues():
+    jobs = [job for job in JOBS.values() if job.status in ("running","preparing")]
+    return [RECIPIENTS]+[job.queue for job in jobs]+[job.retry for job in jobs if job.retry]
+
+def pending_count():
+    return sum(len(queue) for queue in pending_queues())
+
+def is_pending(email):
+    return any(email in queue for queue in pending_queues())
+
+# 从所有待发送队列中删除这些邮箱（按归一邮箱匹配），返回被删除的记录；队列因此清空的活动随之结束
+def remove_pending(emails):
+    with SEND_LOCK:
+        removed = [r for queue in pending_queues() for email in emails for r in queue.remove_email(email)]
+        jobs = [job for job in JOBS.values() if job.status == "running"]
+    for job in jobs: settle_job(job,0)
+    return removed
+
 # ---- 保证启动时总是加载历史数据 ----
-load_recipients()
-load_logs()
+# 多进程时收件人只在数据库中，发送进程按活动分块认领；web worker 的日志窗口在下方“多进程部署”中加载
+# 旧版 JSON 文件中的收件人要转成 Recipient 记录，迁移放在其定义之后
+try:
+    migrate_json_files()
+except Exception as e:
+    print("JSON 数据迁移失败:", e)
+migrate_import_columns()
+
+if not SHARED:
+    load_recipients()
+    load_logs()
 
 
 # ================== 后端：24小时内账号统计 ==================
-def append_log(msg):
-    global SEND_LOGS
-    now_utc = datetime.datetime.utcnow()
-    cutoff = now_utc - datetime.timedelta(hours=24)
-    
-    # 清理24小时以上日志
-    valid_logs = []
-    for entry in SEND_LOGS:
-        try:
-            ts = datetime.datetime.fromisoformat(entry['ts'])
-            if ts > cutoff:
-                valid_logs.append(entry)
-        except Exception:
-            continue
-    SEND_LOGS = valid_logs
+# event="sent" 且带 account 的日志计入该账号 24 小时发送次数
+def append_log(msg, event=None, account=None):
+    start = time.perf_counter()
+    if SHARED:
+        # 多进程时日志和对应事件在同一事务中写库，由各 web worker 从共享事件流读出后更新日志窗口并推送
+        now = time.time()
+        entry = log_entry(msg,now)
+        db_execute_atomic([("INSERT INTO logs(epoch,ts,msg,event,account) VALUES (?,?,?,?,?)",(now,entry['ts'],msg,event,account)),
+                           ("INSERT INTO events(epoch,data) VALUES (?,?)",
+                            (now,json.dumps({"log":msg,"ts":entry['ts'],"event":event,"account":account},ensure_ascii=False)))])
+    else:
+        # 在锁内发布事件，保证 /get-logs 返回的日志与 last_event_id 一致
+        with LOG_LOCK:
+            recent_usage = _append_log_locked(msg, event, account)
+            send_event({"log": msg, "usage": recent_usage})
+    PERSIST_SECONDS.observe(time.perf_counter()-start,"append_log")
 
-    entry = {"ts":(now_utc+datetime.timedelta(hours=8)).isoformat()+"+08:00", "msg":msg}
-    SEND_LOGS.append(entry)
-    save_logs()
-    save_usage()
+def log_entry(msg, now):
+    ts = datetime.datetime.fromtimestamp(now,datetime.timezone(datetime.timedelta(hours=8)))
+    return {"ts":ts.replace(tzinfo=None).isoformat()+"+08:00", "msg":msg}
 
-    # 统计24小时内账号发送次数
-    recent_usage = {}
-    for log in SEND_LOGS:
-        text = log['msg']
-        if text.startswith('已发送给'):
-            parts = text.split('使用账号')
-            if len(parts) == 2:
-                acc_email = parts[1].strip(' )')
-                recent_usage[acc_email] = recent_usage.get(acc_email, 0) + 1
+def _append_log_locked(msg, event, account):
+    now = time.time()
+    entry = log_entry(msg,now)
+    remember_log(now, entry, account if event == "sent" else None)
+    save_log(entry, now, event, account)
+    return dict(RECENT_USAGE)
 
-    send_event({"log": msg, "usage": recent_usage})
+# 淘汰 24 小时窗口外的旧日志。追加和读取时都要调用：空闲时没有新日志，读取时也不能返回过期条目
+def expire_logs(now):
+    cutoff = now-LOG_WINDOW
+    while SEND_LOGS and SEND_LOGS[0][0] <= cutoff:
+        _,_,old_account = SEND_LOGS.popleft()
+        if old_account:
+            left = RECENT_USAGE[old_account]-1
+            if left: RECENT_USAGE[old_account] = left
+            else: del RECENT_USAGE[old_account]
+
+# 追加到 24 小时日志窗口，先清理窗口外的旧日志；counted 为计入发送次数的账号
+def remember_log(now, entry, counted):
+    expire_logs(now)
+    SEND_LOGS.append((now,entry,counted))
+    if counted: RECENT_USAGE[counted] = RECENT_USAGE.get(counted,0)+1
 
 # ================== SSE ==================
+# 事件总线：发布方只往共享环形缓冲写一次，订阅者各自记录读到的事件 id，发布耗时与订阅者数量无关。
+# 落后超过缓冲区的订阅者丢弃最旧事件；一次读出的多条事件中 usage / import / campaigns 快照只保留最新的。
+# 断线重连时浏览器带上 Last-Event-ID，从缓冲区续传
+SSE_HISTORY = 1000
+SSE_HEARTBEAT = 15
+SNAPSHOT_KEYS = ("usage","import","campaigns")
+
+class EventBus:
+    def __init__(self, size, start_id=0):
+        self._cond = Condition()
+        self._events = deque(maxlen=size)
+        self.last_id = start_id
+        self.start_id = start_id    # 本进程从这个 id 之后开始记录事件
+
+    # event_id 为共享事件流中的 id（多进程时），否则顺序编号
+    def publish(self, data, event_id=None):
+        with self._cond:
+            self.last_id = self.last_id+1 if event_id is None else event_id
+            self._events.append((self.last_id, data))
+            self._cond.notify_all()
+
+    # 返回 last_id 之后的 (事件列表, 丢弃条数)；timeout 内没有新事件返回空列表。
+    # 早于 start_id 的（单进程时是重启前的 id）从本进程的第一条事件读起；
+    # 多进程时 id 全局递增，客户端可能来自读得更快的 worker，此时等本进程追上，不重放缓冲区
+    def read_after(self, last_id, timeout):
+        with self._cond:
+            last_id = max(last_id,self.start_id)
+            if not self._cond.wait_for(lambda: self.last_id > last_id, timeout): return [],0
+            first_id = self._events[0][0]
+            dropped = max(0,first_id-last_id-1)
+            events = list(itertools.islice(self._events,max(0,last_id+1-first_id),None))
+        return events,dropped
+
+# 单进程时 id 从 启动时刻秒数×10^6 起编号，重启前后的 id 不会重叠，浏览器带着重启前的 id 重连时能识别出来；
+# 多进程时用共享事件流的 id，由 load_shared_logs 设置起点
+EVENT_BUS = EventBus(SSE_HISTORY,int(time.time())*10**6)
+
 def send_event(data):
-    for subscriber in EVENT_SUBSCRIBERS:
-        try: subscriber.put(json.dumps(data))
-        except: pass
+    if SHARED:
+        db_execute("INSERT INTO events(epoch,data) VALUES (?,?)", (time.time(),json.dumps(data,ensure_ascii=False)))
+    else:
+        EVENT_BUS.publish(data)
+
+if any(RECOVERED_INFLIGHT):
+    _action = "移入失败列表待确认" if INFLIGHT_RECOVERY == "hold" else "放回队首重新发送"
+    append_log(f"上次运行中断：{RECOVERED_INFLIGHT[0]} 个在途收件人已确认送达，{RECOVERED_INFLIGHT[1]} 个结果未知，已{_action}")
+
+def coalesce_events(events):
+    latest = {}
+    for i,(_,data) in enumerate(events):
+        for key in SNAPSHOT_KEYS:
+            if key in data: latest[key] = i
+    result = []
+    for i,(event_id,data) in enumerate(events):
+        stale = [key for key in SNAPSHOT_KEYS if key in data and latest[key] != i]
+        if stale:
+            data = {k:v for k,v in data.items() if k not in stale}
+        result.append((event_id,data))
+    return result
 
 @app.route('/send-stream')
 def send_stream():
-    def event_stream():
-        q = Queue()
-        EVENT_SUBSCRIBERS.append(q)
-        try:
-            while True:
-                data = q.get()
-                yield f"data: {data}\n\n"
-        except GeneratorExit:
-            if q in EVENT_SUBSCRIBERS: EVENT_SUBSCRIBERS.remove(q)
-    return Response(event_stream(),mimetype='text/event-stream')
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try: last_id = int(last_id)
+    except (TypeError,ValueError): last_id = EVENT_BUS.last_id   # 新连接只接收之后的事件
+
+    def event_stream(last_id):
+        yield "retry: 3000\n\n"
+        while True:
+            events,dropped = EVENT_BUS.read_after(last_id,SSE_HEARTBEAT)
+            if not events:
+                yield ": ping\n\n"
+                continue
+            if dropped:
+                yield f"data: {json.dumps({'dropped': dropped})}\n\n"
+            for event_id,data in coalesce_events(events):
+                # 被合并掉的事件只推进 id，方便断线续传
+                if data: yield f"id: {event_id}\ndata: {json.dumps(data)}\n\n"
+                else: yield f"id: {event_id}\n\n"
+            last_id = events[-1][0]
+    return Response(event_stream(last_id),mimetype='text/event-stream',
+                    headers={"Cache-Control":"no-cache","X-Accel-Buffering":"no"})
 
 # ================== 前端页面（完整 HTML 内嵌） ==================
 @app.route("/", methods=["GET"])
@@ -287,6 +2047,14 @@ def home():
                         <button class="btn" onclick="downloadTemplate()">下载 CSV 模板</button>
                         <button class="btn" onclick="exportPending()">导出未发送收件人</button>
                         <button class="btn" onclick="exportSent()">导出已发送收件人</button>
+                        <button class="btn" onclick="exportDead()">导出发送失败收件人</button>
+                        <button class="btn" onclick="retryDead()">失败收件人重新排队</button>
+                    </div>
+                    <div class="muted" id="importProgress"></div>
+                    <div class="row">
+                        <label>屏蔽名单（CSV 含 email 列）:</label>
+                        <input type="file" id="suppressFile">
+                        <button class="btn" onclick="uploadSuppressions()">导入屏蔽名单</button>
                     </div>
                 </div>
                 <div class="card" style="margin-top:10px;">
@@ -294,6 +2062,15 @@ def home():
 
     <!-- 分页控件 -->
     <div style="margin-bottom:6px;">
+        状态：
+        <select id="recipientStatus" onchange="resetPage()">
+            <option value="pending">未发送</option>
+            <option value="sent">已发送</option>
+            <option value="dead">发送失败</option>
+        </select>
+        搜索：
+        <input type="text" id="recipientQuery" placeholder="邮箱" style="width:160px;" onchange="resetPage()">
+        <label><input type="checkbox" id="recipientSubstring" onchange="resetPage()"> 包含匹配</label>
         每页显示：
         <select id="perPage" onchange="loadRecipients()">
             <option value="10">10</option>
@@ -319,7 +2096,7 @@ def home():
             <div id="sendPage" style="display:none;">
                 <div class="card">
                     <h2>邮件发送</h2>
-                    <div class="muted">主题/正文可用变量：<code>{name}</code>、<code>{real_name}</code></div>
+                    <div class="muted">主题/正文可用变量：<code>{email}</code>、<code>{name}</code>、<code>{real_name}</code>，以及 CSV 中的其他列名</div>
                     <div class="row" style="margin-top:6px;">
                         <label>主题:</label>
                         <input type="text" id="subject" style="flex:1; min-width:280px;" placeholder="请输入主题, 可用 {name} {real_name}">
@@ -332,6 +2109,12 @@ def home():
                         <label>选择发送账号:</label>
                         <div id="accountCheckboxes"></div>
                     </div>
+                    <div class="row">
+                        <label>活动名称:</label>
+                        <input type="text" id="campaignName" style="width:160px;" placeholder="可选">
+                        <label>权重:</label>
+                        <input type="number" id="priority" value="1" min="1" style="width:60px;">
+                    </div>
                     <div class="row">
                         <label>发送间隔(秒):</label>
                         <input type="number" id="interval" value="5" style="width:80px;">
@@ -340,6 +2123,11 @@ def home():
                         <button class="btn" onclick="resumeSend()">继续</button>
                     </div>
                 </div>
+                <div class="card" style="margin-top:10px;">
+                    <h3>发送活动</h3>
+                    <div class="muted">每次开始发送都会把当前未分配的收件人建成一个活动，多个活动按权重轮流使用账号</div>
+                    <div id="campaignList"></div>
+                </div>
                 <div class="card" style="margin-top:10px;">
                     <h3>实时发送进度</h3>
                     <ul id="sendLog"></ul>
@@ -382,7 +2170,7 @@ def home():
                 document.getElementById('accountsPage').style.display = page==='accounts'?'block':'none';
                 activeTab(page);
                 if(page==='recipients'){ loadRecipients(); }
-                if(page==='send'){ loadAccounts(); loadLogsAndUsage(); startEventSource(); }
+                if(page==='send'){ loadAccounts(); loadLogsAndUsage(); }
                 if(page==='accounts'){ loadAccountsList(); }
             }
 
@@ -392,6 +2180,7 @@ def home():
                 if(!file){ alert("请选择文件"); return; }
                 const formData = new FormData();
                 formData.append('file', file);
+                startEventSource(null);
                 fetch('/upload-csv', {method:'POST', body:formData})
                 .then(res=>res.json()).then(data=>{
                     alert(data.message);
@@ -399,34 +2188,53 @@ def home():
                 });
             }
 
+            function uploadSuppressions(){
+                const file = document.getElementById('suppressFile').files[0];
+                if(!file){ alert("请选择文件"); return; }
+                const formData = new FormData();
+                formData.append('file', file);
+                fetch('/upload-suppressions', {method:'POST', body:formData})
+                .then(res=>res.json()).then(data=>{
+                    alert(data.message);
+                    loadRecipients();
+                });
+            }
+
            function loadRecipients(){
-    fetch('/recipients').then(res=>res.json()).then(data=>{
+    const perPage = parseInt(document.getElementById('perPage')?.value || 10);
+    let page = parseInt(document.getElementById('currentPage')?.value || 1);
+    if(page < 1) page = 1;
+    const status = document.getElementById('recipientStatus').value;
+    const q = document.getElementById('recipientQuery').value.trim();
+    const match = document.getElementById('recipientSubstring').checked ? 'substring' : 'prefix';
+    const params = new URLSearchParams({status, q, match, offset:(page-1)*perPage, limit:perPage});
+    fetch('/recipients?'+params).then(res=>res.json()).then(data=>{
         const tbody = document.querySelector('#recipientsTable tbody');
         tbody.innerHTML = '';
 
-        const perPage = parseInt(document.getElementById('perPage')?.value || 10);
-        let page = parseInt(document.getElementById('currentPage')?.value || 1);
-
-        const totalPages = Math.ceil(data.pending.length / perPage);
-        if(page > totalPages) page = totalPages;
-        if(page < 1) page = 1;
-        document.getElementById('currentPage').value = page;
-
-        const startIdx = (page-1) * perPage;
-        const endIdx = startIdx + perPage;
-        const pageData = data.pending.slice(startIdx, endIdx);
+        const totalPages = Math.max(1, Math.ceil(data.total / perPage));
+        if(page > totalPages){
+            document.getElementById('currentPage').value = totalPages;
+            if(data.total > 0){ loadRecipients(); return; }
+        }
 
-        pageData.forEach((r)=>{
+        data.items.forEach((r)=>{
             const tr = document.createElement('tr');
             tr.innerHTML = `<td>${r.email}</td><td>${r.name||''}</td><td>${r.real_name||''}</td>`+
-                           `<td><button class="danger-link" onclick="deleteRecipient('${r.email}')">删除</button></td>`;
+                           (status==='pending' ? `<td><button class="danger-link" onclick="deleteRecipient('${r.email}')">删除</button></td>` : '<td></td>');
             tbody.appendChild(tr);
         });
 
-        document.getElementById('pagination').textContent = `页数: ${page}/${totalPages}`;
+        document.getElementById('pagination').textContent =
+            `页数: ${Math.min(page,totalPages)}/${totalPages}（共 ${data.total} 条；未发送 ${data.counts.pending}，已发送 ${data.counts.sent}，屏蔽 ${data.counts.suppressed}）`;
     });
 }
 
+function resetPage(){
+    document.getElementById('currentPage').value = 1;
+    loadRecipients();
+}
+
 // 上一页 / 下一页按钮函数
 function changePage(offset){
     const pageInput = document.getElementById('currentPage');
@@ -449,6 +2257,10 @@ function changePage(offset){
             function downloadTemplate(){ window.location.href="/download-template"; }
             function exportPending(){ window.location.href="/download-recipients?status=pending"; }
             function exportSent(){ window.location.href="/download-recipients?status=sent"; }
+            function exportDead(){ window.location.href="/download-recipients?status=dead"; }
+            function retryDead(){
+                fetch('/retry-dead', {method:'POST'}).then(res=>res.json()).then(data=>{ alert(data.message); loadRecipients(); });
+            }
 
             // ---------------- 邮件发送 ----------------
             function loadAccounts(){
@@ -474,24 +2286,68 @@ function changePage(offset){
                 const subject = document.getElementById('subject').value;
                 const body = document.getElementById('body').value;
                 const interval = parseInt(document.getElementById('interval').value);
+                const name = document.getElementById('campaignName').value;
+                const priority = parseInt(document.getElementById('priority').value) || 1;
                 if(!subject || !body){ alert("请填写主题和正文"); return; }
-                fetch('/send', {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({subject,body,interval})})
-                .then(res=>res.json()).then(data=>{ alert(data.message); });
+                fetch('/send', {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({subject,body,interval,name,priority})})
+                .then(res=>res.json()).then(data=>{ alert(data.message); loadCampaigns(); });
                 // SSE 在 showPage('send') 时已经启动，这里无需重复
             }
 
-            function startEventSource(){
-                if(evtSource){ evtSource.close(); }
-                evtSource = new EventSource('/send-stream');
+            const CAMPAIGN_STATUS = {preparing:'预检中', running:'进行中', done:'已完成', cancelled:'已取消'};
+            function renderCampaigns(list){
+                const div = document.getElementById('campaignList');
+                div.innerHTML = '';
+                list.slice().reverse().forEach(c=>{
+                    const finished = c.sent + c.skipped + c.dead;
+                    div.innerHTML += `
+                      <div class="item">
+                        <div class="left">
+                          <strong>${c.name}</strong>
+                          <span class="pill">${CAMPAIGN_STATUS[c.status]||c.status}</span>
+                          <span class="pill">权重 ${c.priority}</span>
+                          ${finished}/${c.total}（送达 ${c.sent}，跳过 ${c.skipped}，失败 ${c.dead}${c.filtered?'（域名无效 '+c.filtered+'）':''}，待发 ${c.pending}）
+                        </div>
+                        <div class="right">
+                          ${(c.status==='running'||c.status==='preparing')?`<button class="btn-danger" onclick="cancelCampaign(${c.id})">取消</button>`:''}
+                        </div>
+                      </div>`;
+                });
+            }
+            function loadCampaigns(){
+                fetch('/campaigns').then(res=>res.json()).then(data=>renderCampaigns(data.campaigns));
+            }
+            function cancelCampaign(id){
+                fetch('/cancel-campaign', {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({id})})
+                .then(res=>res.json()).then(data=>{ alert(data.message); loadCampaigns(); });
+            }
+
+            // 只建立一次连接；断线后浏览器自动重连并带上 Last-Event-ID 续传
+            function startEventSource(lastEventId){
+                if(evtSource && evtSource.readyState !== EventSource.CLOSED){ return; }
+                evtSource = new EventSource('/send-stream' + (lastEventId != null ? '?last_event_id=' + lastEventId : ''));
                 const log = document.getElementById('sendLog');
                 const usage = document.getElementById('accountUsage');
                 evtSource.onmessage = function(e){
                     const d = JSON.parse(e.data);
+                    if(d.dropped){
+                        const li = document.createElement('li');
+                        li.textContent = '（跳过 ' + d.dropped + ' 条较早的事件）';
+                        log.appendChild(li);
+                    }
                     if(d.log){
                         const li = document.createElement('li');
                         li.textContent = d.log;
                         log.appendChild(li);
                     }
+                    if(d.import){
+                        const p = d.import;
+                        document.getElementById('importProgress').textContent =
+                            (p.done?'导入完成':'导入中')+`：已读取 ${p.rows} 行，新增 ${p.added}，重复 ${p.duplicate}，屏蔽 ${p.suppressed||0}，无效 ${p.bad}`;
+                    }
+                    if(d.campaigns){
+                        renderCampaigns(d.campaigns);
+                    }
                     if(d.usage){
                         usage.innerHTML='';
                         for(const acc in d.usage){
@@ -503,8 +2359,11 @@ function changePage(offset){
                 }
             }
 
+            let logsLoaded = false;
             function loadLogsAndUsage(){
-                // 回放历史日志
+                // 历史日志只在首次进入时拉取一次，之后由 SSE 增量推送
+                if(logsLoaded){ return; }
+                logsLoaded = true;
                 fetch('/get-logs').then(res=>res.json()).then(data=>{
                     const log = document.getElementById('sendLog');
                     log.innerHTML = '';
@@ -513,7 +2372,9 @@ function changePage(offset){
                         li.textContent = '[' + item.ts + '] ' + item.msg;
                         log.appendChild(li);
                     });
+                    startEventSource(data.last_event_id);
                 });
+                loadCampaigns();
                 // 读取历史用量
                 fetch('/get-usage').then(res=>res.json()).then(data=>{
                     const usage = document.getElementById('accountUsage');
@@ -586,148 +2447,1321 @@ function changePage(offset){
     """
     return render_template_string(template)
 
+# ================== 模板 ==================
+# 主题/正文在 /send 时解析校验一次，编译成 (字面量, 字段, 转换) 片段，渲染时按收件人取值拼接，
+# 不再每封邮件重新解析格式串。字段可以是 email 或 CSV 中的任意列，缺失的列按空字符串处理
+class TemplateError(ValueError):
+    pass
+
+TEMPLATE_FIELDS = frozenset(("email","name","real_name"))
+
+class CompiledTemplate:
+    def __init__(self, source):
+        self.source = source
+        self.fields = set()
+        self._parts = []
+        try:
+            parsed = list(string.Formatter().parse(source))
+        except ValueError as e:
+            raise TemplateError(f"模板格式错误: {e}")
+        for literal,field,spec,conversion in parsed:
+            if field is None:
+                self._parts.append((literal,None,None))
+                continue
+            if not field.isidentifier():
+                raise TemplateError(f"不支持的变量 {{{field}}}，只能使用列名，如 {{name}}")
+            self.fields.add(field)
+            self._parts.append((literal,field,self._converter(field,spec,conversion)))
+
+    @staticmethod
+    def _converter(field, spec, conversion):
+        if conversion not in (None,"s","r","a"):
+            raise TemplateError(f"变量 {{{field}}} 的转换符无效")
+        if spec and "{" in spec:
+            raise TemplateError(f"变量 {{{field}}} 不支持嵌套格式")
+        try: format("",spec or "")
+        except ValueError as e: raise TemplateError(f"变量 {{{field}}} 的格式无效: {e}")
+        if not spec and conversion in (None,"s"): return None
+        to_text = {"r":repr,"a":ascii}.get(conversion,str)
+        return lambda value: format(to_text(value),spec or "")
+
+    def render(self, values):
+        out = []
+        for literal,field,convert in self._parts:
+            out.append(literal)
+            if field is None: continue
+            value = values.get(field)
+            if value is None: value = ""
+            elif type(value) is not str: value = str(value)
+            out.append(convert(value) if convert else value)
+        return "".join(out)
+
+    def render_many(self, recipients):
+        return [self.render(r) for r in recipients]
+
+# ---- 邮件骨架：与 build_message 产出完全相同的报文，但不变的部分每个任务只编码一次 ----
+# MIMEText(utf-8) 的 as_string() 依次输出 Content-Type / MIME-Version / Content-Transfer-Encoding /
+# From / To / Subject，正文为 base64（每行 76 字符）。骨架按账号缓存头部前缀，主题/正文不含变量时只编码一次，
+# 每个收件人只拼接 To、主题和正文片段，直接生成 CRLF 结尾的字节供 sendmail 使用
+MIME_PREFIX = 'Content-Type: text/plain; charset="utf-8"\r\nMIME-Version: 1.0\r\nContent-Transfer-Encoding: base64\r\n'
+
+def encode_subject(subject):
+    return Header(subject,'utf-8').encode(linesep="\r\n",maxlinelen=0)
+
+def encode_body(body):
+    return base64.encodebytes(body.encode('utf-8')).replace(b"\n",b"\r\n")
+
+# 只有纯 ASCII、无空白/控制字符的地址才能原样写入头部，其他情况走 build_message
+def is_plain_address(addr):
+    return addr.isascii() and addr.isprintable() and not any(c.isspace() for c in addr)
+
+class MessageFactory:
+    def __init__(self, subject_tpl, body_tpl):
+        self.subject_tpl = subject_tpl
+        self.body_tpl = body_tpl
+        self._subject = None if subject_tpl.fields else encode_subject(subject_tpl.render({})).encode('ascii')
+        self._body = None if body_tpl.fields else encode_body(body_tpl.render({}))
+        self._prefixes = {}
+        self._shared = {}
+
+    # 主题和正文都不含变量时，所有收件人的内容完全相同，可以合并到一个事务发送
+    @property
+    def shared(self):
+        return self._subject is not None and self._body is not None
+
+    # 合并发送用的报文：To 头不暴露其他收件人
+    def build_shared(self, from_email):
+        payload = self._shared.get(from_email)
+        if payload is None:
+            payload = self.build(from_email,{"email":"undisclosed-recipients:;"})
+            self._shared[from_email] = payload
+        return payload
+
+    def build(self, from_email, recipient):
+        to_email = recipient['email']
+        prefix = self._prefixes.get(from_email)
+        if prefix is None:
+            if not is_plain_address(from_email): prefix = False
+            else: prefix = (MIME_PREFIX+f"From: {from_email}\r\n").encode('ascii')
+            self._prefixes[from_email] = prefix
+        if prefix is False or not is_plain_address(to_email):
+            payload = build_message({"email":from_email},to_email,self.subject_tpl.render(recipient),self.body_tpl.render(recipient))
+            return smtplib._fix_eols(payload).encode('ascii')
+        subject = self._subject
+        if subject is None: subject = encode_subject(self.subject_tpl.render(recipient)).encode('ascii')
+        body = self._body
+        if body is None: body = encode_body(self.body_tpl.render(recipient))
+        return b"".join((prefix,b"To: ",to_email.encode('ascii'),b"\r\nSubject: ",subject,b"\r\n\r\n",body))
+
+# ================== 收件域名预检 ==================
+# 活动开始发送前把收件人按域名分组，每个域名只解析一次（带缓存）：域名不存在或声明不收信（null MX）的收件人
+# 直接移入失败列表，省掉注定失败的 SMTP 事务；再把各域名的收件人均匀交错排列，避免集中冲击同一收信方。
+# 解析结果为 (可投递, 说明)：True 可投递，False 不可投递，None 暂时无法确定（超时、未安装 dnspython 等，不过滤）
+DOMAIN_ERROR_TTL = 60     # 无法确定的结果只缓存这么久
+
+def dns_resolve_domain(domain):
+    try:
+        answer = dns.resolver.resolve(domain,"MX",lifetime=5)
+    except dns.resolver.NXDOMAIN:
+        return False,"域名不存在"
+    except dns.resolver.NoAnswer:
+        # 没有 MX 记录时按 RFC 5321 以域名本身的 A/AAAA 记录作为收信主机
+        for rdtype in ("A","AAAA"):
+            try:
+                dns.resolver.resolve(domain,rdtype,lifetime=5)
+                return True,domain
+            except dns.resolver.NoAnswer:
+                continue
+            except dns.exception.DNSException as e:
+                return None,f"解析失败：{e.__class__.__name__}"
+        return False,"域名没有 MX 或 A 记录"
+    except dns.exception.DNSException as e:
+        return None,f"解析失败：{e.__class__.__name__}"
+    hosts = sorted((r.preference,r.exchange.to_text(omit_final_dot=True)) for r in answer)
+    if len(hosts) == 1 and hosts[0][1] in ("","."):
+        return False,"域名声明不接收邮件（null MX）"
+    return True,hosts[0][1]
+
+def unchecked_domain(domain):
+    return None,"未安装 dnspython，未检查"
+
+class DomainCache:
+    # resolver(domain) -> (可投递, 说明)，可替换为本地桩函数
+    def __init__(self, resolver, ttl=DOMAIN_CACHE_TTL, negative_ttl=DOMAIN_NEGATIVE_TTL):
+        self.resolver = resolver
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}    # 域名 -> (过期时间, 结果)
+        self._lock = Lock()
+
+    def lookup(self, domain):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        try:
+            result = self.resolver(domain)
+        except Exception as e:
+            result = (None,f"解析失败：{e}")
+        ttl = self.ttl if result[0] else self.negative_ttl if result[0] is False else DOMAIN_ERROR_TTL
+        with self._lock:
+            self._entries[domain] = (now+ttl,result)
+        return result
+
+    def resolve_many(self, domains, workers=DOMAIN_RESOLVE_WORKERS):
+        domains = list(domains)
+        with ThreadPoolExecutor(max_workers=max(1,min(workers,len(domains) or 1))) as pool:
+            return dict(zip(domains,pool.map(self.lookup,domains)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            entries = [{"domain":domain,"deliverable":result[0],"detail":result[1],"expires_in":round(expires-now,1)}
+                       for domain,(expires,result) in self._entries.items() if expires > now]
+            return {"hits":self.hits,"misses":self.misses,"entries":entries}
+
+DOMAIN_CACHE = DomainCache(dns_resolve_domain if dns is not None else unchecked_domain)
+
+def recipient_domain(recipient):
+    return recipient.email.rpartition('@')[2].lower()
+
+# 各域名的收件人在整个队列中均匀分布：域名内第 k 个（共 n 个）排在 (k+0.5)/n 处，域名内保持原有顺序
+def interleave_domains(recipients):
+    groups = {}
+    for r in recipients: groups.setdefault(recipient_domain(r),[]).append(r)
+    keyed = []
+    for g,members in enumerate(groups.values()):
+        n = len(members)
+        keyed.extend(((k+0.5)/n,g,r) for k,r in enumerate(members))
+    keyed.sort(key=lambda item: item[:2])
+    return [r for _,_,r in keyed]
+
+# 解析收件域名，返回 {无法投递的域名: 原因}
+def blocked_domains(job, domains):
+    results = {}
+    if DOMAIN_PREFLIGHT:
+        try:
+            results = DOMAIN_CACHE.resolve_many(domains)
+        except Exception as e:
+            append_log(f"{job.name} 域名预检失败，跳过：{e}")
+    blocked = {domain:detail for domain,(ok,detail) in results.items() if ok is False}
+    if len(domains) > 1 and len(blocked) == len(domains):
+        # 所有域名都无法投递，多半是本机 DNS 异常（被劫持或离线），此时不过滤
+        append_log(f"{job.name} 域名预检：{len(domains)} 个收件域名全部解析失败，疑似 DNS 异常，本次不过滤")
+        blocked = {}
+    return blocked
+
+def prepare_job(job):
+    with SEND_LOCK:
+        domains = {recipient_domain(r) for r in job.queue}
+    blocked = blocked_domains(job,domains)
+    with SEND_LOCK:
+        cancelled = job.status != "preparing"
+    if cancelled:
+        start_workers()     # 预检期间被取消，只需更新发送状态
+        return
+    with SEND_LOCK:
+        # 预检期间可能有收件人被删除，以当前队列为准
+        recipients = list(job.queue)
+        undeliverable = [(r,f"收件域名无法投递：{blocked[recipient_domain(r)]}") for r in recipients if recipient_domain(r) in blocked]
+        ordered = interleave_domains([r for r in recipients if recipient_domain(r) not in blocked])
+        job.queue = PendingQueue(ordered)
+        job.domains = len(domains)
+        job.filtered = len(undeliverable)
+        job.dead += len(undeliverable)
+        for r,_ in undeliverable:
+            DEAD_EMAILS.add(normalize_email(r.email))
+            RECIPIENT_ATTEMPTS.pop(r.id,None)
+        FAILURE_COUNTS["dead"] += len(undeliverable)
+        job.status = "running"
+    if undeliverable: db_mark_dead_many(undeliverable)
+    db_reorder(ordered)
+    for domain,detail in sorted(blocked.items())[:20]:
+        append_log(f"收件域名 {domain} 无法投递：{detail}", event="domain")
+    append_log(f"{job.name} 域名预检：{len(domains)} 个收件域名，{len(blocked)} 个无法投递，{len(undeliverable)} 个收件人移入失败列表")
+    settle_job(job,0)
+    publish_campaigns(force=True)
+    start_workers()
+
+@app.route("/domains")
+def get_domains():
+    return jsonify({"enabled":DOMAIN_PREFLIGHT,"dnspython":dns is not None,**DOMAIN_CACHE.snapshot()})
+
 # ================== 邮件发送逻辑 ==================
+# 发送活动：每个活动有自己的收件人、模板、发送间隔、权重和可用账号。多个活动共享账号池，
+# 每取到一个账号，就在允许使用该账号的活动之间按权重做平滑加权轮询，决定这一封发哪个活动
+class CampaignJob:
+    def __init__(self, job_id, name, subject, body, message, interval, priority=1, accounts=None):
+        self.id = job_id
+        self.name = name or f"活动 {job_id}"
+        self.subject = subject
+        self.body = body
+        self.message = message
+        self.interval = interval
+        self.priority = priority
+        self.accounts = accounts      # 可用账号邮箱集合，None 表示全部选中账号
+        self.campaign = campaign_key(job_id,subject,body)
+        self.queue = PendingQueue()
+        self.retry = RetryQueue()     # 临时失败、等待退避到期的收件人，到期后回到 queue 队尾
+        self.total = 0
+        self.sent = 0
+        self.skipped = 0              # 此前已送达而跳过的
+        self.dead = 0
+        self.filtered = 0             # 预检时因域名无法投递移入失败列表的（也计入 dead）
+        self.domains = 0
+        self.inflight = 0             # 已取出、尚未有结果的收件人
+        self.status = "preparing"     # preparing | running | done | cancelled
+        self.created = time.time()
+        self.finished = None
+        self.current_weight = 0
+        self.claim_size = 0           # 多进程时上次认领的目标数量，本地队列低于一半时补充
+
+    def allows(self, email):
+        return self.accounts is None or email in self.accounts
+
+    def runnable(self):
+        return self.status == "running" and len(self.queue) > 0
+
+    # 退避到期的收件人回到发送队列
+    def release_retries(self, now):
+        for recipient in self.retry.pop_due(now): self.queue.append(recipient)
+
+    def snapshot(self):
+        return {"id":self.id,"name":self.name,"subject":self.subject,"status":self.status,
+                "priority":self.priority,"interval":self.interval,
+                "accounts":sorted(self.accounts) if self.accounts is not None else None,
+                "total":self.total,"sent":self.sent,"skipped":self.skipped,"dead":self.dead,
+                "filtered":self.filtered,"domains":self.domains,
+                "pending":len(self.queue)+len(self.retry),"inflight":self.inflight,
+                "created":self.created,"finished":self.finished}
+
+# 以下四个函数需在持有 SEND_LOCK 时调用
+def runnable_jobs():
+    now = time.time()
+    for job in JOBS.values():
+        if job.retry and job.status == "running": job.release_retries(now)
+    return [job for job in JOBS.values() if job.runnable()]
+
+# 本地队列都空时发送线程还要等几秒再看，返回 None 表示可以退出：单进程时等最早一个退避到期的收件人；
+# 多进程时活动未结束就请 sender_loop 补充认领，稍后再看
+def next_retry_in():
+    if SHARED:
+        if not any(job.status == "running" for job in JOBS.values()): return None
+        REFILL_WANTED.set()
+        return 0.1
+    due = [job.retry.next_due() for job in JOBS.values() if job.retry and job.status == "running"]
+    due = [t for t in due if t is not None]
+    return max(0.0,min(due)-time.time()) if due else None
+
+# 返回调度器用的账号过滤函数；有活动不限账号时返回 None
+def jobs_usable(jobs):
+    if any(job.accounts is None for job in jobs): return None
+    return set().union(*(job.accounts for job in jobs)).__contains__
+
+def pick_job(jobs,email):
+    best,total = None,0
+    for job in jobs:
+        if not job.allows(email): continue
+        job.current_weight += job.priority
+        total += job.priority
+        if best is None or job.current_weight > best.current_weight: best = job
+    if best is not None: best.current_weight -= total
+    return best
+
+# 需在持有 SEND_LOCK 时调用：单进程时已结束的活动只保留最近 CAMPAIGN_LIST_LIMIT 个，与多进程时活动列表的上限一致，
+# 更早的从 JOBS 中移除；已结束活动的送达集合不再用到，一并释放
+def prune_jobs():
+    finished = [job for job in JOBS.values() if job.status in ("done","cancelled") and not job.inflight]
+    for job in finished: CAMPAIGN_DELIVERIES.pop(job.campaign,None)
+    for job in finished[:max(0,len(finished)-CAMPAIGN_LIST_LIMIT)]: del JOBS[job.id]
+
+CAMPAIGN_PUBLISHED = 0.0
+CAMPAIGN_PUBLISH_INTERVAL = 0.5
+
+def campaign_snapshots():
+    if SHARED: return db_campaign_snapshots()
+    with SEND_LOCK:
+        return [job.snapshot() for job in JOBS.values()]
+
+# 活动进度推送给前端；逐封发送时限制频率，状态变化时立即推送。
+# 多进程时发送进程只有自己认领的部分，进度由 web worker 读共享事件流时从库中汇总
+def publish_campaigns(force=False):
+    global CAMPAIGN_PUBLISHED
+    if ROLE == "sender": return
+    now = time.time()
+    if not force and now-CAMPAIGN_PUBLISHED < CAMPAIGN_PUBLISH_INTERVAL: return
+    CAMPAIGN_PUBLISHED = now
+    send_event({"campaigns":campaign_snapshots()})
+
 @app.route("/send", methods=["POST"])
 def start_send():
-    global IS_SENDING, PAUSED
+    global IS_SENDING, PAUSED, RECIPIENTS, NEXT_JOB_ID
     data = request.json
     subject = data.get("subject")
     body = data.get("body")
     interval = int(data.get("interval", 5))
     if not subject or not body:
         return jsonify({"message":"主题和正文不能为空"}), 400
-    SEND_QUEUE.append({"subject":subject,"body":body,"interval":interval})
-    if not IS_SENDING:
+    try:
+        priority = max(1,int(data.get("priority") or 1))
+    except (TypeError,ValueError):
+        return jsonify({"message":"权重必须是正整数"}), 400
+    accounts = data.get("accounts") or None
+    if accounts is not None:
+        if SHARED: refresh_accounts()
+        accounts = {email.strip() for email in accounts if email.strip()}
+        if not any(acc.get("selected",True) and acc['email'] in accounts for acc in ACCOUNTS):
+            return jsonify({"message":"指定的账号都不存在或未选中"}), 400
+    try:
+        subject_tpl,body_tpl = CompiledTemplate(subject),CompiledTemplate(body)
+    except TemplateError as e:
+        return jsonify({"message":str(e)}), 400
+    # 变量名写错时每个收件人都会渲染成空白，发送前拒绝
+    unknown = (subject_tpl.fields|body_tpl.fields)-TEMPLATE_FIELDS
+    if unknown: unknown -= db_import_columns()
+    if unknown:
+        return jsonify({"message":"模板中有未知的变量："+"、".join(f"{{{f}}}" for f in sorted(unknown))+
+                                  "，只能使用 email、name、real_name 和导入的列","unknown":sorted(unknown)}), 400
+    if SHARED:
+        return start_shared_send((data.get("name") or "").strip(),subject,body,interval,priority,accounts,
+                                 MessageFactory(subject_tpl,body_tpl))
+    with SEND_LOCK:
+        if not RECIPIENTS:
+            return jsonify({"message":"没有待分配的收件人，请先导入"}), 400
+        # 新活动接管当前所有未分配的待发送收件人
+        job = CampaignJob(NEXT_JOB_ID,(data.get("name") or "").strip(),subject,body,
+                          MessageFactory(subject_tpl,body_tpl),interval,priority,accounts)
+        NEXT_JOB_ID += 1
+        job.queue,RECIPIENTS = RECIPIENTS,PendingQueue()
+        job.total = len(job.queue)
+        prune_jobs()
+        JOBS[job.id] = job
+        db_assign_job(job.id,job.queue)
+        if not IS_SENDING: PAUSED = False
         IS_SENDING = True
-        PAUSED = False
-        t = Thread(target=send_worker_loop, daemon=True)
-        t.start()
-    return jsonify({"message":"邮件发送任务已启动"})
+        snapshot = job.snapshot()
+    append_log(f"{job.name} 已创建：{job.total} 个收件人，权重 {job.priority}" +
+               (f"，限定账号 {len(job.accounts)} 个" if job.accounts is not None else ""))
+    if job.message.shared and SMTP_BATCH_SIZE > 1:
+        append_log(f"主题和正文不含变量，将按每批最多 {SMTP_BATCH_SIZE} 个收件人合并发送")
+    # 域名预检完成后活动才进入发送，预检在后台线程中进行
+    Thread(target=prepare_job, args=(job,), daemon=True).start()
+    publish_campaigns(force=True)
+    return jsonify({"message":"邮件发送任务已启动","campaign":snapshot})
+
+# 每个选中账号一个发送线程，共享各活动的队列；asyncio 后端只需一个线程。已在发送时只补足线程数
+def start_workers():
+    global IS_SENDING, ACTIVE_WORKERS
+    target = max(1,len([acc for acc in ACCOUNTS if sending_account(acc)]))
+    if SEND_BACKEND == "asyncio" and aiosmtplib is not None: target = 1
+    with SEND_LOCK:
+        workers = max(0,target-ACTIVE_WORKERS) if runnable_jobs() else 0
+        ACTIVE_WORKERS += workers
+        IS_SENDING = ACTIVE_WORKERS > 0 or any(job.status == "preparing" for job in JOBS.values())
+    if not workers: return
+    worker = send_worker_loop
+    if SEND_BACKEND == "asyncio":
+        if aiosmtplib is None:
+            append_log("未安装 aiosmtplib，改用线程发送")
+        else:
+            worker = async_send_worker
+    for _ in range(workers):
+        Thread(target=worker, daemon=True).start()
+    append_log(f"发送任务已启动，并发线程 {workers} 个")
+
+# 为取到的账号选一个活动并取出一个收件人，返回 (活动, 收件人)
+def next_job_recipient(acc):
+    with SEND_LOCK:
+        job = pick_job(runnable_jobs(),acc['email'])
+        if job is None: return None,None
+        recipient = job.queue.popleft()
+        job.inflight += 1
+        want_refill(job)
+    set_account_pace(acc,job.interval)
+    return job,recipient
+
+def pop_recipients(job,n):
+    batch = []
+    with SEND_LOCK:
+        while len(batch) < n:
+            recipient = job.queue.popleft()
+            if recipient is None: break
+            batch.append(recipient)
+        job.inflight += len(batch)
+        want_refill(job)
+    return batch
+
+# 合并发送时一批最多拿多少个收件人（受账号剩余配额限制），返回 (收件人列表, 占用配额)
+def take_batch(job,acc,recipient):
+    if not job.message.shared or SMTP_BATCH_SIZE <= 1:
+        return [recipient],1
+    extra = reserve_quota(acc,SMTP_BATCH_SIZE-1)
+    batch = [recipient]+pop_recipients(job,extra)
+    if len(batch) < 1+extra: refund_quota(acc,1+extra-len(batch))
+    return batch,len(batch)
+
+def finish_batch(job,acc,batch,refused,err):
+    for recipient in batch:
+        if refused is None:
+            finish_recipient(job,acc,recipient,False,err)
+        elif recipient['email'] in refused:
+            finish_recipient(job,acc,recipient,False,refused[recipient['email']])
+        else:
+            finish_recipient(job,acc,recipient,True,'')
+
+# 活动的收件人有了结果后调用：队列已空、没有在途也没有等待重试的收件人时活动结束
+def settle_job(job,n=1):
+    with SEND_LOCK:
+        job.inflight -= n
+        done = job.status == "running" and not job.inflight and not job.queue and not job.retry
+        if done and not SHARED:
+            job.status,job.finished = "done",time.time()
+            prune_jobs()
+    if done and SHARED:
+        # 多进程时本进程认领的发完了不代表活动结束，由 finish_shared_job 按库中剩余收件人判断并记录日志
+        finish_shared_job(job)
+    elif done:
+        append_log(f"{job.name} 已完成：送达 {job.sent}，跳过 {job.skipped}，失败 {job.dead}")
+    publish_campaigns(force=done)
+
+# ---- 幂等：同一活动对同一邮箱（按 normalize_email 归一）只投递一次 ----
+CAMPAIGN_DELIVERIES = {}    # 活动 -> 已送达的归一邮箱集合，首次用到时从数据库加载
+
+# 幂等键按活动 id 区分：内容相同的新活动（如每周通知）是新的一次投递，不跳过此前收到过的人。
+# 附带的内容摘要只用于崩溃恢复时核对同一活动，id 被重新分配给内容不同的活动时不会误认送达记录
+def campaign_key(job_id,subject,body):
+    return f"{job_id}:"+hashlib.sha1((subject+"\0"+body).encode("utf-8")).hexdigest()[:16]
+
+def campaign_deliveries(campaign):
+    with SEND_LOCK:
+        delivered = CAMPAIGN_DELIVERIES.get(campaign)
+        if delivered is None:
+            delivered = CAMPAIGN_DELIVERIES[campaign] = db_campaign_deliveries(campaign)
+        return delivered
+
+# SMTP 事务前认领收件人：本活动已送达过的直接记为已发送，其余写入在途租约后再发送
+def claim_batch(job,acc,batch):
+    global SENT_COUNT
+    delivered = campaign_deliveries(job.campaign)
+    skipped = [r for r in batch if normalize_email(r.email) in delivered]
+    batch = [r for r in batch if normalize_email(r.email) not in delivered]
+    for recipient in skipped:
+        with SEND_LOCK:
+            SENT_COUNT += 1
+            SENT_EMAILS.add(normalize_email(recipient.email))
+            RECIPIENT_ATTEMPTS.pop(recipient['id'],None)
+            job.skipped += 1
+        db_mark_sent(recipient)
+        append_log(f"跳过 {recipient['email']}：本次活动此前已送达", event="skipped")
+    if skipped: settle_job(job,len(skipped))
+    if batch:
+        leased = db_lease(batch,job.campaign,acc['email'])
+        if len(leased) < len(batch): settle_job(job,len(batch)-len(leased))
+        batch = leased
+    return batch
+
+def personalize(job,acc,recipient):
+    try:
+        return job.message.build(acc['email'],recipient),''
+    except Exception as e:
+        # 同样的数据再试也会失败
+        return None,SendFailure(str(e),"permanent")
+
+def finish_recipient(job,acc,recipient,success,err):
+    global SENT_COUNT
+    if success:
+        with SEND_LOCK:
+            SENT_COUNT += 1
+            SENT_EMAILS.add(normalize_email(recipient.email))
+            RECIPIENT_ATTEMPTS.pop(recipient['id'],None)
+            if job.campaign in CAMPAIGN_DELIVERIES: CAMPAIGN_DELIVERIES[job.campaign].add(normalize_email(recipient.email))
+            job.sent += 1
+        db_mark_sent(recipient,job.campaign,acc['email'])
+        append_log(f"已发送给 {recipient['email']} (使用账号 {acc['email']})", event="sent", account=acc['email'])
+        settle_job(job)
+        return
+    kind = getattr(err,"kind","other")
+    # 认证、网络问题归咎于账号：放回队首换账号重试，不计入收件人的失败次数。
+    # 结果未知的按 INFLIGHT_RECOVERY：requeue 计一次失败后退避重试（至少投递一次），hold 移入失败列表待人工确认
+    counted = kind not in ("auth","network")
+    with SEND_LOCK:
+        FAILURE_COUNTS[kind] += 1
+        per_account = ACCOUNT_FAILURES.setdefault(acc['email'],dict.fromkeys(FAILURE_KINDS,0))
+        per_account[kind] += 1
+        attempts = RECIPIENT_ATTEMPTS.get(recipient['id'],0)+counted
+        dead = kind == "permanent" or (kind == "unknown" and INFLIGHT_RECOVERY == "hold") or attempts >= MAX_RECIPIENT_ATTEMPTS
+        if dead:
+            RECIPIENT_ATTEMPTS.pop(recipient['id'],None)
+            DEAD_EMAILS.add(normalize_email(recipient.email))
+            FAILURE_COUNTS["dead"] += 1
+            job.dead += 1
+        else:
+            if attempts: RECIPIENT_ATTEMPTS[recipient['id']] = attempts
+            FAILURE_COUNTS["retried"] += 1
+    if dead:
+        db_mark_dead(recipient,attempts,str(err))
+        append_log(f"发送失败 {recipient['email']} : {err}，已移入失败列表", event="dead", account=acc['email'])
+    elif counted:
+        # 收件人这边的临时失败（如 4xx 邮箱忙）立即重试大多还会失败，按次数指数退避
+        delay = retry_delay(attempts)
+        append_log(f"发送失败 {recipient['email']} : {err}，{delay:.0f} 秒后重试", event="failed", account=acc['email'])
+        requeue_recipient(recipient,attempts=attempts,error=str(err),job=job,retry_at=time.time()+delay)
+    else:
+        append_log(f"发送失败 {recipient['email']} : {err}", event="failed", account=acc['email'])
+        requeue_recipient(recipient,front=True,attempts=attempts,error=str(err),job=job)
+    settle_job(job)
+
+# 需在持有 SEND_LOCK 时调用：没有可发的活动时登记退出，与 /send 补线程互斥，避免新活动无人发送。
+# 返回是否为最后一个退出的线程
+def leave_send():
+    global IS_SENDING, ACTIVE_WORKERS
+    ACTIVE_WORKERS -= 1
+    if ACTIVE_WORKERS > 0: return False
+    IS_SENDING = any(job.status == "preparing" for job in JOBS.values())
+    return True
 
 def send_worker_loop():
-    global IS_SENDING, PAUSED
-    while SEND_QUEUE:
-        reset_daily_usage_if_needed()
-        task = SEND_QUEUE[0]
-        subject = task["subject"]
-        body = task["body"]
-        interval = task["interval"]
+    while True:
+        with SEND_LOCK:
+            jobs = runnable_jobs()
+            retry_in = None if jobs else next_retry_in()
+            if not jobs and retry_in is None:
+                last = leave_send()
+                break
+            usable = jobs_usable(jobs)
 
         if PAUSED:
             time.sleep(1)
             continue
+        if not jobs:
+            # 只剩等待退避到期或待补充认领的收件人；最多睡 1 秒，期间新建的活动也能及时发出
+            time.sleep(min(retry_in,1))
+            continue
 
-        recipient = None
-        with SEND_LOCK:
-            if RECIPIENTS:
-                recipient = RECIPIENTS.pop(0)
+        acc = get_next_account(1,usable)
+        if not acc:
+            wait_for_account(1,usable)
+            continue
 
+        job,recipient = next_job_recipient(acc)
         if not recipient:
-            break
+            release_account(acc, unused=1)
+            continue
 
-        acc = get_next_account()
-        if not acc:
-            append_log("没有可用账号或账号今日已达上限，等待 60 秒后重试。")
-            time.sleep(60)
-            with SEND_LOCK:
-                RECIPIENTS.insert(0, recipient)
+        batch,reserved = take_batch(job,acc,recipient)
+        batch = claim_batch(job,acc,batch)
+        if not batch:
+            release_account(acc, reserved, unused=reserved)
+            continue
+        if len(batch) > 1:
+            refused, err = send_batch(acc, [r["email"] for r in batch], job.message.build_shared(acc['email']))
+            release_account(acc, reserved, err, reserved-len(batch))
+            finish_batch(job, acc, batch, refused, err)
             continue
 
-        recipient_safe = {
-            "name": recipient.get("name",""),
-            "real_name": recipient.get("real_name","")
-        }
+        recipient = batch[0]
+        payload, err = personalize(job,acc,recipient)
+        success = False
+        if payload is not None:
+            success, err = send_payload(acc, recipient["email"], payload)
+        release_account(acc, reserved, err if payload is not None else None, reserved-1)
+        finish_recipient(job, acc, recipient, success, err)
+
+    # 最后一个退出的发送线程负责收尾
+    if last: close_smtp_pool()
+
+# ================== asyncio 发送后端 ==================
+# SEND_BACKEND=asyncio 时，由一个事件循环同时维持大量 SMTP 会话：
+# 每个账号最多 ASYNC_PER_ACCOUNT 封在途，全局最多 ASYNC_GLOBAL 封在途
+if aiosmtplib is not None:
+    class AsyncTimedSMTP(aiosmtplib.SMTP):
+        data_seconds = 0.0
+        data_started = False
+
+        async def data(self, *args, **kwargs):
+            self.data_started = True
+            start = time.perf_counter()
+            try:
+                return await super().data(*args, **kwargs)
+            finally:
+                self.data_seconds = time.perf_counter()-start
+
+async def async_open_smtp_session(account):
+    endpoint = smtp_endpoint(account)
+    email,host = account['email'],endpoint[0]
+    # 与 smtplib.starttls() 默认行为保持一致，不校验证书；STARTTLS 单独调用以便分阶段计时
+    server = AsyncTimedSMTP(hostname=endpoint[0],port=endpoint[1],timeout=SMTP_TIMEOUT,
+                            start_tls=False,validate_certs=False)
+    t0 = time.perf_counter()
+    await server.connect()
+    try:
+        t1 = time.perf_counter()
+        await server.starttls()
+        t2 = time.perf_counter()
+        await server.login(account['email'],account['app_password'])
+        t3 = time.perf_counter()
+    except:
+        server.close()
+        raise
+    observe_phase("connect",email,host,t1-t0)
+    observe_phase("starttls",email,host,t2-t1)
+    observe_phase("login",email,host,t3-t2)
+    return SMTPSession(account,server,endpoint)
+
+async def async_close_smtp_session(sess):
+    try: await sess.server.quit()
+    except:
+        try: sess.server.close()
+        except: pass
+
+async def async_acquire_smtp(account,pool):
+    while True:
+        idle = pool.get(account['email'])
+        sess = idle.pop() if idle else None
+        if sess is None:
+            return await async_open_smtp_session(account)
+        if sess.app_password != account['app_password'] or sess.endpoint != smtp_endpoint(account):
+            await async_close_smtp_session(sess)
+            continue
+        idle_for = time.time()-sess.last_used
+        if idle_for > SMTP_IDLE_TIMEOUT:
+            await async_close_smtp_session(sess)
+            continue
+        if idle_for > SMTP_NOOP_AFTER:
+            start = time.perf_counter()
+            try: code = (await sess.server.noop()).code
+            except: code = None
+            observe_phase("noop",sess.email,sess.endpoint[0],time.perf_counter()-start)
+            if code != 250:
+                await async_close_smtp_session(sess)
+                continue
+        return sess
+
+async def async_release_smtp(sess,pool):
+    sess.last_used = time.time()
+    if sess.sent >= SMTP_MAX_MSGS_PER_SESSION:
+        await async_close_smtp_session(sess)
+        return
+    pool.setdefault(sess.email,[]).append(sess)
+
+def is_async_smtp_disconnect(e):
+    if isinstance(e,(aiosmtplib.SMTPServerDisconnected,aiosmtplib.SMTPConnectError,ConnectionError)): return True
+    return isinstance(e,aiosmtplib.SMTPResponseException) and e.code==421
+
+async def async_smtp_transaction(account,pool,transaction):
+    for attempt in range(2):
+        sess = None
         try:
-            personalized_subject = subject.format(**recipient_safe)
-            personalized_body = body.format(**recipient_safe)
+            sess = await async_acquire_smtp(account,pool)
+            sess.server.data_seconds,sess.server.data_started = 0.0,False
+            start = time.perf_counter()
+            result = await transaction(sess.server)
+            observe_transaction(sess,time.perf_counter()-start)
+            sess.sent += 1
+            await async_release_smtp(sess,pool)
+            return result,''
         except Exception as e:
-            append_log(f"内容格式错误 {recipient['email']}: {e}")
-            with SEND_LOCK:
-                RECIPIENTS.append(recipient)
+            if sess is not None:
+                if is_async_smtp_disconnect(e) or not isinstance(e,aiosmtplib.SMTPException):
+                    await async_close_smtp_session(sess)
+                else:
+                    await async_release_smtp(sess,pool)
+                if data_unanswered(sess.server,e): return None,unknown_failure(e)
+            if attempt==0 and is_async_smtp_disconnect(e):
+                continue
+            return None,classify_failure(e)
+
+async def async_send_payload(account,to_email,payload,pool):
+    _,err = await async_smtp_transaction(account,pool,lambda server: server.sendmail(account['email'],[to_email],payload))
+    if err: return False,err
+    await asyncio.to_thread(record_usage,account)
+    return True,''
+
+async def async_sendmail_refused(server,from_addr,to_addrs,payload):
+    try:
+        errors,_ = await server.sendmail(from_addr,to_addrs,payload)
+    except aiosmtplib.SMTPRecipientsRefused as e:
+        # 全部被拒时每个收件人按自己的响应码归类；含 421 的按断线重试整批
+        for r in e.recipients:
+            if r.code == 421: raise r
+        return {r.recipient:(r.code,r.message) for r in e.recipients}
+    return {addr:(resp.code,resp.message) for addr,resp in errors.items()}
+
+# 与 send_batch 相同的约定
+async def async_send_batch(account,to_emails,payload,pool):
+    to_emails,failures = split_unencodable(to_emails)
+    if not to_emails: return failures,''
+    refused,err = await async_smtp_transaction(account,pool,lambda server: async_sendmail_refused(server,account['email'],to_emails,payload))
+    if err and batch_failed_for_all(err): return None,err
+    if err:
+        for i,addr in enumerate(to_emails):
+            ok,err = await async_send_payload(account,addr,payload,pool)
+            if ok: continue
+            if batch_failed_for_all(err):
+                fail_remaining(failures,to_emails,i,err)
+                return failures,err
+            failures[addr] = err
+        return failures,''
+    await asyncio.to_thread(record_usage,account,len(to_emails)-len(refused))
+    failures.update(refused_failures(refused))
+    return failures,''
+
+# 取收件人、占配额、释放账号（熔断状态变化要写日志）和记录结果都要拿锁或写库，一律放到线程里，
+# 一次慢的 SQLite 写入不会卡住事件循环上所有进行中的 SMTP 会话
+async def async_deliver(job,acc,recipient,pool,global_sem):
+    try:
+        batch,reserved = await asyncio.to_thread(take_batch, job, acc, recipient)
+        batch = await asyncio.to_thread(claim_batch, job, acc, batch)
+        if not batch:
+            await asyncio.to_thread(release_account, acc, reserved, None, reserved)
+            return
+        if len(batch) > 1:
+            refused, err = await async_send_batch(acc, [r["email"] for r in batch], job.message.build_shared(acc['email']), pool)
+            await asyncio.to_thread(release_account, acc, reserved, err, reserved-len(batch))
+            await asyncio.to_thread(finish_batch, job, acc, batch, refused, err)
+            return
+        recipient = batch[0]
+        payload, err = personalize(job,acc,recipient)
+        success = False
+        if payload is not None:
+            success, err = await async_send_payload(acc, recipient["email"], payload, pool)
+        await asyncio.to_thread(release_account, acc, reserved, err if payload is not None else None, reserved-1)
+        await asyncio.to_thread(finish_recipient, job, acc, recipient, success, err)
+    finally:
+        global_sem.release()
+
+# 返回是否为最后一个退出的发送线程
+async def async_send_loop():
+    global_sem = asyncio.Semaphore(ASYNC_GLOBAL)
+    pool = {}
+    inflight = set()
+    while True:
+        with SEND_LOCK:
+            jobs = runnable_jobs()
+            retry_in = None if jobs else next_retry_in()
+            if not jobs and not inflight and retry_in is None:
+                last = leave_send()
+                break
+            usable = jobs_usable(jobs)
+
+        if PAUSED:
+            await asyncio.sleep(1)
+            continue
+        if not jobs:
+            # 各活动队列已空但仍有在途邮件或等待退避到期的收件人，失败的会重新入队
+            wait = min(retry_in,1) if retry_in is not None else None
+            if inflight:
+                await asyncio.wait(inflight,timeout=wait,return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(wait)
             continue
 
-        success, err = send_email(acc, recipient["email"], personalized_subject, personalized_body)
-        if success:
-            SENT_RECIPIENTS.append(recipient)
-            save_recipients()
-            append_log(f"已发送给 {recipient['email']} (使用账号 {acc['email']})")
-        else:
-            append_log(f"发送失败 {recipient['email']} : {err}")
-            with SEND_LOCK:
-                RECIPIENTS.append(recipient)
+        await global_sem.acquire()
+        acc = get_next_account(ASYNC_PER_ACCOUNT,usable)
+        if not acc:
+            global_sem.release()
+            wait = await asyncio.to_thread(wait_for_account,ASYNC_PER_ACCOUNT,usable,False)
+            start = time.perf_counter()
+            if inflight:
+                await asyncio.wait(inflight,timeout=wait,return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(wait)
+            SCHEDULER_WAIT_SECONDS.inc(n=time.perf_counter()-start)
+            continue
 
-        time.sleep(interval)
+        job,recipient = await asyncio.to_thread(next_job_recipient,acc)
+        if not recipient:
+            await asyncio.to_thread(release_account,acc,1,None,1)
+            global_sem.release()
+            continue
+        t = asyncio.create_task(async_deliver(job,acc,recipient,pool,global_sem))
+        inflight.add(t)
+        t.add_done_callback(inflight.discard)
 
-    IS_SENDING = False
-    with SEND_LOCK:
-        if SEND_QUEUE:
-            SEND_QUEUE.pop(0)
+    for idle in pool.values():
+        for sess in idle:
+            await async_close_smtp_session(sess)
+    return last
+
+def async_send_worker():
+    last = None
+    try:
+        last = asyncio.run(async_send_loop())
+    finally:
+        if last is None:
+            with SEND_LOCK: last = leave_send()
+        if last: close_smtp_pool()
 
 @app.route("/pause-send", methods=["POST"])
 def pause_send():
     global PAUSED
+    if SHARED: db_set_control("paused",1)
     PAUSED = True
     return jsonify({"message":"发送已暂停"})
 
 @app.route("/resume-send", methods=["POST"])
 def resume_send():
     global PAUSED
+    if SHARED: db_set_control("paused",0)
     PAUSED = False
     return jsonify({"message":"发送已继续"})
 
+@app.route("/campaigns")
+def get_campaigns():
+    if SHARED:
+        campaigns = campaign_snapshots()
+        return jsonify({"campaigns":campaigns,"sending":any(c["status"] == "running" for c in campaigns),
+                        "paused":bool(db_get_control("paused",0))})
+    return jsonify({"campaigns":campaign_snapshots(),"sending":IS_SENDING,"paused":PAUSED})
+
+def find_job():
+    try: job_id = int(request.values.get("id") or (request.get_json(silent=True) or {}).get("id"))
+    except (TypeError,ValueError): return None
+    return job_id if SHARED else JOBS.get(job_id)
+
+@app.route("/campaign-status")
+def campaign_status():
+    job = find_job()
+    if SHARED and job is not None:
+        snapshots = db_campaign_snapshots(job)
+        return jsonify(snapshots[0]) if snapshots else (jsonify({"message":"活动不存在"}), 404)
+    if job is None:
+        return jsonify({"message":"活动不存在"}), 404
+    with SEND_LOCK:
+        return jsonify(job.snapshot())
+
+# 取消活动：未发出的收件人回到未分配队列，在途的照常完成
+@app.route("/cancel-campaign", methods=["POST"])
+def cancel_campaign():
+    job = find_job()
+    if SHARED and job is not None:
+        return cancel_shared_campaign(job)
+    if job is None:
+        return jsonify({"message":"活动不存在"}), 404
+    with SEND_LOCK:
+        if job.status not in ("running","preparing"):
+            return jsonify({"message":f"{job.name} 已结束"}), 400
+        job.status,job.finished = "cancelled",time.time()
+        returned = len(job.queue)+len(job.retry)
+        for r in itertools.chain(job.queue,job.retry): RECIPIENTS.append(r)
+        job.queue.clear()
+        job.retry.clear()
+        db_release_job(job.id)
+        prune_jobs()
+    append_log(f"{job.name} 已取消，{returned} 个未发送的收件人回到待发送列表")
+    publish_campaigns(force=True)
+    return jsonify({"message":f"{job.name} 已取消","returned":returned})
+
 
 # ======= 历史日志 / 用量：用于刷新后回放 =======
 @app.route("/get-logs")
 def get_logs():
-    return jsonify({"logs": SEND_LOGS})
+    with LOG_LOCK:
+        expire_logs(time.time())
+        logs = [entry for _,entry,_ in SEND_LOGS]
+        last_event_id = EVENT_BUS.last_id
+    return jsonify({"logs": logs, "last_event_id": last_event_id})
 
 @app.route("/get-usage")
 def get_usage():
-    return jsonify({"usage": account_usage})
+    now = time.time()
+    if SHARED:
+        refresh_accounts()
+        usage = dict(db_execute("SELECT email,SUM(count) FROM usage_minutes WHERE minute>=? GROUP BY email", (usage_cutoff(now),)))
+        return jsonify({"usage": {acc['email']:usage.get(acc['email'],0) for acc in ACCOUNTS}})
+    return jsonify({"usage": {acc['email']:usage_count(acc['email'],now) for acc in ACCOUNTS}})
+
+@app.route("/scheduler")
+def get_scheduler():
+    # web worker 不发送，返回各发送进程最近一次上报的状态
+    if ROLE == "web": return jsonify({"senders": db_sender_states()})
+    max_inflight = ASYNC_PER_ACCOUNT if SEND_BACKEND == "asyncio" and aiosmtplib is not None else 1
+    now = time.time()
+    accounts = []
+    with SCHEDULER:
+        for acc in ACCOUNTS:
+            email = acc['email']
+            ready,reason = account_ready_at(acc,now,max_inflight)
+            account_bucket,_,_ = rate_buckets(acc)
+            breaker = ACCOUNT_BREAKERS.get(email)
+            accounts.append({
+                "email": email,
+                "selected": acc.get("selected",True),
+                "host": smtp_endpoint(acc)[0],
+                "usage": usage_count(email,now),
+                "reserved": ACCOUNTS_RESERVED.get(email,0),
+                "inflight": ACCOUNTS_INFLIGHT.get(email,0),
+                "ready_in": None if ready is None else round(max(ready-now,0),3),
+                "blocked_by": reason,
+                "pace": pace_bucket(acc).snapshot(now),
+                "rate": account_bucket.snapshot(now),
+                "breaker": breaker.snapshot(now) if breaker else None,
+            })
+        earliest = min((now+a["ready_in"] for a in accounts if a["selected"] and a["ready_in"] is not None),default=None)
+        hosts = {host:bucket.snapshot(now) for host,bucket in HOST_BUCKETS.items()}
+        global_bucket = GLOBAL_BUCKET.snapshot(now)
+    return jsonify({
+        "sending": IS_SENDING,
+        "paused": PAUSED,
+        "daily_limit": DAILY_LIMIT,
+        "next_ready_in": None if earliest is None else round(max(earliest-now,0),3),
+        "global": global_bucket,
+        "hosts": hosts,
+        "accounts": accounts,
+    })
+
+@app.route("/failures")
+def get_failures():
+    if ROLE == "web": return jsonify({"senders": db_sender_states()})
+    now = time.time()
+    with SCHEDULER:
+        breakers = {email:breaker.snapshot(now) for email,breaker in ACCOUNT_BREAKERS.items()}
+    with SEND_LOCK:
+        counts = dict(FAILURE_COUNTS)
+        accounts = {email:dict(per_account) for email,per_account in ACCOUNT_FAILURES.items()}
+        dead = len(DEAD_EMAILS)
+        retrying = len(RECIPIENT_ATTEMPTS)
+    return jsonify({"counts":counts,"accounts":accounts,"breakers":breakers,"dead":dead,"retrying":retrying})
+
+# 请求时现算的状态量：队列深度、在途事务、连接池等
+# 多进程时各进程只报告自己的部分：发送进程是本进程认领的队列，web worker 的收件人数量取自数据库
+def metric_gauges():
+    with SEND_LOCK:
+        jobs = [(job.id,job.name,len(job.queue)+len(job.retry),job.inflight) for job in JOBS.values() if job.status in ("preparing","running")]
+        gauges = {"pending":pending_count(),"unassigned":len(RECIPIENTS),"sent":SENT_COUNT,
+                  "dead":len(DEAD_EMAILS),"suppressed":len(SUPPRESSED),"retrying":len(RECIPIENT_ATTEMPTS),
+                  "workers":ACTIVE_WORKERS,"sending":int(IS_SENDING),"paused":int(PAUSED)}
+        failures = dict(FAILURE_COUNTS)
+        account_failures = {email:dict(per_account) for email,per_account in ACCOUNT_FAILURES.items()}
+    if ROLE == "web":
+        gauges.update(db_recipient_counts())
+        gauges["unassigned"] = db_execute("SELECT COUNT(*) FROM recipients WHERE status='pending' AND job IS NULL")[0][0]
+    # web worker 不发送，在途数取自数据库
+    if ROLE != "web":
+        with SCHEDULER:
+            gauges["inflight"] = sum(ACCOUNTS_INFLIGHT.values())
+    with SMTP_POOL_LOCK:
+        gauges["idle_sessions"] = sum(len(idle) for idle in SMTP_POOLS.values())
+    return gauges,jobs,failures,account_failures
+
+@app.route("/metrics")
+def get_metrics():
+    gauges,jobs,failures,account_failures = metric_gauges()
+    lines = []
+    for key,value in gauges.items():
+        lines += [f"# TYPE mailbot_{key} gauge",f"mailbot_{key} {value}"]
+    lines += ["# TYPE mailbot_campaign_pending gauge"]
+    lines += [f"mailbot_campaign_pending{metric_labels([('campaign',id),('name',name)])} {pending}" for id,name,pending,_ in jobs]
+    lines += ["# TYPE mailbot_campaign_inflight gauge"]
+    lines += [f"mailbot_campaign_inflight{metric_labels([('campaign',id),('name',name)])} {inflight}" for id,name,_,inflight in jobs]
+    lines += ["# HELP mailbot_failures_total 本进程启动以来按类别统计的失败、重试和熔断次数","# TYPE mailbot_failures_total counter"]
+    lines += [f"mailbot_failures_total{metric_labels([('kind',kind)])} {n}" for kind,n in failures.items()]
+    lines += ["# TYPE mailbot_account_failures_total counter"]
+    lines += [f"mailbot_account_failures_total{metric_labels([('account',email),('kind',kind)])} {n}"
+              for email,per_account in sorted(account_failures.items()) for kind,n in per_account.items() if n]
+    for metric in (SENT_TOTAL,SCHEDULER_WAIT_SECONDS,SMTP_PHASE_SECONDS,ACCOUNT_PHASE_SECONDS,PERSIST_SECONDS):
+        lines += metric.collect()
+    return Response("\n".join(lines)+"\n",mimetype="text/plain; version=0.0.4")
+
+# /metrics 的 JSON 汇总：各阶段的次数、均值和 p50/p90/p99 估算
+@app.route("/metrics-summary")
+def get_metrics_summary():
+    gauges,jobs,failures,account_failures = metric_gauges()
+    hosts = {}
+    for (phase,host),item in SMTP_PHASE_SECONDS.summary().items():
+        hosts.setdefault(host,{})[phase] = item
+    accounts = {}
+    for (phase,account),item in ACCOUNT_PHASE_SECONDS.summary().items():
+        accounts.setdefault(account,{})[phase] = item
+    return jsonify({
+        "enabled": METRICS_ENABLED,
+        "phases": {phase:item for (phase,),item in SMTP_PHASE_SECONDS.summary(lambda labels: labels[:1]).items()},
+        "hosts": hosts,
+        "accounts": accounts,
+        "persist": {op:item for (op,),item in PERSIST_SECONDS.summary().items()},
+        "sent": {account:n for (account,),n in SENT_TOTAL.snapshot().items()},
+        "scheduler_wait_seconds": round(SCHEDULER_WAIT_SECONDS.snapshot().get((),0.0),3),
+        "failures": failures,
+        "account_failures": account_failures,
+        "queue": gauges,
+        "campaigns": [{"id":id,"name":name,"pending":pending,"inflight":inflight} for id,name,pending,inflight in jobs],
+    })
 
 # ================== 收件人管理 ==================
 @app.route("/recipients", methods=["GET"])
 def get_recipients():
-    return jsonify({"pending": RECIPIENTS, "sent": SENT_RECIPIENTS})
+    status = request.args.get("status","pending")
+    if status not in ("pending","sent","dead"):
+        return jsonify({"message":"status 只能是 pending、sent 或 dead"}), 400
+    try:
+        offset = max(0,int(request.args.get("offset",0)))
+        limit = min(1000,max(1,int(request.args.get("limit",50))))
+        cursor = request.args.get("cursor")
+        cursor = int(cursor) if cursor not in (None,"") else None
+    except ValueError:
+        return jsonify({"message":"分页参数错误"}), 400
+    q = request.args.get("q","").strip()
+    match = request.args.get("match","prefix")
+    # 条目和计数都取自数据库：待发送的按位置排列，即活动域名交错后的发送顺序
+    items,total,next_cursor = db_page_recipients(status,offset,limit,q,match,cursor)
+    counts = db_recipient_counts()
+    if total is None: total = counts[status]
+    return jsonify({"items":items,"total":total,"counts":counts,"offset":offset,"limit":limit,"next_cursor":next_cursor})
+
+# ---- CSV 流式导入：边读边解码边入库，不把整个文件读进内存 ----
+IMPORT_CHUNK_BYTES = 64*1024
+IMPORT_BATCH = 1000
+# 邮箱语法：本地部分 1-64 个字符，不以点开头或结尾、没有连续的点；域名各段为字母数字和连字符，
+# 不以连字符开头或结尾；顶级域为字母或 xn-- 国际化域名；总长不超过 254
+EMAIL_RE = re.compile(r"""
+    (?!\.)(?!.*\.\.)[^@\s,;<>"()\[\]\\]{1,64}(?<!\.)
+    @(?:[^\W_](?:(?:[^\W_]|-){0,61}[^\W_])?\.)+(?:[^\W\d_]{2,63}|xn--(?:[^\W_]|-){1,59})
+""", re.VERBOSE)
+
+def valid_email(email):
+    return len(email) <= 254 and EMAIL_RE.fullmatch(email) is not None
+
+# 根据 BOM 判断 UTF-8(含 BOM)、UTF-16；否则把整个文件按 UTF-8 严格解码一遍（只校验不保留），
+# 任何位置解码失败都按 GB18030（兼容 Excel 导出的 GBK）。只看开头会把前面全是 ASCII 的 GBK 文件当成 UTF-8。
+# 上传的文件已由 werkzeug 缓存在内存或临时文件里，读完后回到开头
+def detect_csv_encoding(stream):
+    chunk = stream.read(IMPORT_CHUNK_BYTES)
+    if chunk.startswith(codecs.BOM_UTF8): encoding = "utf-8-sig"
+    elif chunk.startswith((codecs.BOM_UTF16_LE,codecs.BOM_UTF16_BE)): encoding = "utf-16"
+    else:
+        encoding = "utf-8"
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        try:
+            while chunk:
+                decoder.decode(chunk)
+                chunk = stream.read(IMPORT_CHUNK_BYTES)
+            decoder.decode(b"",final=True)
+        except UnicodeDecodeError:
+            encoding = "gb18030"
+    stream.seek(0)
+    return encoding
+
+# 固定列（email / name / real_name）的表头不区分大小写；其余列保留表头原样，模板中的 {Company} 对应 Company 列
+def csv_column(name):
+    name = name.strip()
+    return name.lower() if name.lower() in RECIPIENT_BASE_KEYS else name
+
+CSV_LINE_RE = re.compile(r"[^\r\n]*(?:\r\n?|\n)")
+
+# 按块增量解码，按 \r、\n、\r\n 切成带换行符的行交给 csv 模块（含老版 Mac Excel 导出的只有 \r 的文件）。
+# 不用 TextIOWrapper：Python 3.10 及以前 werkzeug 给的 SpooledTemporaryFile 没有 readable()，包装时直接报错。
+# 块末尾的 \r 可能和下一块开头的 \n 是同一个换行，留到下一块再切
+def iter_text_lines(stream, encoding):
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    tail = ""
+    while True:
+        chunk = stream.read(IMPORT_CHUNK_BYTES)
+        text = tail+decoder.decode(chunk,final=not chunk)
+        end = 0
+        for m in CSV_LINE_RE.finditer(text):
+            if chunk and m.end() == len(text) and text.endswith("\r"): break
+            yield m.group()
+            end = m.end()
+        tail = text[end:]
+        if not chunk:
+            if tail: yield tail
+            return
+
+def iter_csv_rows(stream, stats):
+    reader = csv.reader(iter_text_lines(stream,detect_csv_encoding(stream)))
+    header = None
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error:
+            stats["bad"] += 1
+            continue
+        if not row or not any(c.strip() for c in row): continue
+        if header is None:
+            header = [csv_column(c) for c in row]
+            continue
+        stats["rows"] += 1
+        yield dict(zip(header,row))
+
+def import_recipients(stream):
+    stats = {"rows":0,"added":0,"duplicate":0,"suppressed":0,"bad":0}
+    batch = []
+    seen = set()
+    # 多进程时没有常驻内存的去重索引：屏蔽名单导入前取一次，库中已有的收件人按批查 email_key 索引；
+    # 本次导入中出现过的留在 seen 里
+    if SHARED: suppressed_keys = db_load_suppressions()
+
+    recorded = set()
+
+    def commit():
+        if SHARED:
+            known = db_known_emails(normalize_email(r.email) for r in batch)
+            if known:
+                kept = [r for r in batch if normalize_email(r.email) not in known]
+                stats["duplicate"] += len(batch)-len(kept)
+                batch[:] = kept
+        # 列名先于收件人写入，导入中途发起的 /send 也能识别这一批的列
+        columns = {k for r in batch if r.extra for k in r.extra}
+        if not columns <= recorded:
+            recorded.update(columns)
+            db_add_import_columns(recorded)
+        db_insert_recipients(batch)
+        if not SHARED:
+            with SEND_LOCK:
+                for r in batch: RECIPIENTS.append(r)
+            seen.clear()
+        stats["added"] += len(batch)
+        batch.clear()
+        send_event({"import": dict(stats)})
+
+    for row in iter_csv_rows(stream, stats):
+        email = (row.get("email") or "").strip()
+        if not valid_email(email):
+            stats["bad"] += 1
+            continue
+        key = normalize_email(email)
+        if SHARED:
+            suppressed,duplicate = key in suppressed_keys,key in seen
+        else:
+            with SEND_LOCK:
+                suppressed = key in SUPPRESSED
+                duplicate = key in seen or is_pending(key) or key in SENT_EMAILS or key in DEAD_EMAILS
+        if suppressed:
+            stats["suppressed"] += 1
+            continue
+        if duplicate:
+            stats["duplicate"] += 1
+            continue
+        seen.add(key)
+        extra = {k:(v or "").strip() for k,v in row.items() if k and k not in RECIPIENT_BASE_KEYS}
+        batch.append(Recipient(email,(row.get("name") or "").strip(),(row.get("real_name") or "").strip(),extra))
+        if len(batch) >= IMPORT_BATCH: commit()
+    if batch: commit()
+    return stats
 
 @app.route("/upload-csv", methods=["POST"])
 def upload_csv():
     file = request.files.get('file')
     if not file:
         return jsonify({"message":"未选择文件"}), 400
-    csv_data = file.read().decode('utf-8').splitlines()
-    reader = csv.DictReader(csv_data)
-    for row in reader:
-        if not row.get("email"):
-            continue
-        RECIPIENTS.append({
-            "email": row.get("email").strip(),
-            "name": row.get("name","").strip(),
-            "real_name": row.get("real_name","").strip()
-        })
-    save_recipients()
-    append_log(f"已导入收件人 {len(RECIPIENTS)} 条（包含历史未发送）。")
-    return jsonify({"message":"CSV 上传成功"})
+    stats = import_recipients(file.stream)
+    if SHARED: pending = db_recipient_counts()["pending"]
+    else:
+        with SEND_LOCK: pending = pending_count()
+    append_log(f"已导入收件人 {stats['added']} 条，重复 {stats['duplicate']} 条，屏蔽 {stats['suppressed']} 条，无效 {stats['bad']} 条，当前未发送 {pending} 条。")
+    send_event({"import": dict(stats, done=True)})
+    return jsonify({"message":f"CSV 上传成功：新增 {stats['added']} 条，重复 {stats['duplicate']} 条，屏蔽 {stats['suppressed']} 条，无效 {stats['bad']} 条", **stats})
 
 @app.route("/delete-recipient", methods=["POST"])
 def delete_recipient():
-    data = request.json
-    email = data.get("email")
-    global RECIPIENTS
-    RECIPIENTS = [r for r in RECIPIENTS if r["email"] != email]
-    save_recipients()
+    email = (request.json or {}).get("email")
+    if not isinstance(email,str) or not email.strip():
+        return jsonify({"message":"缺少收件人邮箱"}), 400
+    if SHARED: db_delete_pending_emails([normalize_email(email)])
+    else:
+        removed = remove_pending([email])
+        db_delete_recipients(removed)
     append_log(f"已删除收件人 {email}")
     return jsonify({"message": f"{email} 已删除"})
 
 @app.route("/clear-recipients", methods=["POST"])
 def clear_recipients():
-    global RECIPIENTS
-    count = len(RECIPIENTS)
-    RECIPIENTS = []
-    save_recipients()
+    if SHARED:
+        count = db_recipient_counts()["pending"]
+        db_delete_pending()
+        append_log(f"已清空未发送收件人 {count} 条")
+        return jsonify({"message":"收件人列表已清空"})
+    with SEND_LOCK:
+        count = pending_count()
+        for queue in pending_queues(): queue.clear()
+        RECIPIENT_ATTEMPTS.clear()
+        jobs = [job for job in JOBS.values() if job.status == "running"]
+    db_delete_pending()
+    for job in jobs: settle_job(job,0)
     append_log(f"已清空未发送收件人 {count} 条")
     return jsonify({"message":"收件人列表已清空"})
 
+@app.route("/retry-dead", methods=["POST"])
+def retry_dead():
+    recipients = db_revive_dead()
+    with SEND_LOCK:
+        if not SHARED:
+            for r in recipients:
+                RECIPIENTS.append(r)
+        DEAD_EMAILS.clear()
+    append_log(f"发送失败的 {len(recipients)} 个收件人已重新排队")
+    return jsonify({"message":f"已重新排队 {len(recipients)} 个收件人"})
+
+# ---- 屏蔽名单：退订、投诉等不再发送的邮箱 ----
+# 加入名单的邮箱同时从待发送队列中删除，返回 (新增条数, 删除的待发送收件人数)
+def suppress_emails(emails, reason=None):
+    keys = {normalize_email(e) for e in emails if valid_email(e.strip())}
+    if SHARED:
+        keys -= db_load_suppressions()
+        if not keys: return 0,0
+        db_add_suppressions(keys, reason)
+        return len(keys),db_delete_pending_emails(keys)
+    with SEND_LOCK:
+        keys -= SUPPRESSED
+    if not keys: return 0,0
+    db_add_suppressions(keys, reason)
+    with SEND_LOCK:
+        SUPPRESSED.update(keys)
+    removed = remove_pending(keys)
+    db_delete_recipients(removed)
+    return len(keys),len(removed)
+
+@app.route("/suppressions")
+def get_suppressions():
+    try:
+        offset = max(0,int(request.args.get("offset",0)))
+        limit = min(1000,max(1,int(request.args.get("limit",50))))
+    except ValueError:
+        return jsonify({"message":"分页参数错误"}), 400
+    rows = db_execute("SELECT email,reason,epoch FROM suppressions ORDER BY epoch DESC,email LIMIT ? OFFSET ?", (limit,offset))
+    items = [{"email":email,"reason":reason,"epoch":epoch} for email,reason,epoch in rows]
+    total = db_execute("SELECT COUNT(*) FROM suppressions")[0][0] if SHARED else len(SUPPRESSED)
+    return jsonify({"items":items,"total":total,"offset":offset,"limit":limit})
+
+@app.route("/suppress", methods=["POST"])
+def suppress():
+    data = request.json
+    emails = data.get("emails") or ([data["email"]] if data.get("email") else [])
+    added,removed = suppress_emails(emails,data.get("reason"))
+    append_log(f"屏蔽名单新增 {added} 个邮箱，删除待发送收件人 {removed} 条")
+    return jsonify({"message":f"已屏蔽 {added} 个邮箱","added":added,"removed":removed})
+
+@app.route("/upload-suppressions", methods=["POST"])
+def upload_suppressions():
+    file = request.files.get('file')
+    if not file:
+        return jsonify({"message":"未选择文件"}), 400
+    stats = {"rows":0,"bad":0}
+    emails = [(row.get("email") or "") for row in iter_csv_rows(file.stream, stats)]
+    added,removed = suppress_emails(emails,request.form.get("reason") or "import")
+    append_log(f"屏蔽名单导入 {stats['rows']} 行，新增 {added} 个邮箱，删除待发送收件人 {removed} 条")
+    return jsonify({"message":f"屏蔽名单导入成功：新增 {added} 个，删除待发送 {removed} 条","added":added,"removed":removed})
+
+@app.route("/delete-suppression", methods=["POST"])
+def delete_suppression():
+    email = normalize_email(request.json.get("email") or "")
+    with SEND_LOCK:
+        SUPPRESSED.discard(email)
+    db_delete_suppression(email)
+    append_log(f"已从屏蔽名单移除 {email}")
+    return jsonify({"message":f"{email} 已移出屏蔽名单"})
+
 @app.route("/download-template")
 def download_template():
     output = StringIO()
@@ -745,13 +3779,18 @@ def download_template():
 def download_recipients():
     status = request.args.get("status","pending")
     if status=="pending":
-        data = RECIPIENTS
+        if SHARED: data = db_load_recipients("pending")
+        else:
+            with SEND_LOCK:
+                data = [r for queue in pending_queues() for r in queue]
         filename="pending.csv"
     else:
-        data = SENT_RECIPIENTS
-        filename="sent.csv"
+        # 已发送和失败列表不常驻内存，从数据库读取
+        if status!="dead": status = "sent"
+        data = db_load_recipients(status)
+        filename=f"{status}.csv"
     output = StringIO()
-    writer = csv.DictWriter(output, fieldnames=["email","name","real_name"])
+    writer = csv.DictWriter(output, fieldnames=["email","name","real_name"], extrasaction="ignore")
     writer.writeheader()
     for r in data:
         writer.writerow(r)
@@ -766,6 +3805,7 @@ def download_recipients():
 # ================== 账号管理 ==================
 @app.route("/accounts")
 def get_accounts():
+    if SHARED: refresh_accounts()
     return jsonify(ACCOUNTS)
 
 @app.route("/toggle-account", methods=["POST"])
@@ -773,10 +3813,14 @@ def toggle_account():
     data = request.json
     email = data.get("email")
     checked = data.get("checked")
+    if SHARED:
+        db_execute("UPDATE accounts SET selected=? WHERE email=?", (int(bool(checked)),email))
+        db_bump_accounts()
     for acc in ACCOUNTS:
         if acc["email"] == email:
             acc["selected"] = bool(checked)
             break
+    accounts_changed()
     append_log(f"账号 {email} 已{ '启用' if checked else '禁用' }")
     return jsonify({"message":"账号状态已更新"})
 
@@ -788,6 +3832,8 @@ def upload_accounts():
     csv_data = file.read().decode('utf-8').splitlines()
     reader = csv.DictReader(csv_data)
     added = 0
+    uploaded = []
+    if SHARED: refresh_accounts()
     for row in reader:
         email = (row.get("email") or "").strip()
         app_password = (row.get("app_password") or "").strip()
@@ -811,9 +3857,10 @@ def upload_accounts():
             ACCOUNTS[existing_idx] = rec
         else:
             ACCOUNTS.append(rec)
-        account_usage.setdefault(email, 0)
+        uploaded.append(rec)
         added += 1
-    save_usage()
+    if SHARED: db_save_accounts(uploaded)
+    accounts_changed()
     append_log(f"已导入/更新账号 {added} 个")
     return jsonify({"message":"账号上传成功"})
 
@@ -822,12 +3869,353 @@ def delete_account():
     data = request.json
     email = data.get("email")
     global ACCOUNTS
+    if SHARED:
+        db_execute("DELETE FROM accounts WHERE email=?", (email,))
+        db_bump_accounts()
+    # 发送计数保留到滚出 24 小时窗口，删除后重新导入同一账号不会重置配额
     ACCOUNTS = [acc for acc in ACCOUNTS if acc["email"] != email]
-    account_usage.pop(email, None)
-    save_usage()
+    with SCHEDULER:
+        ACCOUNT_PACE.pop(email, None)
+        ACCOUNT_BUCKETS.pop(email, None)
+        ACCOUNT_REGISTRY.rebuild()
+        SCHEDULER.notify_all()
+    close_smtp_pool(email)
     append_log(f"已删除账号 {email}")
     return jsonify({"message": f"{email} 已删除"})
 
+# ================== 多进程部署 ==================
+# MAILBOT_ROLE=web：只读写数据库、不发送，可用 gunicorn 起多个 worker（SSE 需要线程 worker，如 -k gthread）；
+# MAILBOT_ROLE=sender：python main.py 启动，只提供监控接口，可起多个进程。
+# 每个账号同一时刻只由一个发送进程负责（account_leases，按存活进程数均分），账号的速率桶、熔断、连接池和 24 小时计数都在该进程内；
+# 活动的收件人分块认领到进程内的队列，发送前再以认领为条件写入在途状态，期间被删除、屏蔽或随活动取消释放的不会发出
+SENDER_STALE = 10           # 发送进程心跳超过该秒数未更新视为已退出
+ACCOUNT_LEASE = 30          # 账号租约秒数：发送进程异常退出后，其他进程最迟这么久后接手它的账号
+EVENT_POLL = 0.2            # web worker 读取共享事件流的间隔秒数
+CAMPAIGN_REFRESH = 1.0      # web worker 随日志推送活动进度的最小间隔秒数
+CAMPAIGN_LIST_LIMIT = 100   # 活动列表最多返回最近这么多个活动
+LEASES_RENEWED = 0
+LIVE_SENDERS = 1            # 存活的发送进程数，认领时按它均分剩余收件人
+REFILL_WANTED = Event()     # 发送线程发现本地队列快取空时置位，唤醒 sender_loop 立即补充认领
+REFILL_MIN_GAP = 0.05       # 两次补充认领的最小间隔秒数，库中已无可认领的收件人时避免空转
+
+# 各状态的收件人数；pending 不含在途的，与 /recipients?status=pending 能翻到的条目一致
+def db_recipient_counts():
+    counts = dict(db_execute("SELECT status,COUNT(*) FROM recipients GROUP BY status"))
+    return {"pending":counts.get("pending",0),"inflight":counts.get("inflight",0),"sent":counts.get("sent",0),
+            "dead":counts.get("dead",0),"suppressed":db_execute("SELECT COUNT(*) FROM suppressions")[0][0]}
+
+# 导入去重用：keys 中已在库中（待发送、在途、已发送、失败）的归一邮箱
+def db_known_emails(keys):
+    return {r[0] for r in db_execute("SELECT DISTINCT email_key FROM recipients WHERE email_key IN (SELECT value FROM json_each(?))",
+                                     (json.dumps(list(keys)),))}
+
+# 按归一邮箱删除待发送收件人（在途的照常完成），返回删除条数。
+# 没有统计信息时查询规划会选 (status,pos) 索引扫全部待发送的，这里指定走 email_key 索引
+def db_delete_pending_emails(keys):
+    return len(db_execute("DELETE FROM recipients INDEXED BY idx_recipients_email_key WHERE status='pending' AND email_key IN (SELECT value FROM json_each(?)) RETURNING id",
+                          (json.dumps(list(keys)),)))
+
+# ---- 活动 ----
+# 已完成的活动在结束时记下送达 / 失败数，其余的按收件人状态现算；跳过的计入送达，域名无效的计入失败
+def db_campaign_snapshots(job_id=None):
+    columns = "id,name,subject,status,priority,interval,accounts,total,created,finished,sent,dead"
+    if job_id is None:
+        rows = db_execute(f"SELECT {columns} FROM campaigns ORDER BY id DESC LIMIT ?", (CAMPAIGN_LIST_LIMIT,))[::-1]
+    else:
+        rows = db_execute(f"SELECT {columns} FROM campaigns WHERE id=?", (job_id,))
+    live = [r[0] for r in rows if r[10] is None]
+    counts = {}
+    if live:
+        for job,status,n in db_execute(f"SELECT job,status,COUNT(*) FROM recipients WHERE job IN ({','.join('?'*len(live))}) GROUP BY job,status", live):
+            counts.setdefault(job,{})[status] = n
+    snapshots = []
+    for job,name,subject,status,priority,interval,accounts,total,created,finished,sent,dead in rows:
+        c = counts.get(job,{})
+        snapshots.append({"id":job,"name":name,"subject":subject,"status":status,"priority":priority,"interval":interval,
+                          "accounts":json.loads(accounts) if accounts else None,"total":total,
+                          "sent":c.get("sent",0) if sent is None else sent,"skipped":0,
+                          "dead":c.get("dead",0) if dead is None else dead,"filtered":0,"domains":0,
+                          "pending":c.get("pending",0),"inflight":c.get("inflight",0),"created":created,"finished":finished})
+    return snapshots
+
+# 新活动接管当前所有未分配的待发送收件人，由发送进程认领发送
+def start_shared_send(name, subject, body, interval, priority, accounts, message):
+    def create(db):
+        job_id = db.execute("INSERT INTO campaigns(name,subject,body,interval,priority,accounts,status,total,created) VALUES (?,?,?,?,?,?,'running',0,?)",
+                            (name,subject,body,interval,priority,json.dumps(sorted(accounts)) if accounts is not None else None,time.time())).lastrowid
+        total = db.execute("UPDATE recipients SET job=? WHERE status='pending' AND job IS NULL", (job_id,)).rowcount
+        if not total:
+            db.execute("DELETE FROM campaigns WHERE id=?", (job_id,))
+            return None
+        db.execute("UPDATE campaigns SET name=?, total=? WHERE id=?", (name or f"活动 {job_id}",total,job_id))
+        # 没有其他进行中的活动时，新活动不沿用之前的暂停
+        if not db.execute("SELECT 1 FROM campaigns WHERE status='running' AND id<>?", (job_id,)).fetchone():
+            db.execute("UPDATE control SET value=0 WHERE key='paused'")
+        return job_id
+    job_id = db_transaction(create)
+    if job_id is None:
+        return jsonify({"message":"没有待分配的收件人，请先导入"}), 400
+    snapshot = db_campaign_snapshots(job_id)[0]
+    append_log(f"{snapshot['name']} 已创建：{snapshot['total']} 个收件人，权重 {priority}" +
+               (f"，限定账号 {len(accounts)} 个" if accounts is not None else ""))
+    if message.shared and SMTP_BATCH_SIZE > 1:
+        append_log(f"主题和正文不含变量，将按每批最多 {SMTP_BATCH_SIZE} 个收件人合并发送")
+    publish_campaigns(force=True)
+    return jsonify({"message":"邮件发送任务已启动","campaign":snapshot})
+
+# 取消后未发出的收件人回到未分配并解除认领，发送进程下次同步时丢弃本地队列；在途的照常完成
+def cancel_shared_campaign(job_id):
+    def cancel(db):
+        row = db.execute("SELECT name,status FROM campaigns WHERE id=?", (job_id,)).fetchone()
+        if row is None or row[1] != "running": return row,0
+        returned = db.execute("UPDATE recipients SET job=NULL, lease_owner=NULL, lease_until=NULL WHERE status='pending' AND job=?", (job_id,)).rowcount
+        db.execute("UPDATE campaigns SET status='cancelled', finished=? WHERE id=?", (time.time(),job_id))
+        return row,returned
+    row,returned = db_transaction(cancel)
+    if row is None:
+        return jsonify({"message":"活动不存在"}), 404
+    if row[1] != "running":
+        return jsonify({"message":f"{row[0]} 已结束"}), 400
+    append_log(f"{row[0]} 已取消，{returned} 个未发送的收件人回到待发送列表")
+    publish_campaigns(force=True)
+    return jsonify({"message":f"{row[0]} 已取消","returned":returned})
+
+# 库中该活动已没有待发送和在途的收件人时记为完成；多个发送进程同时判断时只有一个成功
+def finish_shared_job(job):
+    def finish(db):
+        if db.execute("SELECT 1 FROM recipients WHERE job=? AND status IN ('pending','inflight') LIMIT 1", (job.id,)).fetchone():
+            return None
+        counts = dict(db.execute("SELECT status,COUNT(*) FROM recipients WHERE job=? GROUP BY status", (job.id,)).fetchall())
+        return db.execute("UPDATE campaigns SET status='done', finished=?, sent=?, dead=? WHERE id=? AND status='running' RETURNING sent,dead",
+                          (time.time(),counts.get("sent",0),counts.get("dead",0),job.id)).fetchone()
+    done = db_transaction(finish)
+    if done is None: return
+    with SEND_LOCK:
+        job.status,job.finished = "done",time.time()
+    append_log(f"{job.name} 已完成：送达 {done[0]}，失败 {done[1]}", event="campaign")
+
+# ---- 共享事件流（web worker）----
+# 日志和事件写在 events 表里，每个 web worker 的后台线程按 id 顺序读出，更新本进程的日志窗口后发布到事件总线。
+# events.id 直接作为 SSE 事件 id，浏览器断线后连到任何一个 worker 都能续传
+def load_shared_logs():
+    # 日志窗口和事件流位置取自同一个读事务，之后从该位置续读，不重不漏
+    with DB_LOCK:
+        DB.execute("BEGIN")
+        try:
+            last_id = DB.execute("SELECT COALESCE(MAX(id),0) FROM events").fetchone()[0]
+            rows = DB.execute("SELECT epoch,ts,msg,event,account FROM logs WHERE epoch>? ORDER BY id",(time.time()-LOG_WINDOW,)).fetchall()
+        finally:
+            DB.execute("COMMIT")
+    with LOG_LOCK:
+        load_logs(rows)
+        EVENT_BUS.last_id = EVENT_BUS.start_id = last_id
+
+def event_tail_loop():
+    refreshed = 0
+    while True:
+        try:
+            rows = db_execute("SELECT id,epoch,data FROM events WHERE id>? ORDER BY id LIMIT 1000", (EVENT_BUS.last_id,))
+            if not rows:
+                time.sleep(EVENT_POLL)
+                continue
+            events = [(event_id,epoch,json.loads(data)) for event_id,epoch,data in rows]
+            # 发送日志带动活动进度刷新（限频）；活动状态变化的日志立即刷新
+            logs = [data for _,_,data in events if "log" in data]
+            if logs and not any("campaigns" in data for _,_,data in events) and \
+                    (time.time()-refreshed >= CAMPAIGN_REFRESH or any(data.get("event") == "campaign" for data in logs)):
+                events[-1][2]["campaigns"] = campaign_snapshots()
+                refreshed = time.time()
+            with LOG_LOCK:
+                for event_id,epoch,data in events:
+                    if "log" in data:
+                        event,account = data.pop("event",None),data.pop("account",None)
+                        remember_log(epoch, {"ts":data.pop("ts"),"msg":data["log"]}, account if event == "sent" else None)
+                        data["usage"] = dict(RECENT_USAGE)
+                    EVENT_BUS.publish(data, event_id)
+        except Exception as e:
+            print("读取共享事件失败:", e)
+            time.sleep(1)
+
+# ---- 发送进程 ----
+def sender_state():
+    with SEND_LOCK:
+        campaigns = {job.id:{"queued":len(job.queue),"inflight":job.inflight} for job in JOBS.values() if job.status == "running"}
+        return {"accounts":sorted(HELD_ACCOUNTS),"workers":ACTIVE_WORKERS,"paused":PAUSED,"sent":SENT_COUNT,
+                "campaigns":campaigns,"failures":dict(FAILURE_COUNTS)}
+
+def db_sender_states():
+    now = time.time()
+    return [dict(json.loads(state or "{}"),id=sender,heartbeat_age=round(now-heartbeat,1))
+            for sender,heartbeat,state in db_execute("SELECT id,heartbeat,state FROM senders WHERE heartbeat>? ORDER BY id", (now-SENDER_STALE,))]
+
+# 按存活的发送进程数均分选中的账号：续租自己的，超出份额的放掉，不足时抢占无人持有或租约已过期的
+def sync_accounts(now):
+    global HELD_ACCOUNTS, LIVE_SENDERS
+    # 交出账号前先写回计数，接手的进程读到的是最新值
+    flush_usage()
+    changed = refresh_accounts()
+    selected = [acc['email'] for acc in ACCOUNTS if acc.get("selected",True)]
+    live = db_execute("SELECT COUNT(*) FROM senders WHERE heartbeat>?", (now-SENDER_STALE,))[0][0]
+    LIVE_SENDERS = max(1,live)
+    share = -(-len(selected)//max(1,live))
+    leases = dict(db_execute("SELECT email,owner FROM account_leases WHERE lease_until>=?", (now,)))
+    keep = [email for email in selected if leases.get(email) == SENDER_ID][:share]
+    until = now+ACCOUNT_LEASE
+    claimed = [email for email in selected if email not in leases][:max(0,share-len(keep))]
+    claimed = [email for email in claimed if db_execute(
+        """INSERT INTO account_leases(email,owner,lease_until) VALUES (?,?,?)
+           ON CONFLICT(email) DO UPDATE SET owner=excluded.owner, lease_until=excluded.lease_until WHERE account_leases.lease_until<?
+           RETURNING email""", (email,SENDER_ID,until,now))]
+    held = set(keep)|set(claimed)
+    # 不再负责的账号等在途事务结束后才交出，避免两个进程同时用它发送、各记各的计数
+    with ACCOUNT_LOCK:
+        draining = {email for email,owner in leases.items() if owner == SENDER_ID and email not in held and ACCOUNTS_INFLIGHT.get(email)}
+    db_executemany("UPDATE account_leases SET lease_until=? WHERE email=? AND owner=?", [(until,email,SENDER_ID) for email in held|draining])
+    db_execute("DELETE FROM account_leases WHERE owner=? AND email NOT IN (SELECT value FROM json_each(?))", (SENDER_ID,json.dumps(sorted(held|draining))))
+    if held == HELD_ACCOUNTS and not changed: return
+    # 接手的账号以库中的 24 小时计数为准
+    gained = held-HELD_ACCOUNTS
+    load_usage(gained)
+    lost = HELD_ACCOUNTS-held
+    HELD_ACCOUNTS = held
+    for email in lost: close_smtp_pool(email)
+    accounts_changed()
+    if gained or lost:
+        append_log(f"发送进程 {SENDER_ID} 负责账号 {len(held)} 个（新增 {len(gained)}，交出 {len(lost)}）")
+
+# 本进程这次为活动认领多少个：按本进程能用于该活动的账号数估算处理能力，
+# 且不超过库中可认领的收件人按存活发送进程均分的份额，避免一个进程认领走整个活动而其他进程空转。
+# 本进程没有能用于该活动的账号时返回 None
+def claim_size(job):
+    now = time.time()
+    ready = sum(1 for acc in ACCOUNTS if sending_account(acc) and job.allows(acc['email']) and usage_count(acc['email'],now) < DAILY_LIMIT)
+    capacity = ready*CLAIM_PER_ACCOUNT*(SMTP_BATCH_SIZE if job.message.shared else 1)
+    if not capacity: return None
+    unclaimed = db_execute("""SELECT COUNT(*) FROM recipients WHERE job=? AND status='pending' AND (lease_until IS NULL OR lease_until<?)
+                              AND (retry_at IS NULL OR retry_at<=?)""", (job.id, now, now))[0][0]
+    return min(CLAIM_BATCH,capacity,-(-unclaimed//LIVE_SENDERS))
+
+# 需在持有 SEND_LOCK 时调用：多进程时本地队列低于上次认领量的一半就唤醒 sender_loop 补充认领
+def want_refill(job):
+    if SHARED and len(job.queue)*2 < job.claim_size: REFILL_WANTED.set()
+
+# 从库中认领一批收件人，把本地队列补到 claim_size；域名预检和按域名打散在每批内进行
+def refill_job(job):
+    with SEND_LOCK:
+        if job.status != "running" or (job.claim_size and len(job.queue)*2 >= job.claim_size): return
+    size = claim_size(job)
+    # 本进程没有能用于该活动的账号时不认领，留给其他进程
+    if size is None: return
+    with SEND_LOCK:
+        job.claim_size = size
+        n = size-len(job.queue)
+    # 库中已无可认领的收件人时检查活动是否结束
+    recipients,attempts = db_claim_recipients(job.id,n) if n > 0 else ([],{})
+    if not recipients:
+        with SEND_LOCK:
+            idle = not job.queue and not job.inflight
+        if idle: finish_shared_job(job)
+        return
+    blocked = blocked_domains(job,{recipient_domain(r) for r in recipients})
+    undeliverable = [(r,f"收件域名无法投递：{blocked[recipient_domain(r)]}") for r in recipients if recipient_domain(r) in blocked]
+    kept = interleave_domains([r for r in recipients if recipient_domain(r) not in blocked])
+    with SEND_LOCK:
+        running = job.status == "running"
+        if running:
+            for r in kept: job.queue.append(r)
+            RECIPIENT_ATTEMPTS.update(attempts)
+            job.total += len(recipients)
+            job.filtered += len(undeliverable)
+            job.dead += len(undeliverable)
+            FAILURE_COUNTS["dead"] += len(undeliverable)
+    if not running:
+        db_release_claims(recipients)
+        return
+    db_reorder(kept)
+    if undeliverable:
+        db_mark_dead_many(undeliverable)
+        append_log(f"{job.name} 域名预检：{len(undeliverable)} 个收件人的域名无法投递（{'、'.join(sorted(blocked)[:5])}），已移入失败列表")
+
+# 与库中进行中的活动对齐：新活动建本地队列，已取消 / 已完成的丢弃本地队列，进行中的补充认领
+def sync_jobs():
+    running = {row[0]:row for row in db_execute("SELECT id,name,subject,body,interval,priority,accounts FROM campaigns WHERE status='running'")}
+    with SEND_LOCK:
+        ended = [job for job in JOBS.values() if job.status == "running" and job.id not in running]
+        added = [row for job_id,row in running.items() if job_id not in JOBS]
+        for job_id in [job.id for job in JOBS.values() if job.status != "running" and not job.inflight]:
+            CAMPAIGN_DELIVERIES.pop(JOBS.pop(job_id).campaign,None)
+    for job in ended:
+        rows = db_execute("SELECT status,finished FROM campaigns WHERE id=?", (job.id,))
+        with SEND_LOCK:
+            job.status,job.finished = rows[0] if rows else ("cancelled",time.time())
+            dropped = list(job.queue)
+            job.queue.clear()
+        db_release_claims(dropped)
+    for job_id,name,subject,body,interval,priority,accounts in added:
+        try:
+            message = MessageFactory(CompiledTemplate(subject),CompiledTemplate(body))
+        except TemplateError as e:
+            append_log(f"{name} 模板无效，无法发送：{e}")
+            continue
+        job = CampaignJob(job_id,name,subject,body,message,interval,priority,set(json.loads(accounts)) if accounts else None)
+        job.status = "running"
+        with SEND_LOCK:
+            JOBS[job_id] = job
+    refill_jobs()
+
+def refill_jobs():
+    with SEND_LOCK:
+        jobs = [job for job in JOBS.values() if job.status == "running"]
+    for job in jobs: refill_job(job)
+
+def sender_sync():
+    global PAUSED, LEASES_RENEWED
+    now = time.time()
+    db_execute("""INSERT INTO senders(id,heartbeat,state) VALUES (?,?,?)
+                  ON CONFLICT(id) DO UPDATE SET heartbeat=excluded.heartbeat, state=excluded.state""",
+               (SENDER_ID,now,json.dumps(sender_state(),ensure_ascii=False)))
+    db_execute("DELETE FROM senders WHERE heartbeat<?", (now-SENDER_STALE*6,))
+    PAUSED = bool(db_get_control("paused",0))
+    sync_accounts(now)
+    # 其他发送进程异常退出时留下的在途收件人，租约到期后回收
+    delivered,unknown = recover_inflight(now)
+    if delivered or unknown:
+        action = "移入失败列表待确认" if INFLIGHT_RECOVERY == "hold" else "放回队首重新发送"
+        append_log(f"回收租约到期的在途收件人：{delivered} 个已确认送达，{unknown} 个结果未知，已{action}")
+    if now-LEASES_RENEWED >= LEASE_SECONDS/3:
+        db_renew_leases()
+        LEASES_RENEWED = now
+    sync_jobs()
+    if HELD_ACCOUNTS: start_workers()
+
+# 每 SENDER_POLL 秒完整同步一次；其间发送线程的本地队列快取空时只补充认领（认领量按处理能力计，不多拿）
+def sender_loop():
+    append_log(f"发送进程 {SENDER_ID} 已启动")
+    synced = 0.0
+    while True:
+        REFILL_WANTED.wait(max(0.0,synced+SENDER_POLL-time.time()))
+        REFILL_WANTED.clear()
+        try:
+            if time.time()-synced >= SENDER_POLL:
+                synced = time.time()
+                sender_sync()
+            else:
+                refill_jobs()
+                if HELD_ACCOUNTS: start_workers()
+                time.sleep(REFILL_MIN_GAP)
+        except Exception as e:
+            print("发送进程同步失败:", e)
+
+# 正常退出时交出账号和认领的收件人，其他进程立即接手；在途的等租约到期后回收
+def leave_shared():
+    db_release_claims()
+    db_execute("DELETE FROM account_leases WHERE owner=?", (SENDER_ID,))
+    db_execute("DELETE FROM senders WHERE id=?", (SENDER_ID,))
+
+if ROLE == "web":
+    load_shared_logs()
+    Thread(target=event_tail_loop, daemon=True).start()
+
 # ================== Keep Alive ==================
 @app.route("/ping")
 def ping():
@@ -846,12 +4234,20 @@ def keep_alive():
     t.start()
 
 # ================== 启动 ==================
+# 发送进程只提供监控接口
+sender_app = Flask(__name__)
+for _rule,_view in (("/metrics",get_metrics),("/metrics-summary",get_metrics_summary),("/scheduler",get_scheduler),
+                    ("/failures",get_failures),("/domains",get_domains),("/ping",ping)):
+    sender_app.add_url_rule(_rule, view_func=_view)
+
 if __name__ == "__main__":
-    for acc in ACCOUNTS:
-        account_usage.setdefault(acc["email"], 0)
-    save_usage()
     port = int(os.environ.get("PORT", 10000))
 
-    keep_alive()   # <-- 在这里启动自 ping 线程
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    if ROLE == "sender":
+        Thread(target=sender_loop, daemon=True).start()
+        sender_app.run(host="0.0.0.0", port=port, threaded=True)
+    else:
+        keep_alive()   # <-- 在这里启动自 ping 线程
 
-    app.run(host="0.0.0.0", port=port, threaded=True)
+        app.run(host="0.0.0.0", port=port, threaded=True)
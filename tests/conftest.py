@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import FakeSMTPServer, load_app  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def smtp_server():
+    server = FakeSMTPServer().start()
+    yield server
+    server.stop()
+
+
+# main 在导入时读取环境变量、打开数据库，整个测试会话只导入一次
+@pytest.fixture(scope="session")
+def main(smtp_server):
+    main = load_app(2, smtp_server.port, tempfile.mkdtemp(prefix="mailbot_test_"))
+    main.DAILY_LIMIT = 10**9
+    main.RETRY_BASE = 0.05
+    main.RETRY_MAX = 0.2
+    return main
+
+
+@pytest.fixture
+def client(main):
+    return main.app.test_client()
@@ -0,0 +1,341 @@
+import itertools
+import time
+from io import BytesIO
+
+import pytest
+
+SEQ = itertools.count()
+
+
+def wait_until(cond, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cond():
+            return
+        time.sleep(0.02)
+    raise AssertionError("timed out")
+
+
+def upload(client, rows, header="email,name,real_name"):
+    data = (header + "\n" + "".join(row + "\n" for row in rows)).encode("utf-8")
+    resp = client.post("/upload-csv", data={"file": (BytesIO(data), "r.csv")}, content_type="multipart/form-data")
+    return resp.get_json()
+
+
+def send_campaign(main, client, subject="Hi {name}", body="Hello {real_name}"):
+    resp = client.post("/send", json={"subject": subject, "body": body, "interval": 0})
+    assert resp.status_code == 200, resp.get_json()
+    wait_until(lambda: not main.IS_SENDING)
+    return resp.get_json()["campaign"]["id"]
+
+
+def status_of(main, email):
+    rows = main.db_execute("SELECT status,attempts FROM recipients WHERE email=? ORDER BY id DESC LIMIT 1", (email,))
+    return rows[0] if rows else None
+
+
+def delivered_to(smtp_server, email):
+    return sum(email in rcpts for rcpts, _ in smtp_server.messages)
+
+
+@pytest.fixture(params=["thread", "asyncio"])
+def backend(request, main, smtp_server):
+    main.SEND_BACKEND = request.param
+    yield request.param
+    # 还原假服务器和熔断器，后面的用例从干净的账号状态开始
+    smtp_server.reject.clear()
+    smtp_server.tempfail.clear()
+    smtp_server.drop_after_data.clear()
+    smtp_server.drop_after = None
+    smtp_server.auth_fail = False
+    smtp_server.batch_reject = False
+    wait_until(lambda: not main.IS_SENDING)
+    main.close_smtp_pool()
+    with main.SCHEDULER:
+        main.ACCOUNT_BREAKERS.clear()
+    main.accounts_changed()
+
+
+# 每个用例用不同的邮箱，避免被此前已发送 / 失败的记录在导入时去重
+def emails(backend, n):
+    batch = next(SEQ)
+    return [f"{backend}.{batch}.{i}@ok.test" for i in range(n)]
+
+
+def test_delivers_personalized(main, client, smtp_server, backend):
+    to = emails(backend, 5)
+    assert upload(client, [f"{e},N{i},R{i}" for i, e in enumerate(to)])["added"] == 5
+    send_campaign(main, client)
+    for i, e in enumerate(to):
+        assert status_of(main, e) == ("sent", 0)
+        payload = next(data for rcpts, data in smtp_server.messages if rcpts == [e])
+        assert f"To: {e}".encode() in payload
+
+
+def test_shared_content_is_batched(main, client, smtp_server, backend):
+    # asyncio 后端每个账号先并发取出若干收件人，人数要多于并发数才能凑成批
+    to = emails(backend, 60)
+    upload(client, to)
+    before = len(smtp_server.messages)
+    send_campaign(main, client, subject="Notice", body="Same for everyone")
+    assert all(status_of(main, e)[0] == "sent" for e in to)
+    assert len(smtp_server.messages) - before < len(to)
+
+
+def test_rcpt_550_is_dead_others_delivered(main, client, smtp_server, backend):
+    to = emails(backend, 4)
+    smtp_server.reject.add(to[1])
+    upload(client, to)
+    send_campaign(main, client)
+    assert status_of(main, to[1])[0] == "dead"
+    assert delivered_to(smtp_server, to[1]) == 0
+    assert all(status_of(main, e)[0] == "sent" for e in to if e != to[1])
+
+
+def test_rcpt_450_retried_until_dead(main, client, smtp_server, backend):
+    to = emails(backend, 2)
+    smtp_server.tempfail.add(to[0])
+    upload(client, to)
+    send_campaign(main, client)
+    assert status_of(main, to[0]) == ("dead", main.MAX_RECIPIENT_ATTEMPTS)
+    assert status_of(main, to[1]) == ("sent", 0)
+
+
+def test_421_reconnects(main, client, smtp_server, backend):
+    to = emails(backend, 6)
+    smtp_server.drop_after = 1
+    connections = smtp_server.connections
+    upload(client, to)
+    send_campaign(main, client)
+    assert all(status_of(main, e) == ("sent", 0) for e in to)
+    assert all(delivered_to(smtp_server, e) == 1 for e in to)
+    assert smtp_server.connections - connections >= len(to)
+
+
+# DATA 之后连接断开：邮件可能已送达，不重连重发；INFLIGHT_RECOVERY=hold 时移入失败列表
+def test_disconnect_after_data_is_not_resent(main, client, smtp_server, backend, monkeypatch):
+    monkeypatch.setattr(main, "INFLIGHT_RECOVERY", "hold")
+    to = emails(backend, 3)
+    smtp_server.drop_after_data.add(to[1])
+    upload(client, [f"{e},N,R" for e in to])
+    send_campaign(main, client)
+    assert status_of(main, to[1]) == ("dead", 1)
+    assert "结果未知" in main.db_execute("SELECT last_error FROM recipients WHERE email=?", (to[1],))[0][0]
+    assert all(delivered_to(smtp_server, e) == 1 for e in to)
+    assert status_of(main, to[0])[0] == status_of(main, to[2])[0] == "sent"
+
+
+def test_auth_failure_trips_breaker_without_charging_recipients(main, client, smtp_server, backend):
+    to = emails(backend, 2)
+    smtp_server.auth_fail = True
+    main.close_smtp_pool()
+    upload(client, to)
+    resp = client.post("/send", json={"subject": "Hi {name}", "body": "x", "interval": 0})
+    assert resp.status_code == 200
+    wait_until(lambda: len(main.ACCOUNT_BREAKERS) == len(main.ACCOUNTS)
+               and all(b.state == "open" for b in main.ACCOUNT_BREAKERS.values()))
+    # 熔断在账号归还时发生，收件人稍后才放回队列
+    wait_until(lambda: all(status_of(main, e)[0] == "pending" for e in to))
+    assert [status_of(main, e) for e in to] == [("pending", 0)] * len(to)
+
+    smtp_server.auth_fail = False
+    with main.SCHEDULER:
+        main.ACCOUNT_BREAKERS.clear()
+    main.accounts_changed()
+    wait_until(lambda: not main.IS_SENDING)
+    assert all(status_of(main, e) == ("sent", 0) for e in to)
+
+
+def test_classify_failure(main):
+    try:
+        "ünï@ok.test".encode("ascii")
+    except UnicodeEncodeError as e:
+        assert main.classify_failure(e).kind == "permanent"
+    assert main.classify_failure(ConnectionResetError()).kind == "network"
+    assert main.classify_failure(main.smtplib.SMTPResponseException(451, b"try later")).kind == "transient"
+    assert main.classify_failure(main.smtplib.SMTPAuthenticationError(535, b"bad")).kind == "auth"
+    assert main.classify_failure(RuntimeError("boom")).kind == "other"
+
+
+def test_non_ascii_recipient_is_dead_after_one_attempt(main, client, smtp_server, backend):
+    to = [f"ü{next(SEQ)}@ok.test"]
+    upload(client, to)
+    send_campaign(main, client)
+    assert status_of(main, to[0]) == ("dead", 1)
+
+
+# 合并发送中个别地址不能编码时只有它失败，同批其他收件人照常送达、不计失败次数
+def test_non_ascii_recipient_does_not_fail_batch(main, client, smtp_server, backend):
+    batch = next(SEQ)
+    good = [f"{backend}.{batch}.{i}@ok.test" for i in range(60)]
+    bad = [f"ü{backend}.{batch}.{i}@ok.test" for i in range(3)]
+    upload(client, good[:20] + bad + good[20:])
+    send_campaign(main, client, subject="Notice", body="Same for everyone")
+    assert all(status_of(main, e) == ("sent", 0) for e in good)
+    assert all(status_of(main, e) == ("dead", 1) for e in bad)
+
+
+# 整批都被拒时每个收件人按自己的响应码归类：550 直接失败，450 退避重试
+def test_all_refused_classified_per_recipient(main, client, smtp_server, backend):
+    batch = next(SEQ)
+    rejected = [f"{backend}.{batch}.r{i}@ok.test" for i in range(30)]
+    busy = [f"{backend}.{batch}.b{i}@ok.test" for i in range(30)]
+    smtp_server.reject.update(rejected)
+    smtp_server.tempfail.update(busy)
+    upload(client, [e for pair in zip(busy, rejected) for e in pair])
+    send_campaign(main, client, subject="Notice", body="Same for everyone")
+    assert all(status_of(main, e) == ("dead", 1) for e in rejected)
+    assert all(status_of(main, e) == ("dead", main.MAX_RECIPIENT_ATTEMPTS) for e in busy)
+
+
+# DATA 被拒是整批事务的失败，逐个重发后只按各自的结果计次
+def test_data_failure_falls_back_to_single_sends(main, client, smtp_server, backend):
+    to = emails(backend, 60)
+    smtp_server.batch_reject = True
+    upload(client, to)
+    send_campaign(main, client, subject="Notice", body="Same for everyone")
+    assert all(status_of(main, e) == ("sent", 0) for e in to)
+    assert all(delivered_to(smtp_server, e) == 1 for e in to)
+
+
+# 内容相同的新活动是新的一次投递；幂等只针对同一活动
+def test_campaign_key_is_per_job(main):
+    assert main.campaign_key(1, "s", "b") != main.campaign_key(2, "s", "b")
+    assert main.campaign_key(1, "s", "b") != main.campaign_key(1, "s", "c")
+
+
+def test_delivered_lookup_is_normalized(main):
+    batch = next(SEQ)
+    job = main.CampaignJob(10**6 + batch, "", "s", "b", None, 0)
+    acc = main.ACCOUNTS[0]
+    first = main.Recipient(f"Mixed.{batch}@OK.test")
+    again = main.Recipient(f" mixed.{batch}@ok.test")
+    main.db_insert_recipients([first, again])
+    main.db_mark_sent(first, job.campaign, acc["email"])
+
+    job.inflight += 1
+    assert main.claim_batch(job, acc, [again]) == []
+    assert job.skipped == 1
+    assert status_of(main, again.email) == ("sent", 0)
+
+
+def test_recover_inflight_matches_normalized_delivery(main):
+    batch = next(SEQ)
+    job = main.CampaignJob(2 * 10**6 + batch, "", "s", "b", None, 0)
+    sent = main.Recipient(f"recover.{batch}@ok.test")
+    inflight = main.Recipient(f"Recover.{batch}@OK.test")
+    main.db_insert_recipients([sent, inflight])
+    main.db_mark_sent(sent, job.campaign, "acc")
+    main.db_lease([inflight], job.campaign, "acc")
+    assert main.recover_inflight() == (1, 0)
+    assert status_of(main, inflight.email) == ("sent", 0)
+
+
+# 模板变量按导入时记录的列名校验；清空待发送收件人后列名一并清除
+def test_send_checks_placeholders_against_imported_columns(main, client):
+    to = emails("columns", 2)
+    upload(client, [f"{e},N,R,ACME" for e in to], header="email,name,real_name,Company")
+    assert "Company" in main.db_import_columns()
+    resp = client.post("/send", json={"subject": "{nmae}", "body": "{Company}", "interval": 0})
+    assert resp.status_code == 400
+    assert resp.get_json()["unknown"] == ["nmae"]
+
+    client.post("/clear-recipients")
+    resp = client.post("/send", json={"subject": "Hi", "body": "{Company}", "interval": 0})
+    assert resp.get_json()["unknown"] == ["Company"]
+
+
+# 待发送列表按实际发送顺序（域名交错后）分页，计数与条目同源
+def test_pending_page_follows_dispatch_order(main, client):
+    batch = next(SEQ)
+    recipients = [main.Recipient(f"order.{batch}.{i}@{d}.test") for d in ("a", "b", "c") for i in range(3)]
+    main.db_insert_recipients(recipients)
+    job = main.CampaignJob(3 * 10**6 + batch, "", "s", "b", None, 0)
+    job.queue = main.PendingQueue(recipients)
+    main.prepare_job(job)
+    dispatch = [r.id for r in job.queue]
+    assert dispatch != [r.id for r in recipients]
+
+    data = client.get("/recipients", query_string={"status": "pending", "limit": 1000}).get_json()
+    assert [item["id"] for item in data["items"] if item["email"].startswith(f"order.{batch}.")] == dispatch
+    assert data["total"] == data["counts"]["pending"] == len(data["items"])
+    main.db_delete_recipients(recipients)
+
+
+# 单进程时已结束的活动只保留最近 CAMPAIGN_LIST_LIMIT 个
+def test_finished_jobs_are_pruned(main, client, monkeypatch):
+    monkeypatch.setattr(main, "CAMPAIGN_LIST_LIMIT", 2)
+    ids = []
+    for _ in range(4):
+        upload(client, emails("prune", 1))
+        ids.append(send_campaign(main, client))
+    with main.SEND_LOCK:
+        finished = [job.id for job in main.JOBS.values() if job.status in ("done", "cancelled")]
+        assert finished == ids[-2:]
+        assert not any(main.JOBS[i].campaign in main.CAMPAIGN_DELIVERIES for i in finished)
+    assert [c["id"] for c in client.get("/campaigns").get_json()["campaigns"]][-2:] == ids[-2:]
+
+
+# 导入时先写库再入队：/send 只把真正接管的收件人划给活动，写了库还没入队的仍是未分配
+def test_send_assigns_only_taken_recipients(main, client):
+    (taken,) = emails("assign", 1)
+    upload(client, [taken])
+    importing = [main.Recipient(e) for e in emails("assign", 2)]
+    main.db_insert_recipients(importing)
+    job_id = send_campaign(main, client)
+    rows = main.db_execute("SELECT email,job FROM recipients WHERE id IN (?,?)", [r.id for r in importing])
+    assert rows == [(r.email, None) for r in importing]
+    assert main.db_execute("SELECT status,job FROM recipients WHERE email=?", (taken,)) == [("sent", job_id)]
+    main.db_delete_recipients(importing)
+
+
+# 队列快空时合并发送取到的收件人少于占用的配额：多占的配额和令牌立即归还，事务没发生时整体归还
+def test_short_batch_refunds_quota(main, monkeypatch):
+    from types import SimpleNamespace
+    acc = main.ACCOUNTS[0]
+    bucket = main.TokenBucket(1, 100)
+    monkeypatch.setitem(main.ACCOUNT_BUCKETS, acc["email"], bucket)
+    monkeypatch.setattr(main, "ACCOUNTS_RESERVED", {acc["email"]: 1})
+    monkeypatch.setattr(main, "ACCOUNTS_INFLIGHT", {acc["email"]: 1})
+    job = main.CampaignJob(4 * 10**6, "", "s", "b", SimpleNamespace(shared=True), 0)
+    first, *rest = [main.Recipient(f"refund.{i}@ok.test") for i in range(3)]
+    job.queue = main.PendingQueue(rest)
+    batch, reserved = main.take_batch(job, acc, first)
+    assert len(batch) == reserved == 3
+    assert main.ACCOUNTS_RESERVED[acc["email"]] == 3
+    assert bucket.available(time.time()) == pytest.approx(100 - 2, abs=0.5)
+    main.release_account(acc, reserved, None, reserved)
+    assert acc["email"] not in main.ACCOUNTS_RESERVED
+    assert bucket.available(time.time()) == pytest.approx(100)
+
+
+# 删除账号不清除 24 小时发送计数，删除后重新导入不会重置配额
+def test_delete_account_keeps_usage(main, client):
+    email = "removed@example.com"
+    main.add_usage(email, 5)
+    main.flush_usage()
+    assert client.post("/delete-account", json={"email": email}).status_code == 200
+    assert main.usage_count(email) == 5
+    assert main.db_execute("SELECT SUM(count) FROM usage_minutes WHERE email=?", (email,)) == [(5,)]
+
+
+# /recipients 的邮箱搜索按归一邮箱匹配，不区分大小写
+def test_recipient_search_ignores_case(client):
+    batch = next(SEQ)
+    email = f"Search.{batch}.Case@OK.test"
+    upload(client, [email])
+    for q, match in ((f"search.{batch}.", "prefix"), (f"SEARCH.{batch}.CASE@", "prefix"), (f"{batch}.case@ok", "substring")):
+        data = client.get("/recipients", query_string={"status": "pending", "q": q, "match": match}).get_json()
+        assert [item["email"] for item in data["items"]] == [email], (q, match)
+        assert data["total"] == 1
+    client.post("/delete-recipient", json={"email": email})
+
+
+# 空闲时没有新日志触发淘汰，读取时也要按 24 小时窗口过滤
+def test_get_logs_drops_expired_entries(main, client):
+    old = {"ts": "old", "msg": "expired entry"}
+    with main.LOG_LOCK:
+        main.SEND_LOGS.appendleft((time.time() - main.LOG_WINDOW - 1, old, None))
+    logs = client.get("/get-logs").get_json()["logs"]
+    assert old not in logs
+    assert all(epoch > time.time() - main.LOG_WINDOW for epoch, _, _ in main.SEND_LOGS)
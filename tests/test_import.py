@@ -0,0 +1,85 @@
+import itertools
+from io import BytesIO
+
+SEQ = itertools.count()
+
+
+def upload_bytes(client, data):
+    resp = client.post("/upload-csv", data={"file": (BytesIO(data), "r.csv")}, content_type="multipart/form-data")
+    return resp.get_json()
+
+
+def recipient(main, email):
+    rows = main.db_execute("SELECT name,real_name FROM recipients WHERE email=?", (email,))
+    return rows[0] if rows else None
+
+
+def addresses(n):
+    batch = next(SEQ)
+    return [f"import.{batch}.{i}@ok.test" for i in range(n)]
+
+
+def test_line_endings(main, client):
+    for sep in ("\r", "\n", "\r\n"):
+        a, b = addresses(2)
+        result = upload_bytes(client, sep.join(["email,name", f"{a},甲", f"{b},乙"]).encode("utf-8"))
+        assert (result["rows"], result["added"], result["bad"]) == (2, 2, 0), sep
+        assert recipient(main, b) == ("乙", "")
+
+
+def test_quoted_newline_kept_in_field(main, client):
+    (a,) = addresses(1)
+    upload_bytes(client, f'email,name\r{a},"two\rlines"\r'.encode("utf-8"))
+    assert recipient(main, a) == ("two\rlines", "")
+
+
+# 前 110 KB 都是 ASCII 的 GBK 文件：编码要看整个文件，不能只看开头
+def test_gbk_after_long_ascii_prefix(main, client):
+    emails = addresses(5000)
+    rows = [f"{e},n{i}" for i, e in enumerate(emails[:-1])]
+    assert len("\n".join(rows)) > 110 * 1024
+    data = ("email,name\n" + "\n".join(rows) + f"\n{emails[-1]},张三\n").encode("gbk")
+    result = upload_bytes(client, data)
+    assert result["added"] == len(emails)
+    assert recipient(main, emails[-1]) == ("张三", "")
+
+
+def test_utf8_bom_and_utf16(main, client):
+    a, b = addresses(2)
+    upload_bytes(client, f"email,name\n{a},李四\n".encode("utf-8-sig"))
+    upload_bytes(client, f"email,name\n{b},王五\n".encode("utf-16"))
+    assert recipient(main, a) == ("李四", "")
+    assert recipient(main, b) == ("王五", "")
+
+
+# 固定列不区分大小写，其余列保留表头原样对应模板变量
+def test_header_case(main):
+    stats = {"rows": 0, "bad": 0}
+    rows = list(main.iter_csv_rows(BytesIO(b"EMAIL,Name,Real_Name,Company\na@bench.test,A,AA,ACME\n"), stats))
+    assert rows == [{"email": "a@bench.test", "name": "A", "real_name": "AA", "Company": "ACME"}]
+
+
+# Python 3.10 及以前 werkzeug 存上传文件用的 SpooledTemporaryFile 没有 readable() 等方法，经 Flask 上传也要能导入
+def test_upload_without_io_methods(main, client, monkeypatch):
+    import tempfile
+    for name in ("readable", "writable", "seekable", "read1", "readinto", "readinto1", "detach"):
+        monkeypatch.delattr(tempfile.SpooledTemporaryFile, name, raising=False)
+    a, b = addresses(2)
+    result = upload_bytes(client, f"email,name\r\n{a},甲\r\n{b},\"x\r\ny\"\r\n".encode("gbk"))
+    assert result["added"] == 2
+    assert recipient(main, a) == ("甲", "")
+    assert recipient(main, b) == ("x\r\ny", "")
+
+
+# 归一邮箱在插入时写入 email_key 列，按邮箱查找走索引
+def test_email_key_indexed(main, client):
+    (a,) = addresses(1)
+    upload_bytes(client, f"email\n{a.upper()}\n".encode("utf-8"))
+    assert main.db_execute("SELECT email,email_key FROM recipients WHERE email_key=?", (a,)) == [(a.upper(), a)]
+    assert main.db_known_emails([a, "missing@ok.test"]) == {a}
+    assert main.db_delete_pending_emails(["missing@ok.test"]) == 0
+
+
+def test_delete_recipient_requires_email(client):
+    assert client.post("/delete-recipient", json={}).status_code == 400
+    assert client.post("/delete-recipient", json={"email": "  "}).status_code == 400
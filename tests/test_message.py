@@ -0,0 +1,52 @@
+import smtplib
+
+import pytest
+
+from bench import MIME_CASES, MIME_RECIPIENTS
+
+SENDERS = ("sender@bench.test", "发件人@bench.test")
+
+
+# 骨架输出必须与 MIMEText 路径经 smtplib 规范化后的字节完全一致
+@pytest.mark.parametrize("subject,body", MIME_CASES)
+@pytest.mark.parametrize("recipient", MIME_RECIPIENTS, ids=lambda r: r["email"])
+@pytest.mark.parametrize("sender", SENDERS)
+def test_factory_matches_mimetext(main, subject, body, recipient, sender):
+    factory = main.MessageFactory(main.CompiledTemplate(subject), main.CompiledTemplate(body))
+    expected = main.build_message({"email": sender}, recipient["email"],
+                                  factory.subject_tpl.render(recipient), factory.body_tpl.render(recipient))
+    assert factory.build(sender, recipient) == smtplib._fix_eols(expected).encode("utf-8")
+
+
+def test_shared_payload_hides_recipients(main):
+    factory = main.MessageFactory(main.CompiledTemplate("固定主题"), main.CompiledTemplate("固定正文"))
+    assert factory.shared
+    payload = factory.build_shared("sender@bench.test")
+    assert b"To: undisclosed-recipients:;\r\n" in payload
+    assert factory.build_shared("sender@bench.test") is payload
+    assert not main.MessageFactory(main.CompiledTemplate("{name}"), main.CompiledTemplate("x")).shared
+
+
+# 编译后的模板与原来逐个收件人调用 str.format 的结果一致
+@pytest.mark.parametrize("source", [
+    "您好 {name}，\n我是 {real_name}，来自 {company}。",
+    "{name!r} {name!s} {real_name:>8} {company:_<6}",
+    "{{literal}} {name}{{}}",
+    "no fields",
+    "",
+])
+def test_template_matches_str_format(main, source):
+    recipients = [{"email": "a@bench.test", "name": "张三", "real_name": "Zhang", "company": "ACME"},
+                  {"email": "b@bench.test", "name": "", "real_name": "", "company": ""}]
+    template = main.CompiledTemplate(source)
+    assert template.render_many(recipients) == [source.format(**r) for r in recipients]
+
+
+def test_template_missing_value_renders_empty(main):
+    assert main.CompiledTemplate("[{name}][{company}]").render({"name": None}) == "[][]"
+
+
+@pytest.mark.parametrize("source", ["{0}", "{name.attr}", "{name[0]}", "{name!x}", "{name:{w}}", "{name", "}"])
+def test_template_rejects_unsupported(main, source):
+    with pytest.raises(main.TemplateError):
+        main.CompiledTemplate(source)